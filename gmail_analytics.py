@@ -0,0 +1,515 @@
+import os
+import re
+import sys
+import json
+import time
+import struct
+import logging
+import argparse
+import datetime
+import threading
+import collections
+from array import array
+from email.utils import parseaddr
+from typing import List, Dict, Any, Optional, Tuple
+
+from gmail_conditions import create_check, rule_conditions
+
+try:
+    import numpy
+except ImportError:
+    # Analytics fall back to the array module and Counter, a few times slower on millions of rows
+    numpy = None
+
+logger = logging.getLogger(__name__)
+
+METADATA_FILE = 'mailbox_metadata.col'
+
+# Headers the export keeps from each message.
+EXPORT_HEADERS = ['From', 'Subject']
+
+# Messages buffered before the export appends them to its file as one block.
+EXPORT_BLOCK_SIZE = 10000
+
+# Each block is a little-endian length, a JSON header of that length, and the
+# raw column bytes the header lists.
+BLOCK_PREFIX = struct.Struct('<I')
+
+# Column type codes: 'q' for millisecond dates and sizes, 'i' for codes into
+# a dictionary kept in the block header.
+COLUMN_TYPES = {'internalDate': 'q', 'sizeEstimate': 'q', 'sender': 'i', 'subject': 'i', 'labels': 'i'}
+
+# Mail providers whose addresses belong to individuals, so suggestions name
+# the sender rather than the whole domain.
+PERSONAL_DOMAINS = {'gmail.com', 'googlemail.com', 'outlook.com', 'hotmail.com', 'live.com', 'yahoo.com',
+                    'icloud.com', 'me.com', 'aol.com', 'proton.me', 'protonmail.com', 'gmx.com'}
+
+# Second-level names that say nothing about the sender, as in news.bbc.co.uk.
+GENERIC_DOMAIN_PARTS = {'co', 'com', 'org', 'net', 'ac', 'gov', 'edu', 'mail', 'email', 'e', 'news'}
+
+SUBJECT_PREFIX = re.compile(r'^(?:\s*(?:re|fwd?|aw|wg)\s*:)+\s*', re.IGNORECASE)
+DIGITS = re.compile(r'\d+')
+
+DAY_MS = 86400000
+
+def sender_address(from_header: str) -> str:
+    return parseaddr(from_header)[1].lower()
+
+def subject_key(subject: str) -> str:
+    """Return a subject with reply prefixes dropped and numbers masked, so recurring mail groups together."""
+    return ' '.join(DIGITS.sub('#', SUBJECT_PREFIX.sub('', subject.lower())).split())[:80]
+
+def _header(message: Dict[str, Any], name: str) -> str:
+    return next((h['value'] for h in message.get('payload', {}).get('headers', []) if h['name'] == name), '')
+
+class _Dictionary:
+    """Assigns consecutive codes to the distinct values of one column."""
+
+    def __init__(self):
+        self.codes: Dict[Any, int] = {}
+        self.values: List[Any] = []
+
+    def code(self, value) -> int:
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+def _write_block(f, rows: int, columns: Dict[str, array], strings: Dict[str, List[str]],
+                 dictionaries: Dict[str, List[Any]]) -> None:
+    encoded = {name: '\n'.join(values).encode('utf-8') for name, values in strings.items()}
+    raw = {}
+    for name, column in columns.items():
+        if sys.byteorder != 'little':
+            column = array(column.typecode, column)
+            column.byteswap()
+        raw[name] = column.tobytes()
+    header = json.dumps({
+        'rows': rows,
+        'strings': [[name, len(data)] for name, data in encoded.items()],
+        'columns': [[name, columns[name].typecode, len(data)] for name, data in raw.items()],
+        'dictionaries': dictionaries,
+    }).encode('utf-8')
+    f.write(BLOCK_PREFIX.pack(len(header)))
+    f.write(header)
+    for data in list(encoded.values()) + list(raw.values()):
+        f.write(data)
+
+class MetadataExport:
+    """Streams a snapshot of the mailbox's metadata into a columnar file.
+
+    Pass one to apply_rules as `export`; only runs listing the whole mailbox
+    feed it. Every message's ID, thread, date, sender, subject, labels and
+    size are buffered column by column, the text ones as codes into
+    per-block dictionaries, and appended to a partial file every
+    EXPORT_BLOCK_SIZE messages. finish() replaces `metadata_file` with it
+    once every message was listed, so the file holds one snapshot instead
+    of growing with each run, and an interrupted run keeps the last one.
+    """
+
+    def __init__(self, metadata_file: str = METADATA_FILE):
+        self.metadata_file = metadata_file
+        self.partial_file = f"{metadata_file}.partial"
+        self.headers = EXPORT_HEADERS
+        self.lock = threading.Lock()
+        self.rows = 0
+        self._start_block()
+
+    def start(self) -> None:
+        """Begin a new snapshot, dropping what an unfinished one wrote."""
+        with self.lock:
+            open(self.partial_file, 'wb').close()
+            self.rows = 0
+            self._start_block()
+
+    def _start_block(self) -> None:
+        self.ids: List[str] = []
+        self.threads: List[str] = []
+        self.columns = {name: array(typecode) for name, typecode in COLUMN_TYPES.items()}
+        self.dictionaries = {name: _Dictionary() for name in ('sender', 'subject', 'labels')}
+
+    def add(self, message: Dict[str, Any]) -> None:
+        """Buffer a message fetched by the engine (metadata or full format)."""
+        with self.lock:
+            self.ids.append(message['id'])
+            self.threads.append(message.get('threadId') or '')
+            self.columns['internalDate'].append(int(message.get('internalDate') or 0))
+            self.columns['sizeEstimate'].append(int(message.get('sizeEstimate') or 0))
+            self.columns['sender'].append(self.dictionaries['sender'].code(sender_address(_header(message, 'From'))))
+            self.columns['subject'].append(self.dictionaries['subject'].code(subject_key(_header(message, 'Subject'))))
+            # Messages share a handful of label combinations, so each row stores one code for its set
+            label_set = ','.join(sorted(message.get('labelIds', [])))
+            self.columns['labels'].append(self.dictionaries['labels'].code(label_set))
+            full = len(self.ids) >= EXPORT_BLOCK_SIZE
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        """Append the buffered messages to the partial snapshot as one block."""
+        with self.lock:
+            if not self.ids:
+                return
+            with open(self.partial_file, 'ab') as f:
+                _write_block(f, len(self.ids), self.columns, {'id': self.ids, 'threadId': self.threads},
+                             {name: dictionary.values for name, dictionary in self.dictionaries.items()})
+            self.rows += len(self.ids)
+            self._start_block()
+
+    def finish(self, complete: bool) -> None:
+        """Publish the snapshot if it is `complete`, otherwise discard it."""
+        self.flush()
+        with self.lock:
+            if complete and os.path.exists(self.partial_file):
+                os.replace(self.partial_file, self.metadata_file)
+                logger.info(f"Exported the metadata of {self.rows} messages to {self.metadata_file}")
+            elif os.path.exists(self.partial_file):
+                os.remove(self.partial_file)
+
+def _read_block(f) -> Optional[Tuple[Dict[str, Any], Dict[str, List[str]], Dict[str, bytes]]]:
+    """Read the next block as (header, string columns, raw columns), or None if no whole block is left.
+
+    Returns None at the end of the file, leaving `f` there; a partial block
+    leaves `f` somewhere before the end.
+    """
+    start = f.tell()
+    prefix = f.read(BLOCK_PREFIX.size)
+    try:
+        if len(prefix) < BLOCK_PREFIX.size:
+            raise ValueError("short prefix")
+        header_data = f.read(BLOCK_PREFIX.unpack(prefix)[0])
+        header = json.loads(header_data)
+        strings = {}
+        for name, length in header['strings']:
+            data = f.read(length)
+            if len(data) < length:
+                raise ValueError("short string column")
+            strings[name] = data.decode('utf-8').split('\n')
+        raw = {}
+        for name, _, length in header['columns']:
+            raw[name] = f.read(length)
+            if len(raw[name]) < length:
+                raise ValueError("short column")
+        if header['rows'] and len(strings['id']) != header['rows']:
+            raise ValueError("row count mismatch")
+        return header, strings, raw
+    except (ValueError, KeyError, UnicodeDecodeError):
+        # Rewind so the caller can tell a partial block from the end of the file
+        f.seek(start)
+        return None
+
+def _remap(codes: array, mapping: List[int]) -> array:
+    """Translate block-local dictionary codes into table-wide ones."""
+    if numpy is not None:
+        return array('i', numpy.asarray(mapping, dtype=numpy.int32)[numpy.frombuffer(codes, dtype=numpy.int32)].tobytes())
+    return array('i', map(mapping.__getitem__, codes))
+
+class MailboxMetadata:
+    """The exported metadata of a mailbox, one column per field.
+
+    `dates` and `sizes` are int64 arrays, and `sender`, `domain`, `subject`
+    and `labels` int32 codes into `senders`, `domains`, `subjects` and
+    `label_sets` (tuples of label IDs). Columns are `array.array`s, or NumPy
+    arrays when NumPy is installed.
+    """
+
+    def __init__(self):
+        self.ids: List[str] = []
+        self.threads: List[str] = []
+        self.dates = array('q')
+        self.sizes = array('q')
+        self.sender = array('i')
+        self.subject = array('i')
+        self.labels = array('i')
+        self.senders: List[str] = []
+        self.subjects: List[str] = []
+        self.label_sets: List[Tuple[str, ...]] = []
+        self.domain = array('i')
+        self.domains: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def load(cls, metadata_file: str = METADATA_FILE) -> 'MailboxMetadata':
+        """Read every block of a metadata file, keeping the latest copy of each message.
+
+        A block cut short at the end of the file, e.g. by a crash while it
+        was written, is skipped with a warning.
+        """
+        table = cls()
+        dictionaries = {name: _Dictionary() for name in ('sender', 'subject', 'labels')}
+        columns = {name: array(typecode) for name, typecode in COLUMN_TYPES.items()}
+        with open(metadata_file, 'rb') as f:
+            while True:
+                block = _read_block(f)
+                if block is None:
+                    if f.read(1):
+                        logger.warning(f"Ignoring a truncated block at the end of {metadata_file}")
+                    break
+                header, strings, raw = block
+                table.ids.extend(strings['id'])
+                table.threads.extend(strings['threadId'])
+                for name, typecode, _ in header['columns']:
+                    column = array(typecode)
+                    column.frombytes(raw[name])
+                    if sys.byteorder != 'little':
+                        column.byteswap()
+                    if name in dictionaries:
+                        column = _remap(column, [dictionaries[name].code(value) for value in header['dictionaries'][name]])
+                    columns[name].extend(column)
+
+        latest = {message_id: row for row, message_id in enumerate(table.ids)}
+        if len(latest) < len(table.ids):
+            keep = sorted(latest.values())
+            table.ids = [table.ids[row] for row in keep]
+            table.threads = [table.threads[row] for row in keep]
+            for name, column in columns.items():
+                columns[name] = array(column.typecode, [column[row] for row in keep])
+
+        table.senders = dictionaries['sender'].values
+        table.subjects = dictionaries['subject'].values
+        table.label_sets = [tuple(filter(None, value.split(','))) for value in dictionaries['labels'].values]
+        domains = _Dictionary()
+        domain_codes = [domains.code(address.rpartition('@')[2]) for address in table.senders]
+        table.domains = domains.values
+        table.dates, table.sizes = columns['internalDate'], columns['sizeEstimate']
+        table.sender, table.subject, table.labels = columns['sender'], columns['subject'], columns['labels']
+        table.domain = _remap(table.sender, domain_codes)
+        if numpy is not None:
+            for name in ('dates', 'sizes', 'sender', 'subject', 'labels', 'domain'):
+                column = getattr(table, name)
+                setattr(table, name, numpy.frombuffer(column, dtype=numpy.int64 if column.typecode == 'q' else numpy.int32))
+        return table
+
+    def save(self, metadata_file: str) -> None:
+        """Write the table as a single block, which also drops the older copies of re-fetched messages."""
+        temporary = f"{metadata_file}.tmp"
+        with open(temporary, 'wb') as f:
+            columns = {
+                'internalDate': array('q', self.dates), 'sizeEstimate': array('q', self.sizes),
+                'sender': array('i', self.sender), 'subject': array('i', self.subject), 'labels': array('i', self.labels),
+            }
+            _write_block(f, len(self), columns, {'id': self.ids, 'threadId': self.threads}, {
+                'sender': self.senders, 'subject': self.subjects,
+                'labels': [','.join(label_set) for label_set in self.label_sets],
+            })
+        os.replace(temporary, metadata_file)
+
+    def to_parquet(self, path: str) -> None:
+        """Write the table as a Parquet file with the text columns dictionary-encoded."""
+        # Imported here because pyarrow is an optional dependency
+        import pyarrow
+        import pyarrow.parquet
+
+        def dictionary(codes, values):
+            return pyarrow.DictionaryArray.from_arrays(pyarrow.array(codes, type=pyarrow.int32()), pyarrow.array(values))
+
+        table = pyarrow.table({
+            'id': self.ids,
+            'threadId': self.threads,
+            'date': pyarrow.array(self.dates, type=pyarrow.int64()).cast(pyarrow.timestamp('ms', tz='UTC')),
+            'sender': dictionary(self.sender, self.senders),
+            'domain': dictionary(self.domain, self.domains),
+            'subject': dictionary(self.subject, self.subjects),
+            'labels': dictionary(self.labels, [','.join(label_set) for label_set in self.label_sets]),
+            'size': pyarrow.array(self.sizes, type=pyarrow.int64()),
+        })
+        pyarrow.parquet.write_table(table, path)
+
+def _counts(codes, size: int) -> List[int]:
+    """Return how many rows hold each code from 0 to size - 1."""
+    if numpy is not None:
+        return numpy.bincount(codes, minlength=size).tolist()
+    counts = [0] * size
+    for code, count in collections.Counter(codes).items():
+        counts[code] = count
+    return counts
+
+def _top(counts: List[int], values: List[Any], total: int, limit: int) -> List[Dict[str, Any]]:
+    ranked = sorted(range(len(counts)), key=counts.__getitem__, reverse=True)[:limit]
+    return [{'value': values[code], 'messages': counts[code], 'share': counts[code] / total}
+            for code in ranked if counts[code]]
+
+def is_user_label(label_id: str) -> bool:
+    return label_id.startswith('Label_')
+
+def analyze_mailbox(table: MailboxMetadata, label_names: Optional[Dict[str, str]] = None,
+                    top: int = 20) -> Dict[str, Any]:
+    """Summarize a mailbox: top senders, domains and subjects, volume per month and label coverage.
+
+    Every statistic is a count over a code column, so the cost is one
+    vectorized pass per column plus work proportional to the dictionaries.
+    """
+    started = time.perf_counter()
+    label_names = label_names or {}
+    total = len(table) or 1
+    set_counts = _counts(table.labels, len(table.label_sets))
+    per_label = collections.Counter()
+    unlabeled = 0
+    for label_set, count in zip(table.label_sets, set_counts):
+        for label_id in label_set:
+            per_label[label_id] += count
+        if not any(is_user_label(label_id) for label_id in label_set):
+            unlabeled += count
+
+    months = collections.Counter()
+    if len(table):
+        if numpy is not None:
+            days = table.dates // DAY_MS
+            first = int(days.min())
+            day_counts = numpy.bincount(days - first).tolist()
+        else:
+            days = [date // DAY_MS for date in table.dates]
+            first = min(days)
+            day_counts = [0] * (max(days) - first + 1)
+            for day, count in collections.Counter(days).items():
+                day_counts[day - first] = count
+        epoch = datetime.date(1970, 1, 1)
+        for offset, count in enumerate(day_counts):
+            if count:
+                months[(epoch + datetime.timedelta(days=first + offset)).strftime('%Y-%m')] += count
+
+    return {
+        'messages': len(table),
+        'senders': _top(_counts(table.sender, len(table.senders)), table.senders, total, top),
+        'domains': _top(_counts(table.domain, len(table.domains)), table.domains, total, top),
+        'subjects': _top(_counts(table.subject, len(table.subjects)), table.subjects, total, top),
+        'months': sorted(months.items()),
+        'labels': [{'value': label_names.get(label_id, label_id), 'messages': count, 'share': count / total}
+                   for label_id, count in per_label.most_common()],
+        'unlabeled': unlabeled,
+        'unlabeled_share': unlabeled / total,
+        'seconds': time.perf_counter() - started,
+    }
+
+def _covered(address: str, from_checks) -> bool:
+    message = {'payload': {'headers': [{'name': 'From', 'value': address}]}}
+    return any(check(message) for check in from_checks)
+
+def suggested_label(key: str) -> str:
+    """Return a label name for a sender address or an @domain."""
+    if not key.startswith('@'):
+        return key.partition('@')[0]
+    parts = key[1:].split('.')[:-1]
+    while len(parts) > 1 and parts[-1] in GENERIC_DOMAIN_PARTS:
+        parts.pop()
+    return parts[-1].capitalize() if parts else key[1:]
+
+def suggest_rules(table: MailboxMetadata, rules: List[Dict[str, Any]], min_messages: int = 50,
+                  limit: int = 10) -> List[Dict[str, Any]]:
+    """Suggest rules for the senders behind the most mail that no user label covers.
+
+    Mail from personal providers is grouped by sender and the rest by domain.
+    Senders a single-condition From rule already matches are skipped. Each
+    suggestion has the rule definition, the number of messages it would
+    match, how many of those have no user label, and a reason.
+    """
+    from_checks = [create_check(rule_conditions(rule)[0]) for rule in rules
+                   if not rule.get('conditions') and rule.get('condition_field') == 'From']
+    unlabeled_sets = [not any(is_user_label(label_id) for label_id in label_set) for label_set in table.label_sets]
+    if numpy is not None:
+        mask = numpy.asarray(unlabeled_sets, dtype=bool)[table.labels] if len(table) else numpy.zeros(0, dtype=bool)
+        sender_total = numpy.bincount(table.sender, minlength=len(table.senders)).tolist()
+        sender_unlabeled = numpy.bincount(table.sender[mask], minlength=len(table.senders)).tolist()
+    else:
+        sender_total = _counts(table.sender, len(table.senders))
+        sender_unlabeled = [0] * len(table.senders)
+        for sender, label_set in zip(table.sender, table.labels):
+            if unlabeled_sets[label_set]:
+                sender_unlabeled[sender] += 1
+
+    # Senders of personal providers stand alone; other senders add up per domain
+    groups: Dict[str, List[int]] = {}
+    for code, address in enumerate(table.senders):
+        if not address or not sender_unlabeled[code]:
+            continue
+        domain = address.rpartition('@')[2]
+        groups.setdefault(address if domain in PERSONAL_DOMAINS else '@' + domain, []).append(code)
+
+    suggestions = []
+    ranked = sorted(groups.items(), key=lambda item: -sum(sender_unlabeled[code] for code in item[1]))
+    for key, codes in ranked:
+        unlabeled = sum(sender_unlabeled[code] for code in codes)
+        if unlabeled < min_messages:
+            break
+        if all(_covered(table.senders[code], from_checks) for code in codes):
+            continue
+        messages = sum(sender_total[code] for code in codes)
+        suggestions.append({
+            'rule': {'condition_field': 'From', 'condition_operator': 'contains', 'condition_value': key,
+                     'action_type': 'Label as', 'action_value': suggested_label(key)},
+            'messages': messages,
+            'unlabeled': unlabeled,
+            'reason': f"{unlabeled} of {messages} messages from {key} have no label",
+        })
+        if len(suggestions) >= limit:
+            break
+    return suggestions
+
+def describe_analytics(analytics: Dict[str, Any], top: int = 10) -> str:
+    """Return the analytics as a short multi-line report."""
+    lines = [f"{analytics['messages']} messages, {analytics['unlabeled_share']:.0%} without a label "
+             f"(analyzed in {analytics['seconds']:.2f}s)"]
+    for key, title in (('domains', 'Top domains'), ('senders', 'Top senders'), ('subjects', 'Recurring subjects'),
+                       ('labels', 'Labels')):
+        lines.append(f"{title}:")
+        lines.extend(f"  {entry['messages']:>8}  {entry['share']:6.1%}  {entry['value']}"
+                     for entry in analytics[key][:top])
+    lines.append("Messages per month:")
+    lines.extend(f"  {month}  {count:>8}" for month, count in analytics['months'][-24:])
+    return '\n'.join(lines)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Summarize the exported mailbox metadata "
+                                                 "and suggest rules for unlabeled mail.")
+    parser.add_argument('--file', default=METADATA_FILE, help="metadata file to read (default: %(default)s)")
+    parser.add_argument('--rules', default='rules.db',
+                        help="rule store whose From rules are not suggested again (default: %(default)s)")
+    parser.add_argument('--top', type=int, default=10, help="entries per list (default: %(default)s)")
+    parser.add_argument('--min-messages', type=int, default=50,
+                        help="unlabeled messages a sender needs to be suggested (default: %(default)s)")
+    parser.add_argument('--compact', action='store_true', help="rewrite the file without older copies of messages")
+    parser.add_argument('--parquet', metavar='FILE', help="also write the table as Parquet (needs pyarrow)")
+    parser.add_argument('--json', action='store_true', help="print the analytics and suggestions as JSON")
+    return parser.parse_args(argv)
+
+def main(argv=None) -> int:
+    """Print mailbox analytics and rule suggestions and return the exit status."""
+    args = parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    if not os.path.exists(args.file):
+        logger.error(f"No metadata in {args.file}; export it with gmail-apply-rules --export-only --export {args.file}")
+        return 2
+    try:
+        table = MailboxMetadata.load(args.file)
+        if args.compact:
+            table.save(args.file)
+        if args.parquet:
+            table.to_parquet(args.parquet)
+        rules = []
+        if os.path.exists(args.rules):
+            # Imported here because only suggestions read the rule store
+            from gmail_rule_store import RuleStore
+            rules = RuleStore(args.rules).all()
+        analytics = analyze_mailbox(table, top=args.top)
+        suggestions = suggest_rules(table, rules, min_messages=args.min_messages, limit=args.top)
+    except ImportError as e:
+        logger.error(f"Parquet export needs pyarrow ({e})")
+        return 1
+    except Exception as e:
+        logger.error(f"Error analyzing {args.file}: {e}")
+        return 1
+    if args.json:
+        print(json.dumps({'analytics': analytics, 'suggestions': suggestions}))
+    else:
+        print(describe_analytics(analytics, args.top))
+        print("Suggested rules:")
+        for suggestion in suggestions:
+            rule = suggestion['rule']
+            print(f"  From contains '{rule['condition_value']}' → Label as '{rule['action_value']}' "
+                  f"({suggestion['reason']})")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,17 +1,36 @@
 import os
-import datetime
-from datetime import UTC
-from dateutil.relativedelta import relativedelta
+import sys
+import signal
+import argparse
 import google.auth
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.http import HttpRequest
+from google_auth_httplib2 import AuthorizedHttp
+import httplib2
 import logging
 import threading
 import time
 import json
-from typing import List, Dict, Any, Optional, Callable
+import queue
+import datetime
+import hashlib
+import weakref
+import collections
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional, Callable, Set, Tuple
+from gmail_conditions import (
+    create_condition, condition_headers, needs_body, rule_query, combine_queries, describe_conditions,
+    rule_conditions, label_search_name, BodyRequired, create_any_condition, conditions_implied,
+    conditions_contradiction, CHANGING_FIELDS
+)
+from gmail_body import BodyReader, BODY_MAX_BYTES
+from gmail_rule_store import RuleStore, RULES_DB_FILE
+from gmail_profiler import NullProfiler, RunProfiler
+from gmail_cassette import RecordingService, ReplayService
+from gmail_analytics import MetadataExport, METADATA_FILE
 
 # Configure logging
 logging.basicConfig(
@@ -24,106 +43,1148 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-# If modifying these SCOPES, delete the file token.json.
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+# A saved token missing any of these SCOPES is replaced by signing in again.
+SCOPES = [
+    'https://www.googleapis.com/auth/gmail.modify',
+    # Needed to sync rules with Gmail filters
+    'https://www.googleapis.com/auth/gmail.settings.basic',
+]
+
+# Gmail enforces a per-user quota of 250 units per second; each API method
+# consumes a fixed number of units.
+DEFAULT_QUOTA_PER_SECOND = 250
+QUOTA_UNITS = {
+    'messages.list': 5,
+    'messages.get': 5,
+    'messages.modify': 5,
+    'messages.batchModify': 50,
+    'labels.list': 1,
+    'labels.create': 5,
+    'labels.patch': 5,
+    'labels.delete': 5,
+    'labels.get': 1,
+    'filters.list': 1,
+    'filters.create': 5,
+    'filters.delete': 5,
+}
+
+# Partial-response masks, so each call only returns the fields this app reads.
+# messages.get masks depend on the rules; see message_fields.
+LABEL_FIELDS = 'id,name,type'
+FIELDS = {
+    'messages.list': 'messages/id,nextPageToken',
+    'messages.modify': 'id',
+    'labels.list': f'labels({LABEL_FIELDS})',
+    'labels.get': 'id,messagesTotal,messagesUnread,threadsTotal',
+    'labels.create': LABEL_FIELDS,
+    'labels.patch': LABEL_FIELDS,
+    'filters.list': 'filter(id,criteria,action)',
+    'filters.create': 'id',
+    'getProfile': 'emailAddress,messagesTotal,threadsTotal',
+}
+
+# What BodyReader walks in a full message: the MIME tree (three levels
+# deep, then whole), each part's type, charset header and inline data.
+BODY_PART_FIELDS = 'mimeType,filename,headers,body(data,attachmentId)'
+BODY_FIELDS = f'payload({BODY_PART_FIELDS},parts({BODY_PART_FIELDS},parts({BODY_PART_FIELDS},parts)))'
+
+# Messages listed per messages.list page (the API maximum), and per run.
+LIST_PAGE_SIZE = 500
+MAX_MESSAGES = 100000
+
+# Messages in the inbox, unread or newer than this many days are processed
+# before the rest of the mailbox.
+RECENT_DAYS = 7
+PRIORITY_QUERY = f"{{in:inbox is:unread newer_than:{RECENT_DAYS}d}}"
+
+# Backlog pages listed ahead, in the background, while fresh mail is processed.
+BACKLOG_PREFETCH_PAGES = 4
+
+# Requests per HTTP batch, and message IDs per batchModify call (the API maximum).
+BATCH_REQUEST_SIZE = 50
+BATCH_MODIFY_SIZE = 1000
+
+# Seconds per-label message counts are reused before being fetched again.
+LABEL_COUNTS_TTL = 300
 
-# Global control events
-pause_event = threading.Event()
-stop_event = threading.Event()
+# Which rules have already been evaluated against which mail, kept between
+# runs so unchanged rules only see new mail.
+RULE_LEDGER_FILE = 'rules_ledger.json'
+
+# Mail received this long before a run started is evaluated again by the next
+# run, in case it was still arriving while the run listed messages.
+LEDGER_OVERLAP_MS = 60 * 60 * 1000
+
+# Messages sent to an evaluation worker at a time, and the ruleset size at
+# which evaluating in worker processes starts to pay off.
+EVAL_CHUNK_SIZE = 200
+POOL_RULE_THRESHOLD = 50
+
+# Adaptive tuning (see AdaptiveTuner): calls per method between decisions,
+# how far per-message latency may rise over the best seen (never taken as
+# less than the floor, in seconds) before batches shrink, the factor a
+# decrease applies, the minimum seconds between two decreases, and the
+# lowest rate tuning goes down to.
+TUNING_WINDOW = 20
+TUNING_LATENCY_FACTOR = 2.0
+TUNING_LATENCY_FLOOR = 0.005
+TUNING_DECREASE = 0.5
+TUNING_COOLDOWN = 1.0
+MIN_QUOTA_PER_SECOND = 10
+
+# Rules sharing an action that the optimizer compares pairwise for
+# subsumption; larger groups are only checked for exact duplicates.
+SUBSUMPTION_LIMIT = 500
+
+# Seconds between checks of pause and stop events set by another process
+# (multi-account runs), whose changes cannot wake this process's waits.
+EVENT_POLL_INTERVAL = 0.05
+
+# Attempts after a throttled or failed-on-the-server call, and the seconds
+# waited before the first one (doubling each time).
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
 
 class GmailRule:
-    def __init__(self, name: str, condition: Callable[[Dict[str, Any]], bool], action: Callable[[Dict[str, Any], Any], None]):
+    def __init__(self, name: str, condition: Callable[[Dict[str, Any]], bool], action: Callable[[Dict[str, Any], Any], None],
+                 rule_id: Optional[str] = None, priority: int = 0, stop_processing: bool = False,
+                 headers: Optional[List[str]] = None, query: Optional[str] = None,
+                 needs_body: bool = False, definition: Optional[Dict[str, Any]] = None,
+                 server_filter: bool = False,
+                 delta: Optional[Callable[..., Tuple[List[str], List[str]]]] = None):
         self.name = name
         self.condition = condition
         self.action = action
+        self.id = rule_id or name
+        # Header names the condition reads; None means it needs the full message
+        self.headers = headers
+        # Gmail query selecting a superset of the messages this rule can match
+        self.query = query
+        # Whether the condition reads the message body through msg['bodyReader']
+        self.needs_body = needs_body
+        # The rules.json entry this rule was built from, if any
+        self.definition = definition
+        # Higher priorities run first; ties keep their file order
+        self.priority = priority
+        # When this rule matches, rules after it are not applied
+        self.stop_processing = stop_processing
+        # Whether a Gmail filter already applies this rule to new mail
+        self.server_filter = server_filter
+        # delta(service, controller) returns the label IDs the action adds and
+        # removes; runs group these changes into batchModify calls. Rules
+        # without one run `action` on each message instead.
+        self.delta = delta
+
+def rule_id(rule_data: Dict[str, Any]) -> str:
+    """Return the rule's stored ID, or one derived from its condition and action."""
+    if rule_data.get('id'):
+        return rule_data['id']
+    key = '|'.join(str(rule_data.get(k, '')) for k in
+                   ('condition_field', 'condition_operator', 'condition_value', 'action_type', 'action_value'))
+    if rule_data.get('conditions'):
+        key += '|' + json.dumps(rule_data['conditions'], sort_keys=True)
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:12]
+
+def stats_file_for(rules_file: str) -> str:
+    """Return the statistics file kept next to a rules file."""
+    return f"{os.path.splitext(rules_file)[0]}_stats.json"
+
+def ledger_file_for(rules_file: str) -> str:
+    """Return the evaluation ledger kept next to a rules file."""
+    return f"{os.path.splitext(rules_file)[0]}_ledger.json"
+
+def rule_fingerprint(rule: GmailRule) -> Optional[str]:
+    """Return a hash of what a rule does, or None for rules without a definition."""
+    if not rule.definition:
+        return None
+    definition = {k: v for k, v in rule.definition.items() if k not in ('id', 'server_filter')}
+    return hashlib.sha1(json.dumps(definition, sort_keys=True).encode('utf-8')).hexdigest()[:12]
+
+def coverage_fingerprint(rule: GmailRule) -> Optional[str]:
+    """Return the rule's fingerprint if the ledger can track it, else None.
+
+    Coverage assumes a message's result never changes once it has been
+    evaluated, which does not hold for Age, Label and Status conditions
+    (CHANGING_FIELDS): rules with them go over all mail on every run.
+    """
+    if not rule.definition or any(condition['field'] in CHANGING_FIELDS
+                                  for condition in definition_conditions(rule.definition)):
+        return None
+    return rule_fingerprint(rule)
+
+class RuleStats:
+    """Evaluation, match and cost counters per rule ID.
+
+    The counters order rule evaluation. They are only kept between runs
+    with a `stats_file`, normally stats_file_for the rules file.
+    """
+
+    def __init__(self, stats_file: Optional[str] = None):
+        self.stats_file = stats_file
+        self.counters: Dict[str, Dict[str, int]] = {}
+        self.load()
+
+    def load(self) -> None:
+        if not self.stats_file or not os.path.exists(self.stats_file):
+            return
+        try:
+            with open(self.stats_file, 'r') as f:
+                self.counters = json.load(f)
+        except Exception as e:
+            logger.error(f"Error loading rule statistics: {e}")
+            self.counters = {}
+
+    def save(self) -> None:
+        if not self.stats_file:
+            return
+        try:
+            with open(self.stats_file, 'w') as f:
+                json.dump(self.counters, f)
+        except Exception as e:
+            logger.error(f"Error saving rule statistics: {e}")
+
+    def record(self, rule_id: str, matched: bool, elapsed_ns: int) -> None:
+        counter = self.counters.setdefault(rule_id, {'evaluations': 0, 'matches': 0, 'cost_ns': 0})
+        counter['evaluations'] += 1
+        counter['matches'] += int(matched)
+        counter['cost_ns'] += elapsed_ns
+
+    def merge(self, counters: Dict[str, Dict[str, int]]) -> None:
+        """Add counters gathered elsewhere, such as in a worker process."""
+        for rule_id, delta in counters.items():
+            counter = self.counters.setdefault(rule_id, {'evaluations': 0, 'matches': 0, 'cost_ns': 0})
+            for key, value in delta.items():
+                counter[key] = counter.get(key, 0) + value
+
+    def match_rate(self, rule_id: str) -> float:
+        """Smoothed fraction of evaluations that matched."""
+        counter = self.counters.get(rule_id, {})
+        return (counter.get('matches', 0) + 1) / (counter.get('evaluations', 0) + 10)
+
+    def average_cost(self, rule_id: str) -> Optional[float]:
+        """Mean evaluation time in nanoseconds, or None if never evaluated."""
+        counter = self.counters.get(rule_id)
+        if not counter or not counter['evaluations']:
+            return None
+        return counter['cost_ns'] / counter['evaluations']
+
+class EvaluationLedger:
+    """Which mail each rule has already been evaluated against.
+
+    A complete run over the whole mailbox covers the mail received before
+    it started, less LEDGER_OVERLAP_MS. The ledger keeps, per rule ID, the
+    fingerprint of the definition that was evaluated and the internalDate it
+    is covered up to, plus for each recorded run the ruleset and the range
+    of mail each rule was evaluated over. An edited rule has a new
+    fingerprint and so no coverage, and rules whose result for a message can
+    change later have none at all (see coverage_fingerprint).
+    """
+
+    MAX_RUNS = 50
+
+    def __init__(self, ledger_file: Optional[str] = RULE_LEDGER_FILE):
+        self.ledger_file = ledger_file
+        self.rules: Dict[str, Dict[str, Any]] = {}
+        self.runs: List[Dict[str, Any]] = []
+        self.load()
+
+    def load(self) -> None:
+        if not self.ledger_file or not os.path.exists(self.ledger_file):
+            return
+        try:
+            with open(self.ledger_file, 'r') as f:
+                data = json.load(f)
+            self.rules = data.get('rules', {})
+            self.runs = data.get('runs', [])
+        except Exception as e:
+            logger.error(f"Error loading evaluation ledger: {e}")
+            self.rules, self.runs = {}, []
+
+    def save(self) -> None:
+        if not self.ledger_file:
+            return
+        try:
+            with open(self.ledger_file, 'w') as f:
+                json.dump({'rules': self.rules, 'runs': self.runs}, f)
+        except Exception as e:
+            logger.error(f"Error saving evaluation ledger: {e}")
+
+    def covered_until(self, rule: GmailRule) -> int:
+        """Return the internalDate (ms) up to which a rule has been evaluated, or 0."""
+        entry = self.rules.get(rule.id)
+        fingerprint = coverage_fingerprint(rule)
+        if not entry or fingerprint is None or entry['fingerprint'] != fingerprint:
+            return 0
+        return entry['covered_until']
+
+    def record(self, rules: List[GmailRule], started: float) -> None:
+        """Mark the rules of a complete run started at `started` as covering the mail before it."""
+        covered_until = int(started * 1000) - LEDGER_OVERLAP_MS
+        evaluated = {}
+        for rule in rules:
+            fingerprint = coverage_fingerprint(rule)
+            if fingerprint is None:
+                continue
+            previous = self.covered_until(rule)
+            evaluated[rule.id] = [previous, covered_until]
+            self.rules[rule.id] = {'fingerprint': fingerprint, 'covered_until': max(previous, covered_until)}
+        ruleset = hashlib.sha1(json.dumps(sorted(self.rules[rule_id]['fingerprint'] for rule_id in evaluated))
+                               .encode('utf-8')).hexdigest()[:12]
+        self.runs = (self.runs + [{'finished': time.time(), 'ruleset': ruleset, 'evaluated': evaluated}])[-self.MAX_RUNS:]
+        self.save()
+
+    def reset(self) -> None:
+        """Forget all coverage, so the next run evaluates every rule over every message."""
+        self.rules, self.runs = {}, []
+        self.save()
+
+def covered_query(rule: GmailRule, covered_until: int) -> Optional[str]:
+    """Return the rule's query narrowed to mail received after its coverage."""
+    if not covered_until:
+        return rule.query
+    after = f"after:{covered_until // 1000}"
+    return f"({rule.query}) {after}" if rule.query else after
+
+class RuleEvaluator:
+    """Evaluate rules in a cost-based order while keeping declared-order results.
+
+    The declared order is priority (highest first), then file order. A
+    matching rule with `stop_processing` suppresses every rule declared after
+    it, so the result is the same as walking the declared list. Stop rules are
+    evaluated first, those most likely to match cheaply and prune many later
+    rules leading, and rules that an earlier stop rule has already suppressed
+    are never evaluated.
+    """
+
+    REORDER_INTERVAL = 500
+
+    def __init__(self, rules: List[GmailRule], stats: Optional[RuleStats] = None):
+        self.rules = sorted(rules, key=lambda rule: -rule.priority)
+        self.stats = stats or RuleStats(stats_file=None)
+        self.evaluated_since_reorder = 0
+        self.order = list(range(len(self.rules)))
+        self.reorder()
+
+    def reorder(self) -> None:
+        """Recompute the evaluation order from the current statistics."""
+        known_costs = [cost for cost in (self.stats.average_cost(rule.id) for rule in self.rules) if cost is not None]
+        default_cost = sum(known_costs) / len(known_costs) if known_costs else 1.0
+        total = len(self.rules)
+
+        def score(index):
+            rule = self.rules[index]
+            if not rule.stop_processing:
+                # Non-stop rules never prune anything, so they go last in declared order
+                return (1, 0.0, index)
+            cost = self.stats.average_cost(rule.id)
+            if cost is None:
+                cost = default_cost
+            pruned = (total - index) / total
+            return (0, cost / (self.stats.match_rate(rule.id) * pruned), index)
+
+        self.order = sorted(range(total), key=score)
+        self.evaluated_since_reorder = 0
+
+    def evaluate(self, msg: Dict[str, Any]) -> List[GmailRule]:
+        """Return the rules whose actions apply to `msg`, in declared order."""
+        cutoff = len(self.rules)
+        matched = []
+        for index in self.order:
+            if index >= cutoff:
+                continue
+            rule = self.rules[index]
+            start = time.perf_counter_ns()
+            result = bool(rule.condition(msg))
+            self.stats.record(rule.id, result, time.perf_counter_ns() - start)
+            if result:
+                matched.append(index)
+                if rule.stop_processing:
+                    cutoff = index
+        self.evaluated_since_reorder += 1
+        if self.evaluated_since_reorder >= self.REORDER_INTERVAL:
+            self.reorder()
+        return [self.rules[index] for index in sorted(matched) if index <= cutoff]
+
+class StopProcessing(Exception):
+    """Raised inside a run when its controller has been stopped."""
+
+class CancellationToken:
+    """Tells the stages of a run, and whatever they are waiting on, that the run was stopped.
+
+    Cancelling wakes every wait() at once, so pacing and retry waits end
+    right away and requests not sent yet are abandoned instead of made.
+    """
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.reason: Optional[str] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.reason is not None
+
+    def cancel(self, reason: str = "Processing stopped") -> None:
+        with self.condition:
+            if self.reason is None:
+                self.reason = reason
+            self.condition.notify_all()
+
+    def raise_if_cancelled(self) -> None:
+        if self.reason is not None:
+            raise StopProcessing(self.reason)
+
+    def wait(self, timeout: float) -> bool:
+        """Sleep up to `timeout` seconds, returning early with True once cancelled."""
+        with self.condition:
+            return self.condition.wait_for(lambda: self.reason is not None, timeout)
+
+    def sleep(self, seconds: float) -> None:
+        """Sleep for `seconds`, raising StopProcessing as soon as the token is cancelled."""
+        if self.wait(seconds):
+            raise StopProcessing(self.reason)
+
+class QuotaPacer:
+    """Token bucket that keeps one account below its per-second quota."""
+
+    def __init__(self, units_per_second: float = DEFAULT_QUOTA_PER_SECOND):
+        self.units_per_second = units_per_second
+        self.available = float(units_per_second)
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+        # Times a call had to wait for quota, so tuning can tell when the rate holds a run back
+        self.waits = 0
+
+    def acquire(self, units: float, token: Optional[CancellationToken] = None) -> None:
+        """Block until `units` quota units are available, then consume them.
+
+        Cancelling `token` ends the wait with StopProcessing.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(
+                    float(self.units_per_second),
+                    self.available + (now - self.last_refill) * self.units_per_second
+                )
+                self.last_refill = now
+                if self.available >= units:
+                    self.available -= units
+                    return
+                wait = (units - self.available) / self.units_per_second
+                self.waits += 1
+            if token is None:
+                time.sleep(wait)
+            else:
+                token.sleep(wait)
+
+class RunController:
+    """Pause, stop, progress and quota pacing for a single processing run.
+
+    Each account gets its own controller. The events default to
+    `threading.Event`, but any object with the same interface works, such as
+    the `multiprocessing.Manager().Event()` proxies used by the multi-account
+    runner. Pausing, resuming and stopping through the controller wake a
+    waiting run through a condition variable; events set from another
+    process are noticed within EVENT_POLL_INTERVAL. Stopping also cancels
+    `token`, the run's CancellationToken.
+    """
+
+    def __init__(self, name: str = 'default', pause_event=None, stop_event=None,
+                 quota_per_second: Optional[float] = DEFAULT_QUOTA_PER_SECOND,
+                 progress_callback: Optional[Callable[[Dict[str, Any]], None]] = None):
+        self.name = name
+        self.external_events = pause_event is not None or stop_event is not None
+        # A caller's stop event is only ever set by the caller, never cleared here
+        self.owns_stop_event = stop_event is None
+        self.pause_event = pause_event if pause_event is not None else threading.Event()
+        self.stop_event = stop_event if stop_event is not None else threading.Event()
+        self.condition = threading.Condition()
+        self.token = CancellationToken()
+        # time.monotonic() when the stop was requested, to report how fast the run acknowledged it
+        self.stop_requested: Optional[float] = None
+        self.pacer = QuotaPacer(quota_per_second) if quota_per_second else None
+        self.progress_callback = progress_callback
+        self.progress: Dict[str, Any] = {}
+        self.reset_progress()
+
+    def set_pause(self, pause: bool) -> None:
+        """Set or clear the pause event."""
+        with self.condition:
+            if pause:
+                self.pause_event.set()
+            else:
+                self.pause_event.clear()
+            self.condition.notify_all()
+        logger.info(f"[{self.name}] Processing {'paused' if pause else 'resumed'}")
+
+    def set_stop(self) -> None:
+        """Set the stop event and cancel the run's token."""
+        with self.condition:
+            self.stop_event.set()
+            self.stop_requested = time.monotonic()
+            self.condition.notify_all()
+        self.token.cancel("Processing stopped by user")
+        logger.info(f"[{self.name}] Processing stopped by user")
+
+    def reset(self) -> None:
+        """Clear progress and issue a new token before a new run.
+
+        The stop event is only cleared if the controller created it, so a
+        stop set on a caller's event while the run was queued still holds.
+        """
+        with self.condition:
+            if self.owns_stop_event:
+                self.stop_event.clear()
+            self.stop_requested = None
+            self.token = CancellationToken()
+        self.reset_progress()
+
+    def stopped(self) -> bool:
+        """Whether the run was stopped, cancelling the token if another process set the stop event."""
+        if self.token.cancelled:
+            return True
+        if self.stop_event.is_set():
+            if self.stop_requested is None:
+                self.stop_requested = time.monotonic()
+            self.token.cancel("Processing stopped by user")
+            return True
+        return False
+
+    def check_pause(self, log_func=None) -> None:
+        """Wait while processing is paused; raise StopProcessing once it is stopped."""
+        if self.stopped():
+            raise StopProcessing(self.token.reason)
+
+        if self.pause_event.is_set():
+            if log_func:
+                log_func("Processing paused...")
+            timeout = EVENT_POLL_INTERVAL if self.external_events else None
+            with self.condition:
+                while self.pause_event.is_set() and not self.stopped():
+                    self.condition.wait(timeout)
+            if self.stopped():
+                raise StopProcessing(self.token.reason)
+            if log_func:
+                log_func("Processing resumed...")
+
+    def consume(self, method: str, token: Optional[CancellationToken] = None) -> None:
+        """Account for one call to `method`, sleeping if the quota is exhausted.
+
+        With a `token`, cancelling it ends the sleep with StopProcessing.
+        """
+        if self.pacer:
+            self.pacer.acquire(QUOTA_UNITS.get(method, 5), token)
+
+    def reset_progress(self) -> None:
+        self.progress = {'state': 'idle', 'processed': 0, 'total': 0, 'rules_applied': {}}
+        self._publish()
+
+    def update_progress(self, **kwargs) -> None:
+        """Merge `kwargs` into the progress snapshot and publish it."""
+        self.progress.update(kwargs)
+        self._publish()
+
+    def _publish(self) -> None:
+        if self.progress_callback:
+            self.progress_callback(dict(self.progress))
+
+# Controller used by the module-level helpers below and by callers that do
+# not pass their own.
+default_controller = RunController()
 
 def set_pause(pause: bool) -> None:
-    """Set or clear the pause event."""
-    if pause:
-        pause_event.set()
-        logger.info("Processing paused")
-    else:
-        pause_event.clear()
-        logger.info("Processing resumed")
+    """Set or clear the pause event of the default controller."""
+    default_controller.set_pause(pause)
 
 def set_stop() -> None:
-    """Set the stop event."""
-    stop_event.set()
-    logger.info("Processing stopped by user")
+    """Set the stop event of the default controller."""
+    default_controller.set_stop()
 
 def check_pause(log_func=None) -> None:
-    """Check if processing should be paused or stopped."""
-    if stop_event.is_set():
-        raise Exception("Processing stopped by user")
-        
-    if pause_event.is_set():
-        if log_func:
-            log_func("Processing paused...")
-        while pause_event.is_set() and not stop_event.is_set():
-            time.sleep(0.1)
-        if not stop_event.is_set():
-            if log_func:
-                log_func("Processing resumed...")
+    """Check if the default controller is paused or stopped."""
+    default_controller.check_pause(log_func)
+
+def error_status(error: Exception) -> Optional[int]:
+    """Return the HTTP status of a Gmail API error, or None for other errors."""
+    return getattr(getattr(error, 'resp', None), 'status', None)
+
+def is_transient(error: Exception) -> bool:
+    """Whether an error is throttling or a server fault, which a later retry may not hit."""
+    status = error_status(error)
+    if status == 429 or (status is not None and status >= 500):
+        return True
+    return status == 403 and any(reason in str(error) for reason in ('rateLimitExceeded', 'userRateLimitExceeded'))
+
+class TunedSetting:
+    """One run setting adjusted by additive increase and multiplicative decrease."""
+
+    def __init__(self, name: str, value: float, minimum: float, maximum: float, step: float):
+        self.name = name
+        self.initial = value
+        self.value = value
+        self.minimum = minimum
+        self.maximum = maximum
+        self.step = step
+
+    def increase(self) -> bool:
+        return self._set(min(self.maximum, self.value + self.step))
+
+    def decrease(self) -> bool:
+        return self._set(max(self.minimum, type(self.value)(self.value * TUNING_DECREASE)))
+
+    def _set(self, value) -> bool:
+        changed = value != self.value
+        self.value = value
+        return changed
+
+class FixedTuning:
+    """Stand-in used when a run's request rate and batch sizes stay as configured."""
+
+    def __init__(self):
+        self.fetch_batch_size = 1
+        self.modify_batch_size = BATCH_MODIFY_SIZE
+        self.page_size = LIST_PAGE_SIZE
+
+    def start(self, controller: 'RunController', log_func=None, page_size: int = LIST_PAGE_SIZE) -> None:
+        self.page_size = page_size
+
+    def stop(self) -> None:
+        pass
+
+    def observe(self, method: str, seconds: float, items: int = 1, error: Optional[Exception] = None) -> None:
+        pass
+
+    def report(self) -> Dict[str, Any]:
+        return {}
+
+class AdaptiveTuner:
+    """Adjusts a run's request rate and batch sizes to how the API responds.
+
+    Every Gmail call of the run is reported to `observe` with its latency,
+    the messages it covered and its error, if any. The settings follow AIMD:
+    throttling (429 or a rate-limit 403) and server errors halve the quota
+    rate and the batch size of the method that hit them, at most once per
+    TUNING_COOLDOWN seconds. After every TUNING_WINDOW clean calls of a
+    method, its batch size grows by one step, or shrinks if the latency per
+    message has risen past TUNING_LATENCY_FACTOR times the best seen; the
+    rate only grows back toward the configured quota while calls are
+    waiting for quota. Each change is logged with its reason and kept in
+    `decisions`. The run's messages are fetched in HTTP batches of
+    `fetch_batch_size`, changes are sent `modify_batch_size` messages at a
+    time and lists ask for `page_size` messages per page.
+    """
+
+    def __init__(self, fetch_batch_size: int = 10, modify_batch_size: int = BATCH_MODIFY_SIZE // 2):
+        self.settings = {
+            'messages.get': TunedSetting('fetch batch size', fetch_batch_size, 1, BATCH_REQUEST_SIZE, 5),
+            'messages.batchModify': TunedSetting('modify batch size', modify_batch_size, 50, BATCH_MODIFY_SIZE, 100),
+            'messages.list': TunedSetting('list page size', LIST_PAGE_SIZE, 50, LIST_PAGE_SIZE, 50),
+        }
+        self.rate: Optional[TunedSetting] = None
+        self.pacer: Optional[QuotaPacer] = None
+        self.log_func = logger.info
+        self.windows: Dict[str, Dict[str, Any]] = {}
+        self.decisions: List[Dict[str, Any]] = []
+        self._pacer_waits = 0
+        self._last_decrease = -TUNING_COOLDOWN
+
+    @property
+    def fetch_batch_size(self) -> int:
+        return self.settings['messages.get'].value
+
+    @property
+    def modify_batch_size(self) -> int:
+        return self.settings['messages.batchModify'].value
+
+    @property
+    def page_size(self) -> int:
+        return self.settings['messages.list'].value
+
+    def start(self, controller: 'RunController', log_func=None, page_size: int = LIST_PAGE_SIZE) -> None:
+        self.log_func = log_func or logger.info
+        self.settings['messages.list'].maximum = page_size
+        self.settings['messages.list'].value = min(self.page_size, page_size)
+        self.pacer = controller.pacer
+        if self.pacer is not None:
+            quota = float(self.pacer.units_per_second)
+            self.rate = TunedSetting('quota rate', quota, min(quota, MIN_QUOTA_PER_SECOND), quota, quota / 10)
+            self._pacer_waits = self.pacer.waits
+        self.log_func(f"Tuning request rate and batch sizes: fetching {self.fetch_batch_size} messages per "
+                      f"batch, {self.modify_batch_size} per label change, {self.page_size} per list page")
+
+    def stop(self) -> None:
+        """Give the controller back its configured rate."""
+        if self.rate is not None:
+            self.pacer.units_per_second = self.rate.initial
+
+    def observe(self, method: str, seconds: float, items: int = 1, error: Optional[Exception] = None) -> None:
+        setting = self.settings.get(method)
+        window = self.windows.setdefault(method, {'calls': 0, 'latency': None, 'best': None})
+        if error is not None:
+            if is_transient(error) and time.monotonic() - self._last_decrease >= TUNING_COOLDOWN:
+                self._last_decrease = time.monotonic()
+                reason = f"{method} returned {error_status(error)}"
+                if setting is not None:
+                    self._change(setting, setting.decrease, reason)
+                if self.rate is not None:
+                    self._change(self.rate, self.rate.decrease, reason)
+                window['calls'] = 0
+            return
+        if setting is None:
+            return
+        latency = seconds / max(items, 1)
+        window['latency'] = latency if window['latency'] is None else 0.8 * window['latency'] + 0.2 * latency
+        window['calls'] += 1
+        if window['calls'] < TUNING_WINDOW:
+            return
+        window['calls'] = 0
+        latency = window['latency']
+        if window['best'] is None or latency < window['best']:
+            window['best'] = latency
+        if latency > TUNING_LATENCY_FACTOR * max(window['best'], TUNING_LATENCY_FLOOR):
+            self._change(setting, setting.decrease,
+                         f"{method} takes {latency * 1000:.0f} ms per message, best {window['best'] * 1000:.0f} ms")
+        else:
+            self._change(setting, setting.increase,
+                         f"{TUNING_WINDOW} {method} calls without errors at {latency * 1000:.0f} ms per message")
+        if self.rate is not None and self.pacer.waits > self._pacer_waits:
+            self._change(self.rate, self.rate.increase,
+                         f"{self.pacer.waits - self._pacer_waits} waits for quota since the last decision")
+        if self.pacer is not None:
+            self._pacer_waits = self.pacer.waits
+
+    def _change(self, setting: TunedSetting, adjust, reason: str) -> None:
+        before = setting.value
+        if not adjust():
+            return
+        if setting is self.rate:
+            self.pacer.units_per_second = setting.value
+        self.decisions.append({'time': time.time(), 'setting': setting.name,
+                               'from': before, 'to': setting.value, 'reason': reason})
+        self.log_func(f"Tuning: {setting.name} {before:g} → {setting.value:g} ({reason})")
+
+    def report(self) -> Dict[str, Any]:
+        settings = {setting.name: setting.value for setting in self.settings.values()}
+        if self.rate is not None:
+            settings[self.rate.name] = self.rate.value
+        return {'settings': settings, 'decisions': list(self.decisions)}
+
+def execute_request(request, method: str, controller: 'RunController', tuner=None, items: int = 1,
+                    token: Optional[CancellationToken] = None):
+    """Execute a request, retrying throttling and server errors with backoff.
+
+    Each attempt is paced by `controller` and reported to `tuner`. Once
+    `token` (the controller's by default) is cancelled the request is not
+    sent, or retried, and StopProcessing is raised instead.
+    """
+    if token is None:
+        token = controller.token
+    for attempt in range(MAX_RETRIES + 1):
+        token.raise_if_cancelled()
+        controller.consume(method, token)
+        started = time.monotonic()
+        try:
+            response = request.execute()
+        except Exception as e:
+            if tuner is not None:
+                tuner.observe(method, time.monotonic() - started, items, e)
+            if attempt == MAX_RETRIES or not is_transient(e):
+                raise
+            logger.warning(f"{method} failed ({e}); retrying in {RETRY_BACKOFF * 2 ** attempt:g}s")
+            token.sleep(RETRY_BACKOFF * 2 ** attempt)
+            continue
+        if tuner is not None:
+            tuner.observe(method, time.monotonic() - started, items)
+        return response
 
-def authenticate_gmail():
-    """Authenticate with Gmail API."""
+def authenticate_gmail(token_file: str = 'token.json', credentials_file: str = 'credentials.json',
+                       interactive: bool = True):
+    """Authenticate with Gmail API.
+
+    With `interactive=False` a missing or unrefreshable token raises instead of
+    opening the browser flow, which is what background workers need. A token
+    granted before a scope in SCOPES was added counts as missing, so the
+    user is asked to consent again.
+    """
     creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
+    if os.path.exists(token_file):
+        # Loaded with the scopes it was granted rather than the ones asked for
+        creds = Credentials.from_authorized_user_file(token_file)
+        if not creds.has_scopes(SCOPES):
+            logger.info(f"The token in {token_file} lacks scopes this version needs; signing in again")
+            creds = None
     if not creds or not creds.valid:
         if creds and creds.expired and creds.refresh_token:
             creds.refresh(Request())
+        elif not interactive:
+            raise RuntimeError(f"No valid token with the required scopes in {token_file}; "
+                               f"authenticate this account interactively first")
         else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
+            flow = InstalledAppFlow.from_client_secrets_file(credentials_file, SCOPES)
             creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
+        with open(token_file, 'w') as token:
             token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    return build_service(creds)
+
+def build_service(creds):
+    """Build a Gmail service that several threads can use at once.
+
+    httplib2 connections are not thread-safe, so every thread making
+    requests gets its own authorized connection, which it keeps reusing.
+    """
+    local = threading.local()
 
-def get_all_messages(service, query: Optional[str] = None, log_func=None) -> List[Dict[str, Any]]:
+    def thread_http():
+        if not hasattr(local, 'http'):
+            local.http = AuthorizedHttp(creds, http=httplib2.Http())
+        return local.http
+
+    def request_builder(http, *args, **kwargs):
+        return HttpRequest(thread_http(), *args, **kwargs)
+
+    return build('gmail', 'v1', http=thread_http(), requestBuilder=request_builder)
+
+def get_all_messages(service, query: Optional[str] = None, log_func=None,
+                     controller: Optional[RunController] = None,
+                     max_messages: int = MAX_MESSAGES,
+                     page_size: int = LIST_PAGE_SIZE) -> List[Dict[str, Any]]:
     """Fetch all messages from Gmail."""
     if log_func is None:
         log_func = logger.info
+    if controller is None:
+        controller = default_controller
         
     messages = []
     page_token = None
     page_count = 0
-    MAX_MESSAGES = 100000
     
     while True:
-        check_pause(log_func)  # Check for pause
+        controller.check_pause(log_func)  # Check for pause
         try:
-            if len(messages) >= MAX_MESSAGES:
-                log_func(f"Reached maximum message limit of {MAX_MESSAGES}")
+            if len(messages) >= max_messages:
+                log_func(f"Reached maximum message limit of {max_messages}")
                 break
 
+            controller.consume('messages.list')
             response = service.users().messages().list(
                 userId='me',
                 q=query,
-                maxResults=500,
-                pageToken=page_token
+                maxResults=min(page_size, max_messages - len(messages)),
+                pageToken=page_token,
+                fields=FIELDS['messages.list']
             ).execute()
             
             if 'messages' in response:
                 messages.extend(response['messages'])
                 page_count += 1
                 log_func(f"Fetched {len(messages)} messages (page {page_count})")
-                check_pause(log_func)  # Check for pause after each page
+                controller.check_pause(log_func)  # Check for pause after each page
             
             page_token = response.get('nextPageToken')
             if not page_token:
                 break
                 
+        except StopProcessing:
+            raise
         except Exception as e:
             log_func(f'Error fetching messages: {e}')
             break
     
     return messages
 
-def get_or_create_label(service, label_name: str) -> str:
+class PagePrefetcher:
+    """Lists the pages of a query on a background thread, a few pages ahead of their use.
+
+    Iterating yields the pages in order and re-raises any error the
+    listing hit, including StopProcessing.
+    """
+
+    def __init__(self, pages, controller: RunController, depth: int = BACKLOG_PREFETCH_PAGES):
+        self.controller = controller
+        self.queue = queue.Queue(maxsize=depth)
+        self.closed = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(pages,), name='page-prefetch', daemon=True)
+        self.thread.start()
+
+    def _run(self, pages) -> None:
+        try:
+            for page in pages:
+                if not self._put(('page', page)):
+                    return
+            self._put(('done', None))
+        except Exception as e:
+            self._put(('error', e))
+
+    def _put(self, item) -> bool:
+        # Waits for room, giving up once the consumer is gone
+        while not self.closed.is_set():
+            try:
+                self.queue.put(item, timeout=EVENT_POLL_INTERVAL)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        while True:
+            self.controller.check_pause()
+            try:
+                kind, value = self.queue.get(timeout=EVENT_POLL_INTERVAL)
+            except queue.Empty:
+                continue
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+
+    def close(self) -> None:
+        self.closed.set()
+
+class MessageScheduler:
+    """Lists the messages of a run lazily, fresh mail first.
+
+    Messages in the inbox, unread or recent (PRIORITY_QUERY) are listed and
+    handed out before the historical backlog, which skips anything already
+    handed out. Pages are requested as work needs them, so processing
+    starts after the first page; the backlog's first pages are listed in
+    the background (see PagePrefetcher) while fresh mail is processed, so
+    it starts without waiting on the listing. Iterating yields (class name,
+    message stub) pairs, newest first within a class.
+    """
+
+    def __init__(self, service, query: Optional[str] = None, log_func=None,
+                 controller: Optional[RunController] = None, max_messages: int = MAX_MESSAGES,
+                 page_size: int = LIST_PAGE_SIZE, prioritize: bool = True, profiler=None, tuner=None):
+        self.service = service
+        self.log_func = log_func or logger.info
+        self.controller = controller or default_controller
+        self.max_messages = max_messages
+        self.page_size = page_size
+        self.profiler = profiler or NullProfiler()
+        self.tuner = tuner or FixedTuning()
+        if prioritize:
+            self.classes = [('priority', f"{query} {PRIORITY_QUERY}" if query else PRIORITY_QUERY),
+                            ('backlog', query)]
+        else:
+            self.classes = [('all', query)]
+        self.progress = {name: {'listed': 0, 'processed': 0, 'done': False} for name, _ in self.classes}
+        self.seen = set()
+        self.failed = False
+
+    @property
+    def listed(self) -> int:
+        return len(self.seen)
+
+    @property
+    def complete(self) -> bool:
+        """Whether every message matching the query was listed."""
+        return not self.failed and all(progress['done'] for progress in self.progress.values())
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        return {name: dict(progress) for name, progress in self.progress.items()}
+
+    def mark_processed(self, class_name: str) -> None:
+        self.progress[class_name]['processed'] += 1
+
+    def _pages(self, query: Optional[str]):
+        page_token = None
+        while True:
+            self.controller.check_pause(self.log_func)
+            # At least one, since a prefetched class may list past the limit before it is reached
+            page_size = max(1, min(self.page_size, self.tuner.page_size, self.max_messages - self.listed))
+            with self.profiler.stage('list'):
+                request = self.service.users().messages().list(
+                    userId='me',
+                    q=query,
+                    maxResults=page_size,
+                    pageToken=page_token,
+                    fields=FIELDS['messages.list']
+                )
+                response = execute_request(request, 'messages.list', self.controller, self.tuner, page_size)
+            yield response.get('messages', [])
+            page_token = response.get('nextPageToken')
+            if not page_token:
+                return
+
+    def __iter__(self):
+        prefetcher = None
+        try:
+            for position, (name, query) in enumerate(self.classes):
+                if position == 0 and len(self.classes) > 1:
+                    prefetcher = PagePrefetcher(self._pages(self.classes[1][1]), self.controller)
+                pages = prefetcher if position == 1 and prefetcher is not None else self._pages(query)
+                yield from self._class_messages(name, query, pages)
+                if self.listed >= self.max_messages:
+                    return
+        finally:
+            if prefetcher is not None:
+                prefetcher.close()
+
+    def _class_messages(self, name: str, query: Optional[str], pages):
+        self.log_func(f"Listing {name} messages" + (f" matching: {query}" if query else ""))
+        try:
+            for page in pages:
+                for message in page:
+                    if message['id'] in self.seen:
+                        continue
+                    self.seen.add(message['id'])
+                    self.progress[name]['listed'] += 1
+                    yield name, message
+                if self.listed >= self.max_messages:
+                    self.log_func(f"Reached maximum message limit of {self.max_messages}")
+                    return
+        except StopProcessing:
+            raise
+        except Exception as e:
+            self.log_func(f'Error fetching {name} messages: {e}')
+            self.failed = True
+        self.progress[name]['done'] = True
+        self.log_func(f"Listed {self.progress[name]['listed']} {name} messages")
+
+class LabelTable:
+    """Local copy of an account's labels with name and ID lookups.
+
+    Loaded with one labels.list call and then kept current as labels are
+    created, so resolving a label name does not cost an API request.
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self.by_id: Dict[str, Dict[str, Any]] = {}
+        self.ids_by_name: Dict[str, str] = {}
+        self.loaded = False
+        self.lock = threading.Lock()
+
+    def refresh(self, controller: Optional[RunController] = None) -> None:
+        """Reload every label from Gmail."""
+        if controller:
+            controller.consume('labels.list')
+        labels = self.service.users().labels().list(userId='me', fields=FIELDS['labels.list']).execute().get('labels', [])
+        with self.lock:
+            self.by_id = {}
+            self.ids_by_name = {}
+            for label in labels:
+                self._store(label)
+            self.loaded = True
+
+    def ensure_loaded(self, controller: Optional[RunController] = None) -> None:
+        if not self.loaded:
+            self.refresh(controller)
+
+    def _store(self, label: Dict[str, Any]) -> None:
+        self.by_id[label['id']] = label
+        self.ids_by_name[label['name']] = label['id']
+
+    def add(self, label: Dict[str, Any]) -> None:
+        with self.lock:
+            self._store(label)
+
+    def update(self, label: Dict[str, Any]) -> None:
+        """Replace a label in place, e.g. after a rename."""
+        with self.lock:
+            old = self.by_id.get(label['id'])
+            if old:
+                self.ids_by_name.pop(old['name'], None)
+            self._store(dict(old or {}, **label))
+
+    def remove(self, label_id: str) -> None:
+        with self.lock:
+            label = self.by_id.pop(label_id, None)
+            if label:
+                self.ids_by_name.pop(label['name'], None)
+
+    def id_for(self, name: str) -> Optional[str]:
+        return self.ids_by_name.get(name)
+
+    def name_for(self, label_id: str) -> str:
+        label = self.by_id.get(label_id)
+        return label['name'] if label else label_id
+
+    def labels(self) -> List[Dict[str, Any]]:
+        return list(self.by_id.values())
+
+# One label table per Gmail service object
+_label_tables = weakref.WeakKeyDictionary()
+
+def label_table(service) -> LabelTable:
+    """Return the shared label table for a service."""
+    table = _label_tables.get(service)
+    if table is None:
+        table = LabelTable(service)
+        _label_tables[service] = table
+    return table
+
+class LabelCounts:
+    """Cached per-label message and thread counts.
+
+    Counts for all labels are fetched with batched labels.get requests and
+    reused for `ttl` seconds; labels a run touched can be invalidated so only
+    those are fetched again.
+    """
+
+    def __init__(self, service, ttl: float = LABEL_COUNTS_TTL):
+        self.service = service
+        self.ttl = ttl
+        self.counts: Dict[str, Dict[str, int]] = {}
+        self.fetched_at: Dict[str, float] = {}
+        self.lock = threading.Lock()
+
+    def get(self, label_id: str) -> Dict[str, int]:
+        with self.lock:
+            return self.counts.get(label_id, {})
+
+    def stale(self, label_ids: List[str]) -> List[str]:
+        now = time.monotonic()
+        with self.lock:
+            return [label_id for label_id in label_ids if now - self.fetched_at.get(label_id, -self.ttl) >= self.ttl]
+
+    def invalidate(self, label_ids) -> None:
+        with self.lock:
+            for label_id in label_ids:
+                self.fetched_at.pop(label_id, None)
+
+    def refresh(self, label_ids: List[str], controller: Optional[RunController] = None) -> List[str]:
+        """Fetch counts for the given labels that are stale and return their IDs."""
+        label_ids = self.stale(label_ids)
+
+        def fetched(request_id, response, exception):
+            if exception is not None:
+                logger.warning(f"Could not fetch counts for label {request_id}: {exception}")
+                return
+            with self.lock:
+                self.counts[request_id] = {
+                    'messagesTotal': response.get('messagesTotal', 0),
+                    'messagesUnread': response.get('messagesUnread', 0),
+                    'threadsTotal': response.get('threadsTotal', 0),
+                }
+                self.fetched_at[request_id] = time.monotonic()
+
+        for start in range(0, len(label_ids), BATCH_REQUEST_SIZE):
+            batch = self.service.new_batch_http_request(callback=fetched)
+            for label_id in label_ids[start:start + BATCH_REQUEST_SIZE]:
+                if controller:
+                    controller.consume('labels.get')
+                batch.add(self.service.users().labels().get(userId='me', id=label_id, fields=FIELDS['labels.get']),
+                          request_id=label_id)
+            batch.execute()
+        return label_ids
+
+def changed_label_ids(service, rules: List[GmailRule], rules_applied: Dict[str, int]) -> Set[str]:
+    """Return the IDs of the labels whose counts a run's actions changed."""
+    label_ids = set()
+    for rule in rules:
+        if not rules_applied.get(rule.name) or not rule.definition:
+            continue
+        add, remove = action_delta(rule.definition, service, create_labels=False)
+        label_ids.update(add, remove)
+    return label_ids
+
+def get_or_create_label(service, label_name: str, controller: Optional[RunController] = None) -> str:
     """Get or create a Gmail label."""
-    labels = service.users().labels().list(userId='me').execute().get('labels', [])
-    label_id = next((label['id'] for label in labels if label['name'] == label_name), None)
+    table = label_table(service)
+    table.ensure_loaded(controller)
+    label_id = table.id_for(label_name)
 
     if not label_id:
         label_body = {
@@ -131,200 +1192,1341 @@ def get_or_create_label(service, label_name: str) -> str:
             'labelListVisibility': 'labelShow',
             'messageListVisibility': 'show'
         }
-        created_label = service.users().labels().create(userId='me', body=label_body).execute()
+        if controller:
+            controller.consume('labels.create')
+        created_label = service.users().labels().create(userId='me', body=label_body,
+                                                        fields=FIELDS['labels.create']).execute()
+        table.add(created_label)
         label_id = created_label['id']
         logger.info(f'Created new label: {label_name}')
 
     return label_id
 
-def apply_rules(service, rules: List[GmailRule], log_func=None) -> None:
-    """Apply a list of rules to all messages."""
+def delete_labels(service, label_ids: List[str], controller: Optional[RunController] = None) -> Dict[str, str]:
+    """Delete labels with batched requests and drop them from the label table.
+
+    Returns the error message for every label that could not be deleted.
+    """
+    table = label_table(service)
+    errors = {}
+
+    def deleted(request_id, response, exception):
+        if exception is not None:
+            errors[request_id] = str(exception)
+        else:
+            table.remove(request_id)
+
+    for start in range(0, len(label_ids), BATCH_REQUEST_SIZE):
+        batch = service.new_batch_http_request(callback=deleted)
+        for label_id in label_ids[start:start + BATCH_REQUEST_SIZE]:
+            if controller:
+                controller.consume('labels.delete')
+            batch.add(service.users().labels().delete(userId='me', id=label_id), request_id=label_id)
+        batch.execute()
+    logger.info(f"Deleted {len(label_ids) - len(errors)} labels")
+    return errors
+
+def rename_label(service, label_id: str, new_name: str, controller: Optional[RunController] = None) -> Dict[str, Any]:
+    """Rename a label with labels.patch and update the label table."""
+    if controller:
+        controller.consume('labels.patch')
+    label = service.users().labels().patch(userId='me', id=label_id, body={'name': new_name},
+                                           fields=FIELDS['labels.patch']).execute()
+    label_table(service).update(label)
+    logger.info(f"Renamed label {label_id} to {new_name}")
+    return label
+
+def list_message_ids(service, query: Optional[str], log_func=None,
+                     controller: Optional[RunController] = None) -> List[str]:
+    """Return the IDs of every message matching `query`.
+
+    Unlike get_all_messages there is no limit, and a page that fails to
+    list raises instead of ending the listing early.
+    """
+    if controller is None:
+        controller = default_controller
+    message_ids = []
+    page_token = None
+    while True:
+        controller.check_pause(log_func)
+        request = service.users().messages().list(userId='me', q=query, maxResults=LIST_PAGE_SIZE,
+                                                  pageToken=page_token, fields=FIELDS['messages.list'])
+        response = execute_request(request, 'messages.list', controller)
+        message_ids.extend(message['id'] for message in response.get('messages', []))
+        page_token = response.get('nextPageToken')
+        if not page_token:
+            return message_ids
+
+def merge_labels(service, source_id: str, target_id: str, log_func=None,
+                 controller: Optional[RunController] = None, delete_source: bool = False) -> int:
+    """Move every message from one label to another and return how many moved.
+
+    Messages are listed with a `label:` search and relabelled with
+    batchModify, up to 1000 per call. With `delete_source`, the source label
+    is only deleted once a fresh search finds no message left on it.
+    """
+    if log_func is None:
+        log_func = logger.info
+    if controller is None:
+        controller = default_controller
+    table = label_table(service)
+    table.ensure_loaded(controller)
+    source_name = table.name_for(source_id)
+    source_query = f"label:{label_search_name(source_name)}"
+    message_ids = list_message_ids(service, source_query, log_func, controller)
+    for start in range(0, len(message_ids), BATCH_MODIFY_SIZE):
+        controller.check_pause(log_func)
+        controller.consume('messages.batchModify')
+        service.users().messages().batchModify(userId='me', body={
+            'ids': message_ids[start:start + BATCH_MODIFY_SIZE],
+            'addLabelIds': [target_id],
+            'removeLabelIds': [source_id],
+        }).execute()
+        log_func(f"Moved {min(start + BATCH_MODIFY_SIZE, len(message_ids))}/{len(message_ids)} messages "
+                 f"from {source_name} to {table.name_for(target_id)}")
+    if delete_source:
+        remaining = list_message_ids(service, source_query, log_func, controller)
+        if remaining:
+            raise RuntimeError(f"{len(remaining)} messages are still labeled {source_name}; the label was kept")
+        errors = delete_labels(service, [source_id], controller)
+        if errors:
+            raise RuntimeError(errors[source_id])
+    return len(message_ids)
+
+class LabelChangeBatcher:
+    """Groups label changes across messages into batchModify calls.
+
+    Messages that need the same change (the same label IDs added and
+    removed) are queued together and sent up to the tuner's modify batch
+    size (BATCH_MODIFY_SIZE unless tuned) at a time, so a rule that archives
+    30,000 messages costs 30 requests rather than 30,000. Throttled calls
+    are retried. `on_sent(message_ids, added, removed)` is called after each
+    successful call, and `on_failed(message_ids, error)` after a failed one.
+    Changes whose call a stopped run abandoned stay queued for flush().
+    """
+
+    def __init__(self, service, controller: RunController, log_func=None, profiler=None,
+                 on_sent=None, on_failed=None, tuner=None):
+        self.service = service
+        self.controller = controller
+        self.log_func = log_func or logger.info
+        self.profiler = profiler or NullProfiler()
+        self.tuner = tuner or FixedTuning()
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.groups: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], List[str]] = {}
+        self.requests = 0
+
+    def add(self, message_id: str, added: List[str], removed: List[str]) -> None:
+        if not added and not removed:
+            return
+        key = (tuple(sorted(added)), tuple(sorted(removed)))
+        message_ids = self.groups.setdefault(key, [])
+        message_ids.append(message_id)
+        if len(message_ids) >= self.tuner.modify_batch_size:
+            self._send(key)
+
+    def flush(self, token: Optional[CancellationToken] = None) -> None:
+        """Send every queued change.
+
+        Pass a `token` other than the controller's to send the changes of a
+        run that has been stopped.
+        """
+        for key in list(self.groups):
+            self._send(key, token)
+
+    @property
+    def queued(self) -> int:
+        return sum(len(message_ids) for message_ids in self.groups.values())
+
+    def _send(self, key, token: Optional[CancellationToken] = None) -> None:
+        message_ids = self.groups.pop(key)
+        added, removed = key
+        try:
+            with self.profiler.stage('modify'):
+                request = self.service.users().messages().batchModify(userId='me', body={
+                    'ids': message_ids,
+                    'addLabelIds': list(added),
+                    'removeLabelIds': list(removed),
+                })
+                execute_request(request, 'messages.batchModify', self.controller, self.tuner, len(message_ids),
+                                token)
+            self.requests += 1
+        except StopProcessing:
+            self.groups[key] = message_ids + self.groups.get(key, [])
+            raise
+        except Exception as e:
+            self.log_func(f"Error changing labels of {len(message_ids)} messages: {e}")
+            if self.on_failed:
+                self.on_failed(message_ids, e)
+            return
+        logger.debug(f"Added {list(added)} and removed {list(removed)} on {len(message_ids)} messages")
+        if self.on_sent:
+            self.on_sent(message_ids, list(added), list(removed))
+
+def apply_rules(service, rules: List[GmailRule], log_func=None,
+                controller: Optional[RunController] = None,
+                stats: Optional[RuleStats] = None,
+                body_max_bytes: int = BODY_MAX_BYTES,
+                eval_workers: int = 0,
+                index=None,
+                profiler=None,
+                query: Optional[str] = None,
+                max_messages: int = MAX_MESSAGES,
+                page_size: int = LIST_PAGE_SIZE,
+                eval_chunk_size: int = EVAL_CHUNK_SIZE,
+                dry_run: bool = False,
+                prioritize: bool = True,
+                journal=None,
+                skip_server_filters: bool = False,
+                ledger: Optional[EvaluationLedger] = None,
+                tuner=None,
+                optimize: bool = True,
+                export=None) -> Dict[str, Any]:
+    """Apply a list of rules to all messages and return the run statistics.
+
+    Bodies are only fetched for messages where a body condition is reached,
+    and at most `body_max_bytes` of each body is decoded. With `eval_workers`
+    above zero, rule matching runs in that many worker processes while this
+    process keeps fetching and modifying messages. Every fetched message is
+    added to `index` (a gmail_index.HeaderIndex), if given, for rule previews.
+    Pass a gmail_profiler.RunProfiler as `profiler` to time the run by stage
+    and by rule. `query` narrows the run to messages matching a Gmail search
+    as well, and with `dry_run` matches are counted but nothing is modified.
+    With `prioritize`, messages in the inbox, unread or recent are processed
+    before the rest (see MessageScheduler). Label changes are recorded in
+    `journal` (a gmail_journal.MutationJournal), if given, under the run ID
+    returned in the summary, so the run can be undone. Label changes are
+    grouped across messages into batchModify calls (see LabelChangeBatcher). With
+    `skip_server_filters`, rules a Gmail filter already enforces are left
+    out, which suits runs over new mail once the backlog is done. With a
+    `ledger`, each rule is only evaluated on mail newer than what earlier
+    runs already evaluated it against, so after adding or editing a rule
+    only that rule goes over the backlog; complete runs over the whole
+    mailbox are recorded in it. Pass an AdaptiveTuner as `tuner` to adjust
+    the request rate and batch sizes during the run; otherwise messages are
+    fetched one at a time and the configured sizes are kept. With
+    `optimize`, duplicate, subsumed and never-matching rules are left out
+    and rules sharing an action are evaluated as one (see optimize_rules).
+
+    When the run lists the whole mailbox, the metadata of every message is
+    streamed into `export` (a gmail_analytics.MetadataExport), if given,
+    for mailbox analytics; runs narrowed by a query, by rule conditions or
+    by the ledger would give a skewed sample and export nothing (see
+    export_mailbox).
+
+    Stopping the run through `controller` does not raise: queued requests
+    are abandoned, the label changes already decided are still sent, and
+    the summary's `status` is 'stopped' instead of 'complete'.
+    """
+    if controller is None:
+        controller = default_controller
+    if stats is None:
+        stats = RuleStats()
+    if profiler is None:
+        profiler = NullProfiler()
+    if tuner is None:
+        tuner = FixedTuning()
     # Reset stop event at the start of processing
-    stop_event.clear()
+    controller.reset()
     
     if log_func is None:
         log_func = logger.info
     
+    if controller.stopped():
+        # Stopped while queued or signing in, before anything was listed
+        log_func("Rule application stopped before it started.")
+        controller.update_progress(state='stopped')
+        return {'status': 'stopped', 'stop_latency': 0.0, 'processed': 0, 'total': 0, 'rules_applied': {},
+                'classes': {}, 'run_id': None, 'tuning': None, 'optimizer': None, 'changed_labels': []}
+    
     log_func("Starting rule application process...")
+    if skip_server_filters:
+        filtered = [rule for rule in rules if rule.server_filter]
+        rules = [rule for rule in rules if not rule.server_filter]
+        log_func(f"Skipping {len(filtered)} rules enforced by Gmail filters")
     log_func(f"Total rules to apply: {len(rules)}")
     
-    # Fetch all messages
-    log_func("Fetching all messages...")
-    all_messages = get_all_messages(service, log_func=log_func)
-    total_count = len(all_messages)
-    log_func(f"Total messages to process: {total_count}")
+    started = time.time()
+    # Age thresholds are measured from the start of the run, not from when the rules were built
+    now = datetime.datetime.fromtimestamp(started, datetime.UTC)
+    rules = [rebuilt_for_run(rule, now) for rule in rules]
+    user_query = query
+    declared_rules = rules
+    coverage = {}
+    if ledger is not None:
+        for rule in rules:
+            covered_until = ledger.covered_until(rule)
+            if covered_until:
+                coverage[rule.id] = covered_until
+        log_func(f"{len(rules) - len(coverage)} rules are new or changed and go over all mail; "
+                 f"{len(coverage)} only see mail they have not been evaluated against")
+    optimizer = None
+    if optimize:
+        rules, coverage, optimizer = optimize_rules(rules, coverage, now)
+        if optimizer is None:
+            log_func("Some rules have no definition or share an ID; evaluating them as declared")
+        else:
+            log_func(f"Optimizer: {describe_analysis(optimizer)}")
+    # Let the server drop messages no rule can match
+    rules_query = combine_queries([covered_query(rule, coverage.get(rule.id, 0)) for rule in rules])
+    if query and rules_query:
+        query = f"({query}) ({rules_query})"
+    else:
+        query = query or rules_query
+    if export is not None:
+        if query:
+            log_func("Not exporting mailbox metadata: this run only lists part of the mailbox")
+            export = None
+        else:
+            export.start()
+    context = None
+    stopped = False
+    stop_latency = 0.0
+    listed_all = False
+    profiler.start(rules, stats)
+    tuner.start(controller, log_func, page_size)
+    try:
+        context = RunContext(service, rules, log_func, controller, stats, body_max_bytes, index, profiler, dry_run,
+                             export)
+        context.tuner = tuner
+        context.coverage = coverage
+        if journal is not None and not dry_run:
+            context.journal = journal
+            context.run_id = journal.start_run(f"{len(declared_rules)} rules"
+                                               + (f", query {user_query}" if user_query else ""))
+            log_func(f"Recording changes under run ID {context.run_id}")
+        if not dry_run:
+            context.batcher = LabelChangeBatcher(service, controller, log_func, profiler,
+                                                 on_sent=context.changes_sent, on_failed=context.changes_failed,
+                                                 tuner=tuner)
+        
+        if query:
+            log_func(f"Fetching messages matching: {query}")
+        else:
+            log_func("Fetching all messages...")
+        # Messages are listed page by page as processing needs them
+        scheduler = MessageScheduler(service, query, log_func, controller, max_messages, page_size,
+                                     prioritize, profiler, tuner)
+        
+        # Process messages
+        processed_count = 0
+        controller.update_progress(state='running', classes=scheduler.snapshot())
+        
+        if eval_workers and not all(rule.definition for rule in rules):
+            log_func("Some rules have no definition to send to worker processes; evaluating in this process")
+            eval_workers = 0
+        
+        if eval_workers:
+            processed_count = _process_messages_pooled(context, scheduler, eval_workers, eval_chunk_size)
+        else:
+            processed_count = _process_messages(context, scheduler)
+        listed_all = scheduler.complete and not context.errors
+    except StopProcessing:
+        stopped = True
+        processed_count = sum(progress['processed'] for progress in scheduler.progress.values())
+        if controller.stop_requested is not None:
+            stop_latency = time.monotonic() - controller.stop_requested
+        log_func(f"Stopped {stop_latency * 1000:.0f} ms after the request; "
+                 f"sending the {context.batcher.queued if context.batcher else 0} label changes already decided")
+    finally:
+        if context is not None and context.batcher is not None:
+            # Send the changes decided so far, even when the run was stopped;
+            # a fresh token keeps the stop from abandoning them
+            context.batcher.flush(CancellationToken())
+        tuner.stop()
+        profiler.stop(stats)
+        stats.save()
+        if index is not None:
+            index.flush()
+        if export is not None:
+            # A snapshot missing messages would skew the analytics, so only a complete one replaces the last
+            export.finish(listed_all)
+        if journal is not None:
+            journal.flush()
+    
+    if ledger is not None and not dry_run:
+        if stopped or user_query or context.errors or not scheduler.complete:
+            log_func("Not every message was evaluated, so the next run will cover this mail again")
+        else:
+            ledger.record(declared_rules, started)
     
-    # Process messages
-    processed_count = 0
-    rules_applied = {rule.name: 0 for rule in rules}
+    # Log final statistics
+    rules_applied = context.rules_applied
+    status = 'stopped' if stopped else 'complete'
+    log_func("Rule application stopped." if stopped else "Rule application complete!")
+    log_func(f"Total messages processed: {processed_count}")
+    if context.batcher is not None:
+        log_func(f"Label changes sent in {context.batcher.requests} batchModify requests")
+    tuning = tuner.report()
+    if tuning:
+        log_func(f"Tuning made {len(tuning['decisions'])} changes; final settings: "
+                 + ", ".join(f"{name} {value:g}" for name, value in tuning['settings'].items()))
+    for rule_name, count in rules_applied.items():
+        log_func(f"Rule '{rule_name}' was applied {count} times")
+    controller.update_progress(state=status, processed=processed_count, total=scheduler.listed,
+                               rules_applied=dict(rules_applied), classes=scheduler.snapshot())
+    
+    return {
+        'status': status,
+        # Seconds between the stop request and the run acting on it
+        'stop_latency': stop_latency if stopped else None,
+        'processed': processed_count,
+        'total': scheduler.listed,
+        'rules_applied': rules_applied,
+        'classes': scheduler.snapshot(),
+        'run_id': context.run_id,
+        'tuning': tuning,
+        'optimizer': optimizer,
+        # Labels whose message counts the run's label changes may have altered
+        'changed_labels': sorted({label_id for add, remove in context.deltas.values() for label_id in add + remove})
+    }
+
+def export_mailbox(service, export: MetadataExport, log_func=None,
+                   controller: Optional[RunController] = None) -> Dict[str, Any]:
+    """List every message and write its metadata to `export` without applying rules.
+
+    Returns the run summary; `export` only replaces its file when every
+    message was listed and fetched.
+    """
+    return apply_rules(service, [], log_func=log_func, controller=controller, max_messages=sys.maxsize,
+                       dry_run=True, prioritize=False, tuner=AdaptiveTuner(), optimize=False, export=export)
+
+def message_format(rules: List[GmailRule]) -> Dict[str, Any]:
+    """Return the messages.get arguments that cover what the rules read.
+
+    Rules built from definitions only need metadata (headers, labelIds,
+    internalDate, sizeEstimate); any other rule gets the full message.
+    """
+    if any(rule.headers is None for rule in rules):
+        return {'format': 'full'}
+    headers = sorted({header for rule in rules for header in rule.headers})
+    return {'format': 'metadata', 'metadataHeaders': headers, 'fields': message_fields(rules)}
+
+def message_fields(rules: List[GmailRule], index=None) -> Optional[str]:
+    """Return the messages.get mask for what the rules (and `index`, or an export) read, or None for everything."""
+    if any(rule.headers is None for rule in rules):
+        return None
+    fields = ['id', 'labelIds', 'internalDate', 'sizeEstimate', 'payload(mimeType,headers)']
+    if index is not None:
+        fields.append('threadId')
+    return ','.join(fields)
+
+def default_eval_workers(rules: List[GmailRule]) -> int:
+    """Suggest a worker count for rule evaluation.
+
+    Small header-only rulesets are cheaper to evaluate in-process than to
+    ship to workers; large ones, or ones with regex or body conditions, use
+    every core but one.
+    """
+    heavy = len(rules) >= POOL_RULE_THRESHOLD or any(
+        rule.needs_body or any(c['operator'] == 'matches regex' for c in definition_conditions(rule.definition))
+        for rule in rules if rule.definition
+    )
+    if not heavy:
+        return 0
+    return max(1, (os.cpu_count() or 2) - 1)
+
+class RunContext:
+    """State shared by the stages of one apply_rules run."""
+
+    def __init__(self, service, rules: List[GmailRule], log_func, controller: RunController,
+                 stats: RuleStats, body_max_bytes: int, index=None, profiler=None, dry_run: bool = False,
+                 export=None):
+        self.service = service
+        self.rules = rules
+        self.log_func = log_func
+        self.controller = controller
+        self.evaluator = RuleEvaluator(rules, stats)
+        self.rules_applied = {rule.name: 0 for rule in rules}
+        self.fetch_args = message_format(rules)
+        self.body_max_bytes = body_max_bytes if any(rule.needs_body for rule in rules) else None
+        self.index = index
+        self.export = export
+        self.profiler = profiler or NullProfiler()
+        self.dry_run = dry_run
+        self.journal = None
+        self.run_id = None
+        # Rule ID -> internalDate (ms) up to which the rule has already been evaluated
+        self.coverage: Dict[str, int] = {}
+        self.errors = 0
+        self.batcher: Optional[LabelChangeBatcher] = None
+        self.tuner = FixedTuning()
+        self.deltas: Dict[str, Tuple[List[str], List[str]]] = {}
+        self._evaluators: Dict[Tuple[str, ...], Tuple[RuleEvaluator, Set[str]]] = {}
+        for sink in (index, export):
+            if sink is not None and 'metadataHeaders' in self.fetch_args:
+                # Fetch the indexed and exported headers too so previews and analytics can read them
+                self.fetch_args['metadataHeaders'] = sorted(set(self.fetch_args['metadataHeaders']) | set(sink.headers))
+                self.fetch_args['fields'] = message_fields(rules, sink)
+        # Load labels once so rules and actions resolve names locally
+        self.labels = label_table(service)
+        with self.profiler.stage('labels'):
+            self.labels.refresh(controller)
+
+    def delta(self, rule: GmailRule) -> Tuple[List[str], List[str]]:
+        """Return a rule's label change, resolving (and creating) its label once per run."""
+        if rule.id not in self.deltas:
+            self.deltas[rule.id] = rule.delta(self.service, self.controller)
+        return self.deltas[rule.id]
+
+    def changes_sent(self, message_ids: List[str], added: List[str], removed: List[str]) -> None:
+        if self.journal is not None:
+            for message_id in message_ids:
+                self.journal.record(self.run_id, message_id, added, removed)
+
+    def changes_failed(self, message_ids: List[str], error: Exception) -> None:
+        self.errors += len(message_ids)
+
+    def pending_rules(self, message: Dict[str, Any]) -> List[GmailRule]:
+        """Return the rules, in declared order, not yet evaluated against a message."""
+        if not self.coverage:
+            return self.evaluator.rules
+        received = int(message.get('internalDate') or time.time() * 1000)
+        return [rule for rule in self.evaluator.rules if self.coverage.get(rule.id, 0) < received]
+
+    def evaluate(self, message: Dict[str, Any]) -> List[GmailRule]:
+        """Return the pending rules whose actions apply to a message."""
+        pending = self.pending_rules(message)
+        if len(pending) == len(self.evaluator.rules):
+            return self.evaluator.evaluate(message)
+        if not pending:
+            return []
+        key = tuple(rule.id for rule in pending)
+        if key not in self._evaluators:
+            # Stop rules declared before a pending rule can still suppress it
+            pending_ids = set(key)
+            last = self.evaluator.rules.index(pending[-1])
+            subset = [rule for index, rule in enumerate(self.evaluator.rules)
+                      if rule.id in pending_ids or (rule.stop_processing and index < last)]
+            self._evaluators[key] = (RuleEvaluator(subset, self.evaluator.stats), pending_ids)
+        evaluator, pending_ids = self._evaluators[key]
+        return [rule for rule in evaluator.evaluate(message) if rule.id in pending_ids]
+
+def _body_fetcher(service, message_id: str, controller: RunController) -> Callable[[], Dict[str, Any]]:
+    """Return a function that fetches a message's full payload when first called."""
+    def fetch():
+        request = service.users().messages().get(userId='me', id=message_id, format='full', fields=BODY_FIELDS)
+        return execute_request(request, 'messages.get', controller)
+    return fetch
+
+def _report_progress(context: RunContext, processed_count: int, scheduler: MessageScheduler) -> None:
+    if processed_count % 100 == 0:
+        context.log_func(f"Processed {processed_count}/{scheduler.listed} messages listed so far...")
+        for rule_name, count in context.rules_applied.items():
+            context.log_func(f"Rule '{rule_name}' applied {count} times")
+        context.controller.update_progress(processed=processed_count, total=scheduler.listed,
+                                           rules_applied=dict(context.rules_applied), classes=scheduler.snapshot())
+        context.controller.check_pause(context.log_func)  # Check for pause after each batch
+    if processed_count % 1000 == 0:
+        if context.index is not None:
+            context.index.flush()
+        # Bound how long a change waits for its group to fill up
+        if context.batcher is not None:
+            context.batcher.flush()
+
+def _fetch_message(context: RunContext, message_id: str) -> Dict[str, Any]:
+    """Get the message with the parts the rules read."""
+    with context.profiler.stage('fetch'):
+        request = context.service.users().messages().get(
+            userId='me',
+            id=message_id,
+            **context.fetch_args
+        )
+        full_message = execute_request(request, 'messages.get', context.controller, context.tuner)
+    return _prepare_message(context, full_message)
+
+def _fetch_batch(context: RunContext, message_ids: List[str]) -> Dict[str, Any]:
+    """Get several messages in one HTTP batch.
+
+    Returns each message, or the error fetching it, by ID. Calls that were
+    throttled or failed on the server are made again after a backoff.
+    """
+    results: Dict[str, Any] = {}
+
+    def fetched(request_id, response, exception):
+        results[request_id] = exception if exception is not None else response
+
+    token = context.controller.token
+    remaining = message_ids
+    for attempt in range(MAX_RETRIES + 1):
+        token.raise_if_cancelled()
+        batch = context.service.new_batch_http_request(callback=fetched)
+        for message_id in remaining:
+            context.controller.consume('messages.get', token)
+            batch.add(context.service.users().messages().get(userId='me', id=message_id, **context.fetch_args),
+                      request_id=message_id)
+        started = time.monotonic()
+        with context.profiler.stage('fetch'):
+            try:
+                batch.execute()
+            except Exception as e:
+                results.update((message_id, e) for message_id in remaining)
+        retry = [message_id for message_id in remaining
+                 if isinstance(results.get(message_id), Exception) and is_transient(results[message_id])]
+        context.tuner.observe('messages.get', time.monotonic() - started, len(remaining),
+                              results[retry[0]] if retry else None)
+        if not retry or attempt == MAX_RETRIES:
+            break
+        remaining = retry
+        logger.warning(f"{len(retry)} messages.get calls throttled; retrying in {RETRY_BACKOFF * 2 ** attempt:g}s")
+        token.sleep(RETRY_BACKOFF * 2 ** attempt)
+    return {message_id: result if isinstance(result, Exception) else _prepare_message(context, result)
+            for message_id, result in results.items()}
+
+def _fetched_messages(context: RunContext, scheduler: MessageScheduler):
+    """Yield (class name, message stub, message or the error fetching it) for each listed message.
+
+    Messages are fetched in HTTP batches of the tuner's fetch batch size,
+    or one at a time when that is 1.
+    """
+    group = []
+    for class_name, msg in scheduler:
+        group.append((class_name, msg))
+        if len(group) >= context.tuner.fetch_batch_size:
+            yield from _fetch_group(context, group)
+            group = []
+    yield from _fetch_group(context, group)
+
+def _fetch_group(context: RunContext, group: List[Tuple[str, Dict[str, Any]]]):
+    if not group:
+        return
+    if len(group) == 1:
+        message_id = group[0][1]['id']
+        try:
+            fetched = {message_id: _fetch_message(context, message_id)}
+        except StopProcessing:
+            raise
+        except Exception as e:
+            fetched = {message_id: e}
+    else:
+        fetched = _fetch_batch(context, [msg['id'] for _, msg in group])
+    for class_name, msg in group:
+        yield class_name, msg, fetched.get(msg['id'], RuntimeError("no response in the batch"))
+
+def _prepare_message(context: RunContext, full_message: Dict[str, Any]) -> Dict[str, Any]:
+    message_id = full_message['id']
+    # Label conditions compare names, but messages only carry IDs
+    full_message['labelNames'] = [context.labels.name_for(label_id) for label_id in full_message.get('labelIds', [])]
+    if context.index is not None:
+        context.index.add(full_message)
+    if context.body_max_bytes:
+        full_message['bodyReader'] = BodyReader(
+            _body_fetcher(context.service, message_id, context.controller), context.body_max_bytes)
     
-    for msg in all_messages:
-        check_pause(log_func)  # Check for pause
+    logger.debug(f"Processing message {message_id}")
+    logger.debug(f"Message headers: {json.dumps(full_message.get('payload', {}).get('headers', []), indent=2)}")
+    return full_message
+
+def _run_actions(context: RunContext, message: Dict[str, Any], matched: List[GmailRule]) -> None:
+    """Apply each matching rule to a message.
+
+    Label changes are applied to the message locally, so later rules see
+    them, and the net change is queued with the run's batcher. Nothing is
+    applied once the run is stopped, since a body fetch the stop abandoned
+    reads as a failed condition.
+    """
+    context.controller.token.raise_if_cancelled()
+    net_added, net_removed = [], []
+    for rule in matched:
+        if context.dry_run:
+            context.rules_applied[rule.name] += 1
+            context.log_func(f"Would apply rule '{rule.name}' to message {message['id']}")
+            continue
+        if rule.delta is None:
+            # The rule's own action modifies the message right away
+            context.controller.consume('messages.modify')
+            with context.profiler.stage('modify', rule.name):
+                changes = rule.action(message, context.service)
+            if context.journal is not None and changes:
+                context.journal.record(context.run_id, message['id'], *changes)
+        else:
+            with context.profiler.stage('modify', rule.name):
+                added, removed = effective_delta(message.setdefault('labelIds', []), *context.delta(rule))
+            update_labels(message, added, removed)
+            # A label one rule adds and a later one removes cancels out
+            for label_id in added:
+                if label_id in net_removed:
+                    net_removed.remove(label_id)
+                else:
+                    net_added.append(label_id)
+            for label_id in removed:
+                if label_id in net_added:
+                    net_added.remove(label_id)
+                else:
+                    net_removed.append(label_id)
+        context.rules_applied[rule.name] += 1
+        context.log_func(f"Applied rule '{rule.name}' to message {message['id']}")
+    if context.batcher is not None:
+        context.batcher.add(message['id'], net_added, net_removed)
+    if context.export is not None:
+        # Exported after the actions, so analytics see the labels the run leaves
+        context.export.add(message)
+
+def _process_messages(context: RunContext, scheduler: MessageScheduler) -> int:
+    """Fetch each message, evaluate the rules and run the matching actions."""
+    processed_count = 0
+    for class_name, msg, full_message in _fetched_messages(context, scheduler):
+        context.controller.check_pause(context.log_func)  # Check for pause
         processed_count += 1
-        
-        if processed_count % 100 == 0:
-            log_func(f"Processed {processed_count}/{total_count} messages...")
-            for rule_name, count in rules_applied.items():
-                log_func(f"Rule '{rule_name}' applied {count} times")
-            check_pause(log_func)  # Check for pause after each batch
+        scheduler.mark_processed(class_name)
+        _report_progress(context, processed_count, scheduler)
             
         try:
-            # Get full message with headers
-            full_message = service.users().messages().get(
+            if isinstance(full_message, Exception):
+                raise full_message
+            with context.profiler.stage('evaluate'):
+                matched = context.evaluate(full_message)
+            _run_actions(context, full_message, matched)
+        except StopProcessing:
+            raise
+        except Exception as e:
+            context.errors += 1
+            context.log_func(f"Error processing message {msg['id']}: {str(e)}")
+            continue
+    
+    return processed_count
+
+def compact_record(message: Dict[str, Any]) -> Dict[str, Any]:
+    """Strip a fetched message down to the fields conditions read."""
+    payload = message.get('payload', {})
+    return {
+        'id': message['id'],
+        'labelIds': message.get('labelIds', []),
+        'labelNames': message.get('labelNames', []),
+        'internalDate': message.get('internalDate'),
+        'sizeEstimate': message.get('sizeEstimate', 0),
+        'payload': {'mimeType': payload.get('mimeType', ''), 'headers': payload.get('headers', [])},
+    }
+
+# Evaluator compiled once per worker process by _init_eval_worker
+_worker_evaluator: Optional[RuleEvaluator] = None
+
+def _init_eval_worker(definitions: List[Dict[str, Any]], counters: Dict[str, Dict[str, int]]) -> None:
+    global _worker_evaluator
+    stats = RuleStats(stats_file=None)
+    stats.counters = counters
+    _worker_evaluator = RuleEvaluator(build_rules(definitions), stats)
+
+def _evaluate_chunk(records: List[Dict[str, Any]]):
+    """Match a chunk of records in a worker process.
+
+    Returns the matched rule IDs per message, with None for messages whose
+    outcome depends on a body condition, plus the statistics gathered.
+    """
+    stats = _worker_evaluator.stats
+    before = {rule_id: dict(counter) for rule_id, counter in stats.counters.items()}
+    results = []
+    for record in records:
+        try:
+            results.append((record['id'], [rule.id for rule in _worker_evaluator.evaluate(record)]))
+        except BodyRequired:
+            results.append((record['id'], None))
+    delta = {}
+    for rule_id, counter in stats.counters.items():
+        previous = before.get(rule_id, {})
+        delta[rule_id] = {key: value - previous.get(key, 0) for key, value in counter.items()}
+    return results, delta
+
+def _process_messages_pooled(context: RunContext, scheduler: MessageScheduler, eval_workers: int,
+                             chunk_size: int = EVAL_CHUNK_SIZE) -> int:
+    """Fetch messages here while worker processes evaluate them in chunks."""
+    evaluator = context.evaluator
+    rules_by_id = {rule.id: rule for rule in evaluator.rules}
+    definitions = [rule.definition for rule in evaluator.rules]
+    pending = collections.deque()
+
+    def finish(future, chunk):
+        with context.profiler.stage('evaluate'):
+            results, delta = future.result()
+        evaluator.stats.merge(delta)
+        for message_id, rule_ids in results:
+            message = chunk[message_id]
+            try:
+                if rule_ids is None:
+                    # A body condition decides this one, so evaluate it here where the body can be fetched
+                    with context.profiler.stage('evaluate'):
+                        matched = context.evaluate(message)
+                else:
+                    # Workers evaluate every rule; only act on those this message has not seen
+                    pending = {rule.id for rule in context.pending_rules(message)}
+                    matched = [rules_by_id[rule_id] for rule_id in rule_ids if rule_id in pending]
+                _run_actions(context, message, matched)
+            except StopProcessing:
+                raise
+            except Exception as e:
+                context.errors += 1
+                context.log_func(f"Error processing message {message_id}: {str(e)}")
+
+    processed_count = 0
+    context.log_func(f"Evaluating rules in {eval_workers} worker processes")
+    with ProcessPoolExecutor(max_workers=eval_workers, initializer=_init_eval_worker,
+                             initargs=(definitions, evaluator.stats.counters)) as pool:
+        try:
+            chunk = {}
+            for class_name, msg, full_message in _fetched_messages(context, scheduler):
+                context.controller.check_pause(context.log_func)  # Check for pause
+                processed_count += 1
+                scheduler.mark_processed(class_name)
+                _report_progress(context, processed_count, scheduler)
+                
+                if isinstance(full_message, Exception):
+                    context.errors += 1
+                    context.log_func(f"Error processing message {msg['id']}: {str(full_message)}")
+                    continue
+                chunk[full_message['id']] = full_message
+                
+                if len(chunk) >= chunk_size:
+                    pending.append((pool.submit(_evaluate_chunk, [compact_record(m) for m in chunk.values()]), chunk))
+                    chunk = {}
+                    # Keep a bounded number of chunks in flight
+                    while len(pending) > 2 * eval_workers or (pending and pending[0][0].done()):
+                        finish(*pending.popleft())
+            if chunk:
+                pending.append((pool.submit(_evaluate_chunk, [compact_record(m) for m in chunk.values()]), chunk))
+            while pending:
+                finish(*pending.popleft())
+        except StopProcessing:
+            # Nothing will act on the chunks still queued, so leaving the pool need not wait for them
+            for future, _ in pending:
+                future.cancel()
+            raise
+    
+    return processed_count
+
+# Rule actions. Label actions take a label name (or a CATEGORY_ label) as
+# their value; the others always make the same label change.
+LABEL_ACTIONS = ['Label as', 'Move to']
+FIXED_ACTIONS = {
+    'Archive': ([], ['INBOX']),
+    'Mark read': ([], ['UNREAD']),
+    'Star': (['STARRED'], []),
+    'Mark important': (['IMPORTANT'], []),
+    # Trashed messages are deleted by Gmail after 30 days; deleting them
+    # outright needs the full mail scope, which this app does not ask for
+    'Trash': (['TRASH'], []),
+}
+ACTION_TYPES = LABEL_ACTIONS + list(FIXED_ACTIONS)
+
+def describe_action(rule: Dict[str, Any]) -> str:
+    if rule['action_type'] in FIXED_ACTIONS:
+        return rule['action_type']
+    return f"{rule['action_type']} '{rule.get('action_value', '')}'"
+
+def action_delta(rule: Dict[str, Any], service, controller: Optional[RunController] = None,
+                 create_labels: bool = True) -> Tuple[List[str], List[str]]:
+    """Return the label IDs a rule's action adds and removes.
+
+    Label names are resolved through the label table and created if missing,
+    unless `create_labels` is False, in which case a missing label's name is
+    returned as is.
+    """
+    action_type = rule['action_type']
+    if action_type in FIXED_ACTIONS:
+        add, remove = FIXED_ACTIONS[action_type]
+        return list(add), list(remove)
+    value = rule.get('action_value', '')
+    if value.startswith('CATEGORY_'):
+        label_id = value
+    elif create_labels:
+        label_id = get_or_create_label(service, value, controller)
+    else:
+        table = label_table(service)
+        table.ensure_loaded(controller)
+        label_id = table.id_for(value) or value
+    return [label_id], ['INBOX'] if action_type == 'Move to' else []
+
+def effective_delta(label_ids: List[str], add: List[str], remove: List[str]) -> Tuple[List[str], List[str]]:
+    """Return the part of a label change that would alter a message with `label_ids`."""
+    return ([label_id for label_id in add if label_id not in label_ids],
+            [label_id for label_id in remove if label_id in label_ids])
+
+def update_labels(msg: Dict[str, Any], added: List[str], removed: List[str]) -> None:
+    current_labels = msg.setdefault('labelIds', [])
+    for label_id in removed:
+        current_labels.remove(label_id)
+    current_labels.extend(added)
+
+def create_action(rule: Dict[str, Any]) -> Callable[[Dict[str, Any], Any], Tuple[List[str], List[str]]]:
+    """Create the action function for a rule definition.
+
+    The action changes one message with a single messages.modify call,
+    returns the label IDs it actually added to and removed from the message,
+    and updates the message's labelIds to match. Runs use the rule's delta
+    instead, which groups changes across messages.
+    """
+    def action(msg, service):
+        added, removed = effective_delta(msg.get('labelIds', []), *action_delta(rule, service))
+        if not added and not removed:
+            return [], []
+        try:
+            service.users().messages().modify(
                 userId='me',
                 id=msg['id'],
-                format='full'
+                body={'addLabelIds': added, 'removeLabelIds': removed},
+                fields=FIELDS['messages.modify']
             ).execute()
-            
-            logger.debug(f"Processing message {msg['id']}")
-            logger.debug(f"Message headers: {json.dumps(full_message.get('payload', {}).get('headers', []), indent=2)}")
-            
-            # Apply each rule
-            for rule in rules:
-                if rule.condition(full_message):
-                    rule.action(full_message, service)
-                    rules_applied[rule.name] += 1
-                    log_func(f"Applied rule '{rule.name}' to message {msg['id']}")
-                    
         except Exception as e:
-            log_func(f"Error processing message {msg['id']}: {str(e)}")
+            logger.error(f"Error applying action to message {msg['id']}: {e}")
+            return [], []
+        logger.info(f"{describe_action(rule)}: message {msg['id']}")
+        update_labels(msg, added, removed)
+        return added, removed
+    return action
+
+def build_rule(rule_data: Dict[str, Any], now: Optional[datetime.datetime] = None) -> GmailRule:
+    """Build a GmailRule from its rules.json definition, with Age conditions measured from `now`."""
+    if rule_data.get('any_of'):
+        return build_merged_rule(rule_data, now)
+    return GmailRule(
+        name=f"{describe_conditions(rule_data)} → {describe_action(rule_data)}",
+        condition=create_condition(rule_data, now),
+        action=create_action(rule_data),
+        rule_id=rule_id(rule_data),
+        priority=int(rule_data.get('priority', 0)),
+        stop_processing=bool(rule_data.get('stop_processing', False)),
+        headers=condition_headers(rule_data),
+        query=rule_query(rule_data, now),
+        needs_body=needs_body(rule_data),
+        definition=rule_data,
+        server_filter=bool(rule_data.get('server_filter', False)),
+        delta=lambda service, controller=None: action_delta(rule_data, service, controller)
+    )
+
+def build_rules(rules_data: List[Dict[str, Any]]) -> List[GmailRule]:
+    """Build GmailRules from a list of rule definitions."""
+    return [build_rule(rule_data) for rule_data in rules_data]
+
+def build_merged_rule(rule_data: Dict[str, Any], now: Optional[datetime.datetime] = None) -> GmailRule:
+    """Build the GmailRule for an optimizer-merged definition, which matches when any of its `any_of` rules does."""
+    members = rule_data['any_of']
+    headers = sorted({header for member in members for header in condition_headers(member)})
+    return GmailRule(
+        name=f"Any of {len(members)} rules → {describe_action(rule_data)}",
+        condition=create_any_condition(members, now),
+        action=create_action(rule_data),
+        rule_id=rule_data['id'],
+        priority=int(rule_data.get('priority', 0)),
+        headers=headers,
+        query=combine_queries([rule_query(member, now) for member in members]),
+        needs_body=any(needs_body(member) for member in members),
+        definition=rule_data,
+        delta=lambda service, controller=None: action_delta(rule_data, service, controller)
+    )
+
+def rebuilt_for_run(rule: GmailRule, now: datetime.datetime) -> GmailRule:
+    """Return the rule with its Age conditions and their query terms measured from `now`.
+
+    Rules are often built once and kept for a session (see CompiledRules),
+    which would otherwise leave their Age thresholds where they were then.
+    """
+    if not rule.definition or not any(condition['field'] == 'Age'
+                                      for condition in definition_conditions(rule.definition)):
+        return rule
+    return build_rule(rule.definition, now)
+
+def definition_conditions(rule_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return every condition a definition checks, including those of merged rules."""
+    if rule_data.get('any_of'):
+        return [condition for member in rule_data['any_of'] for condition in rule_conditions(member)]
+    return rule_conditions(rule_data)
+
+def _action_key(rule_data: Dict[str, Any]) -> Tuple[str, str]:
+    if rule_data['action_type'] in FIXED_ACTIONS:
+        return rule_data['action_type'], ''
+    return rule_data['action_type'], rule_data['action_value']
+
+def _action_labels(rule_data: Dict[str, Any]) -> Tuple[Set[str], Set[str]]:
+    """Return the labels (upper-cased names, or IDs of system labels) an action adds and removes."""
+    if rule_data['action_type'] in FIXED_ACTIONS:
+        add, remove = FIXED_ACTIONS[rule_data['action_type']]
+        return set(add), set(remove)
+    return {rule_data['action_value'].upper()}, {'INBOX'} if rule_data['action_type'] == 'Move to' else set()
+
+def _condition_key(rule_data: Dict[str, Any]) -> str:
+    conditions = []
+    for condition in rule_conditions(rule_data):
+        value = condition['value']
+        if not (condition['field'] == 'Body' and condition['operator'] == 'matches regex'):
+            value = str(value).lower()
+        conditions.append((condition['field'], condition['operator'], value))
+    return json.dumps(sorted(conditions))
+
+def analyze_rules(rules_data: List[Dict[str, Any]],
+                  coverage: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """Find rules that cannot change any run's outcome and rules that can share one matcher.
+
+    Works on rule definitions in declared order and returns lists of rule
+    IDs: `never_match` (id, reason) for rules whose conditions contradict each
+    other, `shadowed` (id, stop rule id) for rules that only match where an
+    earlier stop rule already matched, `duplicates` and `subsumed` (id, kept
+    id) for rules whose matches a kept rule with the same action already
+    covers, and `merged`, the groups of rules with the same action that can
+    be evaluated as one. Rules are only dropped or merged where the result
+    cannot differ: no stop rule sits between them, they have the same
+    `coverage` (see EvaluationLedger), and no rule removes a label they add.
+    """
+    coverage = coverage or {}
+    ordered = sorted(rules_data, key=lambda rule: -int(rule.get('priority', 0)))
+    report = {'rules': len(ordered), 'never_match': [], 'shadowed': [], 'duplicates': [], 'subsumed': [],
+              'merged': [], 'evaluated': len(ordered)}
+    dropped = set()
+    stop_rules = []
+    groups: Dict[Tuple, List[Dict[str, Any]]] = {}
+    all_added, all_removed = set(), set()
+    for rule in ordered:
+        add, remove = _action_labels(rule)
+        all_added |= add
+        all_removed |= remove
+
+    for rule in ordered:
+        identifier = rule_id(rule)
+        conditions = rule_conditions(rule)
+        reason = conditions_contradiction(conditions)
+        if reason:
+            report['never_match'].append((identifier, reason))
+            dropped.add(identifier)
             continue
-    
-    # Log final statistics
-    log_func("Rule application complete!")
-    log_func(f"Total messages processed: {processed_count}")
-    for rule_name, count in rules_applied.items():
-        log_func(f"Rule '{rule_name}' was applied {count} times")
+        shadow = next((stop for stop in stop_rules[:SUBSUMPTION_LIMIT]
+                       if conditions_implied(conditions, rule_conditions(stop))), None)
+        if shadow is not None:
+            report['shadowed'].append((identifier, rule_id(shadow)))
+            dropped.add(identifier)
+            continue
+        if rule.get('stop_processing'):
+            stop_rules.append(rule)
+            continue
+        add, remove = _action_labels(rule)
+        if add & all_removed or remove & all_added:
+            # Another rule undoes this one's change, so where it runs matters
+            continue
+        key = (len(stop_rules), _action_key(rule), coverage.get(identifier, 0))
+        groups.setdefault(key, []).append(rule)
+
+    for group in groups.values():
+        kept = {}
+        for rule in group:
+            identifier = rule_id(rule)
+            key = _condition_key(rule)
+            if key in kept:
+                report['duplicates'].append((identifier, rule_id(kept[key])))
+                dropped.add(identifier)
+            else:
+                kept[key] = rule
+        members = list(kept.values())
+        if len(members) <= SUBSUMPTION_LIMIT:
+            conditions = [rule_conditions(rule) for rule in members]
+            for index, rule in enumerate(members):
+                by = next((other for other_index, other in enumerate(members) if other_index != index
+                           and rule_id(other) not in dropped and conditions_implied(conditions[index], conditions[other_index])),
+                          None)
+                if by is not None:
+                    report['subsumed'].append((rule_id(rule), rule_id(by)))
+                    dropped.add(rule_id(rule))
+        members = [rule_id(rule) for rule in members if rule_id(rule) not in dropped]
+        if len(members) > 1:
+            report['merged'].append(members)
+
+    report['evaluated'] = (len(ordered) - len(dropped)
+                           - sum(len(members) - 1 for members in report['merged']))
+    return report
+
+def describe_analysis(report: Dict[str, Any]) -> str:
+    """Return a one-line summary of an analyze_rules report."""
+    parts = [f"{len(report[key])} {label}" for key, label in
+             (('duplicates', 'duplicate'), ('subsumed', 'subsumed'), ('never_match', 'never matching'),
+              ('shadowed', 'shadowed by a stop rule')) if report[key]]
+    merged = report['merged']
+    if merged:
+        parts.append(f"{sum(len(members) for members in merged)} merged into {len(merged)} matchers")
+    if not parts:
+        return f"{report['rules']} rules, nothing to optimize"
+    return f"{report['rules']} rules evaluated as {report['evaluated']}: " + ", ".join(parts)
+
+def optimize_rules(rules: List[GmailRule], coverage: Optional[Dict[str, int]] = None,
+                   now: Optional[datetime.datetime] = None
+                   ) -> Tuple[List[GmailRule], Dict[str, int], Dict[str, Any]]:
+    """Return the rules a run evaluates in place of `rules`, their coverage and the analyze_rules report.
+
+    Dropped rules are left out and each merged group becomes one rule at the
+    position of its first member, so a run gives the same label changes.
+    Rulesets with rules that have no definition, or that share an ID, are
+    returned unchanged with no report. Merged rules measure Age conditions
+    from `now`.
+    """
+    coverage = dict(coverage or {})
+    if not all(rule.definition for rule in rules) or len({rule.id for rule in rules}) < len(rules):
+        return rules, coverage, None
+    report = analyze_rules([rule.definition for rule in rules], coverage)
+    by_id = {rule.id: rule for rule in rules}
+    dropped = {identifier for key in ('never_match', 'shadowed', 'duplicates', 'subsumed')
+               for identifier, _ in report[key]}
+    merged_into = {}
+    for members in report['merged']:
+        first = by_id[members[0]].definition
+        definition = {
+            'id': 'merged-' + hashlib.sha1('|'.join(members).encode('utf-8')).hexdigest()[:12],
+            'any_of': [by_id[identifier].definition for identifier in members],
+            'action_type': first['action_type'],
+            # Rules with a fixed action may be stored without a value
+            'action_value': first.get('action_value', ''),
+            'priority': first.get('priority', 0),
+        }
+        merged = build_rule(definition, now)
+        merged_into[members[0]] = merged
+        dropped.update(members)
+        if members[0] in coverage:
+            coverage[merged.id] = coverage[members[0]]
 
-def load_rules_from_json() -> List[GmailRule]:
-    """Load rules from rules.json file."""
+    optimized = []
+    for rule in sorted(rules, key=lambda rule: -rule.priority):
+        if rule.id in merged_into:
+            optimized.append(merged_into[rule.id])
+        elif rule.id not in dropped:
+            optimized.append(rule)
+    return optimized, coverage, report
+
+def load_rules_from_json(rules_file: str = 'rules.json') -> List[GmailRule]:
+    """Load rules from a rules JSON file."""
     try:
-        with open('rules.json', 'r') as f:
+        with open(rules_file, 'r') as f:
             rules_data = json.load(f)
         
-        rules = []
-        for rule_data in rules_data:
-            # Create condition function based on rule data
-            def create_condition(rule):
-                def condition(msg):
-                    try:
-                        # Get message metadata
-                        headers = []
-                        if 'payload' in msg:
-                            headers = msg['payload'].get('headers', [])
-                        elif 'headers' in msg:
-                            headers = msg['headers']
-                            
-                        # Get the header value based on the condition field
-                        header_value = next((h['value'] for h in headers if h['name'].lower() == rule['condition_field'].lower()), '')
-                        logger.debug(f"Message {msg.get('id', 'unknown')} - Found {rule['condition_field']}: {header_value}")
-                        
-                        if rule['condition_operator'] == 'contains':
-                            result = rule['condition_value'].lower() in header_value.lower()
-                            logger.debug(f"Message {msg.get('id', 'unknown')} - Rule check: '{rule['condition_value']}' in '{header_value}' = {result}")
-                            return result
-                        elif rule['condition_operator'] == 'equals':
-                            result = rule['condition_value'].lower() == header_value.lower()
-                            logger.debug(f"Message {msg.get('id', 'unknown')} - Rule check: '{rule['condition_value']}' equals '{header_value}' = {result}")
-                            return result
-                        elif rule['condition_operator'] == 'starts with':
-                            result = header_value.lower().startswith(rule['condition_value'].lower())
-                            logger.debug(f"Message {msg.get('id', 'unknown')} - Rule check: '{header_value}' starts with '{rule['condition_value']}' = {result}")
-                            return result
-                        elif rule['condition_operator'] == 'ends with':
-                            result = header_value.lower().endswith(rule['condition_value'].lower())
-                            logger.debug(f"Message {msg.get('id', 'unknown')} - Rule check: '{header_value}' ends with '{rule['condition_value']}' = {result}")
-                            return result
-                        return False
-                    except Exception as e:
-                        logger.error(f"Error in condition for message {msg.get('id', 'unknown')}: {e}")
-                        return False
-                return condition
-
-            # Create action function based on rule data
-            def create_action(rule):
-                def action(msg, service):
-                    try:
-                        if rule['action_type'] == 'Label as':
-                            # For labeling, we add the label
-                            label_id = get_or_create_label(service, rule['action_value'])
-                            result = service.users().messages().modify(
-                                userId='me',
-                                id=msg['id'],
-                                body={'addLabelIds': [label_id]}
-                            ).execute()
-                            logger.info(f"Added label '{rule['action_value']}' to message {msg['id']}")
-                            logger.debug(f"Label result: {result}")
-                            
-                        elif rule['action_type'] == 'Move to':
-                            # For moving to categories, we need to handle both Gmail's special category labels
-                            # and custom labels
-                            category_label = rule['action_value']
-                            
-                            # First remove from INBOX if it's there
-                            current_labels = msg.get('labelIds', [])
-                            if 'INBOX' in current_labels:
-                                result = service.users().messages().modify(
-                                    userId='me',
-                                    id=msg['id'],
-                                    body={'removeLabelIds': ['INBOX']}
-                                ).execute()
-                                logger.debug(f"Remove INBOX result: {result}")
-                            
-                            # Then add the new label
-                            if category_label.startswith('CATEGORY_'):
-                                # For Gmail's built-in categories
-                                result = service.users().messages().modify(
-                                    userId='me',
-                                    id=msg['id'],
-                                    body={'addLabelIds': [category_label]}
-                                ).execute()
-                                logger.info(f"Moved message {msg['id']} to category {category_label}")
-                                logger.debug(f"Add category result: {result}")
-                            else:
-                                # For custom labels
-                                label_id = get_or_create_label(service, category_label)
-                                result = service.users().messages().modify(
-                                    userId='me',
-                                    id=msg['id'],
-                                    body={'addLabelIds': [label_id]}
-                                ).execute()
-                                logger.info(f"Moved message {msg['id']} to label {category_label}")
-                                logger.debug(f"Add label result: {result}")
-                                
-                    except Exception as e:
-                        logger.error(f"Error applying action to message {msg['id']}: {e}")
-                return action
-
-            rule = GmailRule(
-                name=f"{rule_data['condition_field']} {rule_data['condition_operator']} {rule_data['condition_value']}",
-                condition=create_condition(rule_data),
-                action=create_action(rule_data)
-            )
-            rules.append(rule)
-        
-        return rules
+        return build_rules(rules_data)
     except Exception as e:
         logger.error(f"Error loading rules from JSON: {e}")
         return []
 
-def main():
-    """Main function to run the Gmail rules application."""
+class CompiledRules:
+    """GmailRules built from a RuleStore, rebuilt only where rules changed.
+
+    Checking for changes costs one version lookup; when the version moved,
+    only rules edited or deleted since the last build are recompiled.
+    """
+
+    def __init__(self, store: RuleStore):
+        self.store = store
+        self.version = -1
+        self.compiled: Dict[str, GmailRule] = {}
+        self.order: List[str] = []
+
+    def rules(self) -> List[GmailRule]:
+        if self.store.version() != self.version:
+            changed, deleted, self.version = self.store.changes_since(self.version)
+            for deleted_id in deleted:
+                self.compiled.pop(deleted_id, None)
+            for rule_data in changed:
+                self.compiled[rule_data['id']] = build_rule(rule_data)
+            self.order = self.store.ids()
+            if changed or deleted:
+                logger.info(f"Recompiled {len(changed)} rules, dropped {len(deleted)} (rules version {self.version})")
+        return [self.compiled[rule_id] for rule_id in self.order if rule_id in self.compiled]
+
+def load_rules(rules_file: str = RULES_DB_FILE) -> List[GmailRule]:
+    """Load rules from a rule store, or from a JSON file if the path ends in .json."""
+    if rules_file.endswith('.json'):
+        return load_rules_from_json(rules_file)
+    return CompiledRules(RuleStore(rules_file)).rules()
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(
+        prog='gmail-apply-rules',
+        description="Apply the labeling rules to a Gmail mailbox without the GUI."
+    )
+    parser.add_argument('--rules', default=RULES_DB_FILE,
+                        help="rule store to use, or a JSON rules file if it ends in .json (default: %(default)s)")
+    parser.add_argument('--token', default='token.json', help="OAuth token file (default: %(default)s)")
+    parser.add_argument('--credentials', default='credentials.json', help="OAuth client file (default: %(default)s)")
+    parser.add_argument('--account', help="take the token and rules of this account from the accounts file")
+    parser.add_argument('--accounts-file', default='accounts.json', help="accounts file for --account (default: %(default)s)")
+    parser.add_argument('--no-browser', action='store_true',
+                        help="fail instead of opening the browser when the token is missing or expired")
+    parser.add_argument('--query', help="only process messages that also match this Gmail search")
+    parser.add_argument('--max-messages', type=int, default=MAX_MESSAGES, help="stop after this many messages (default: %(default)s)")
+    parser.add_argument('--page-size', type=int, default=LIST_PAGE_SIZE, help="messages per list request, up to 500 (default: %(default)s)")
+    parser.add_argument('--workers', type=int,
+                        help="rule evaluation worker processes; 0 evaluates in this process (default: chosen from the ruleset)")
+    parser.add_argument('--chunk-size', type=int, default=EVAL_CHUNK_SIZE,
+                        help="messages sent to an evaluation worker at a time (default: %(default)s)")
+    parser.add_argument('--rate', type=float, default=DEFAULT_QUOTA_PER_SECOND,
+                        help="quota units per second to stay under; 0 disables pacing (default: %(default)s)")
+    parser.add_argument('--no-adapt', action='store_true',
+                        help="fetch messages one at a time and keep the rate and batch sizes fixed "
+                             "instead of adapting them to API latency and throttling")
+    parser.add_argument('--export', metavar='FILE',
+                        help="write the metadata of every message to this columnar file for gmail-mailbox-stats "
+                             "when the run lists the whole mailbox")
+    parser.add_argument('--export-only', action='store_true',
+                        help="list every message and export its metadata (to --export, default "
+                             f"{METADATA_FILE}) without applying rules")
+    parser.add_argument('--no-optimize', action='store_true',
+                        help="evaluate every rule as declared instead of dropping redundant rules and "
+                             "merging rules that share an action")
+    parser.add_argument('--no-priority', action='store_true',
+                        help="process messages in listing order instead of inbox, unread and recent mail first")
+    parser.add_argument('--dry-run', action='store_true', help="report what would change without modifying messages")
+    parser.add_argument('--json', action='store_true', help="write progress and the summary to stdout as JSON lines")
+    parser.add_argument('--profile', action='store_true', help="write a timing report to the profiles folder")
+    parser.add_argument('--journal', default='journal.db',
+                        help="file recording every label change so runs can be undone (default: %(default)s)")
+    parser.add_argument('--no-journal', action='store_true', help="do not record label changes")
+    parser.add_argument('--full', action='store_true',
+                        help="forget which mail each rule was evaluated against and evaluate every rule over all mail")
+    parser.add_argument('--skip-filtered', action='store_true',
+                        help="leave out rules that Gmail filters already enforce on new mail")
+    parser.add_argument('--sync-filters', action='store_true',
+                        help="create and delete Gmail filters to match the rules they can express, then exit")
+    parser.add_argument('--import-filters', action='store_true',
+                        help="add rules for existing Gmail filters, then exit")
+    parser.add_argument('--record', metavar='CASSETTE',
+                        help="record every Gmail call and its timing to this cassette file")
+    parser.add_argument('--replay', metavar='CASSETTE',
+                        help="answer Gmail calls from a recorded cassette instead of the network")
+    parser.add_argument('--replay-scale', type=float, default=1.0,
+                        help="multiply recorded latencies by this when replaying; 0 answers at once (default: %(default)s)")
+    parser.add_argument('--list-runs', action='store_true', help="list recent runs in the journal and exit")
+    parser.add_argument('--undo', metavar='RUN_ID', help="revert the label changes of a journaled run and exit")
+    args = parser.parse_args(argv)
+    if not 1 <= args.page_size <= LIST_PAGE_SIZE:
+        parser.error(f"--page-size must be between 1 and {LIST_PAGE_SIZE}")
+    if args.max_messages < 1 or args.chunk_size < 1:
+        parser.error("--max-messages and --chunk-size must be positive")
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be combined")
+    return args
+
+def emit_json(event: str, **fields) -> None:
+    """Write one JSON line to stdout for scripts driving the command line."""
+    print(json.dumps({'event': event, 'time': time.time(), **fields}), flush=True)
+
+def main(argv=None) -> int:
+    """Run the Gmail rules from the command line and return the exit status."""
+    args = parse_args(argv)
     try:
-        service = authenticate_gmail()
+        if args.account:
+            # Imported here because gmail_multi_account imports this module
+            from gmail_multi_account import load_accounts
+            account = next((a for a in load_accounts(args.accounts_file) if a['name'] == args.account), None)
+            if account is None:
+                logger.error(f"No account named {args.account} in {args.accounts_file}")
+                return 2
+            args.token = account['token_file']
+            args.rules = account['rules_file']
+            args.credentials = account.get('credentials_file', args.credentials)
+        
+        # Imported here because gmail_journal imports this module
+        import gmail_journal
+        journal = None if args.no_journal else gmail_journal.MutationJournal(args.journal)
+        if args.list_runs:
+            for run in journal.runs() if journal else []:
+                if args.json:
+                    emit_json('run', **run)
+                else:
+                    started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['started']))
+                    print(f"{run['run_id']}  {started}  {run['changes']:>7} changes  "
+                          f"{'undone  ' if run['undone'] else ''}{run['description']}")
+            return 0
+        
+        if args.replay:
+            service = ReplayService(args.replay, args.replay_scale)
+        else:
+            service = authenticate_gmail(token_file=args.token, credentials_file=args.credentials,
+                                         interactive=not args.no_browser)
+            if args.record:
+                # The cassette is closed when the process exits
+                service = RecordingService(service, args.record)
+        
+        progress_callback = (lambda snapshot: emit_json('progress', **snapshot)) if args.json else None
+        controller = RunController(name=args.account or 'default', quota_per_second=args.rate,
+                                   progress_callback=progress_callback)
+        
+        if args.sync_filters or args.import_filters:
+            # Imported here because gmail_filters imports this module
+            import gmail_filters
+            if args.rules.endswith('.json'):
+                logger.error("Filter sync needs a rule store, not a JSON rules file")
+                return 2
+            store = RuleStore(args.rules)
+            if args.import_filters:
+                ids = gmail_filters.import_filters(service, store, controller=controller)
+                result = {'imported': len(ids)}
+            else:
+                result = gmail_filters.sync_filters(service, store, dry_run=args.dry_run, controller=controller)
+            if args.json:
+                emit_json('summary', status='complete', **result)
+            return 0
         
-        # Load rules from JSON file
-        rules = load_rules_from_json()
+        if args.undo:
+            if journal is None:
+                logger.error("--undo needs the journal")
+                return 2
+            restored = gmail_journal.undo_run(service, journal, args.undo, controller=controller)
+            if args.json:
+                emit_json('summary', status='undone', run_id=args.undo, restored=restored)
+            return 0
+        
+        if args.export_only:
+            summary = export_mailbox(service, MetadataExport(args.export or METADATA_FILE), controller=controller)
+            if args.json:
+                emit_json('summary', **summary)
+            return 0 if summary['status'] == 'complete' else 1
+        
+        # Load rules from the rule store
+        rules = load_rules(args.rules)
         if not rules:
-            logger.error("No rules loaded from rules.json")
-            return
-            
-        logger.info(f"Loaded {len(rules)} rules from rules.json")
-        apply_rules(service, rules)
+            logger.error(f"No rules loaded from {args.rules}")
+            return 2
+        logger.info(f"Loaded {len(rules)} rules from {args.rules}")
+        
+        profiler = None
+        if args.profile:
+            profiler = RunProfiler(use_cprofile=True, trace_memory=True)
+        workers = args.workers if args.workers is not None else default_eval_workers(rules)
+        ledger = EvaluationLedger(ledger_file_for(args.rules))
+        if args.full:
+            ledger.reset()
+        
+        previous_handler = None
+        if threading.current_thread() is threading.main_thread():
+            # The first Ctrl+C stops the run cleanly, sending the label changes
+            # already decided; a second one interrupts it outright
+            def interrupt(signum, frame):
+                signal.signal(signal.SIGINT, signal.default_int_handler)
+                controller.set_stop()
+            previous_handler = signal.signal(signal.SIGINT, interrupt)
+        
+        start = time.monotonic()
+        try:
+            summary = apply_rules(service, rules, controller=controller,
+                                  stats=RuleStats(stats_file_for(args.rules)),
+                                  eval_workers=workers, profiler=profiler, query=args.query,
+                                  max_messages=args.max_messages, page_size=args.page_size,
+                                  eval_chunk_size=args.chunk_size, dry_run=args.dry_run,
+                                  prioritize=not args.no_priority, journal=journal,
+                                  skip_server_filters=args.skip_filtered,
+                                  ledger=ledger, tuner=None if args.no_adapt else AdaptiveTuner(),
+                                  optimize=not args.no_optimize,
+                                  export=MetadataExport(args.export) if args.export else None)
+        finally:
+            if previous_handler is not None:
+                signal.signal(signal.SIGINT, previous_handler)
+        if profiler:
+            profiler.write_report()
+        if args.replay:
+            logger.info(f"Replayed {service.calls} calls; {service.misses} had no recorded response")
+        if args.json:
+            emit_json('summary', dry_run=args.dry_run, elapsed=time.monotonic() - start, **summary)
+        return 0 if summary['status'] == 'complete' else 1
         
+    except StopProcessing:
+        if args.json:
+            emit_json('summary', status='stopped')
+        return 1
     except Exception as e:
         logger.error(f"An error occurred: {e}")
-        raise
+        if args.json:
+            emit_json('summary', status='error', error=str(e))
+        return 1
 
 if __name__ == '__main__':
-    main() 
\ No newline at end of file
+    sys.exit(main())
@@ -0,0 +1,119 @@
+import re
+import base64
+import codecs
+import logging
+from typing import List, Dict, Any, Optional, Callable, Iterator, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Stop decoding a message body after this many bytes.
+BODY_MAX_BYTES = 256 * 1024
+
+# Base64 characters decoded per step (12KB of body); a multiple of 4 so every
+# slice decodes on its own.
+DECODE_CHUNK_CHARS = 16 * 1024
+
+def _part_charset(part: Dict[str, Any]) -> str:
+    content_type = next((h['value'] for h in part.get('headers', []) if h['name'].lower() == 'content-type'), '')
+    match = re.search(r'charset="?([\w.:-]+)"?', content_type, re.IGNORECASE)
+    if match:
+        try:
+            codecs.lookup(match.group(1))
+            return match.group(1)
+        except LookupError:
+            pass
+    return 'utf-8'
+
+def _is_attachment(part: Dict[str, Any]) -> bool:
+    return bool(part.get('filename')) or 'attachmentId' in part.get('body', {})
+
+def iter_text_parts(payload: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Walk a message payload depth-first, yielding its inline text parts.
+
+    Attachments are skipped, and from a multipart/alternative only the
+    text/plain version is read when there is one.
+    """
+    if _is_attachment(payload):
+        return
+    mime_type = payload.get('mimeType', '').lower()
+    parts = payload.get('parts')
+    if parts:
+        if mime_type == 'multipart/alternative':
+            plain = [part for part in parts if part.get('mimeType', '').lower() == 'text/plain']
+            if plain:
+                parts = plain
+        for part in parts:
+            yield from iter_text_parts(part)
+    elif mime_type.startswith('text/'):
+        yield payload
+
+def iter_decoded_text(part: Dict[str, Any]) -> Iterator[Tuple[int, str]]:
+    """Decode a part's base64url body a slice at a time, yielding (bytes, text)."""
+    data = part.get('body', {}).get('data', '')
+    decoder = codecs.getincrementaldecoder(_part_charset(part))(errors='replace')
+    for start in range(0, len(data), DECODE_CHUNK_CHARS):
+        chunk = data[start:start + DECODE_CHUNK_CHARS]
+        final = start + DECODE_CHUNK_CHARS >= len(data)
+        if final:
+            chunk += '=' * (-len(chunk) % 4)
+        raw = base64.urlsafe_b64decode(chunk)
+        yield len(raw), decoder.decode(raw, final=final)
+
+class BodyReader:
+    """Lazily fetched and decoded message body, shared by all body conditions.
+
+    Nothing is requested until a condition first reads the body. Text is
+    decoded chunk by chunk and cached, so a second body condition on the same
+    message reuses what the first one decoded, and decoding stops once
+    `max_bytes` of the body have been read or a condition is decided.
+    """
+
+    def __init__(self, fetch: Callable[[], Dict[str, Any]], max_bytes: int = BODY_MAX_BYTES):
+        self.fetch = fetch
+        self.max_bytes = max_bytes
+        self.chunks: List[str] = []
+        self.decoded_bytes = 0
+        self.source: Optional[Iterator[Tuple[int, str]]] = None
+        self.exhausted = False
+
+    def _source(self) -> Iterator[Tuple[int, str]]:
+        message = self.fetch()
+        for part in iter_text_parts(message.get('payload', {})):
+            yield from iter_decoded_text(part)
+
+    def iter_chunks(self) -> Iterator[str]:
+        """Yield cached chunks, then decode more until the cap is reached."""
+        yield from list(self.chunks)
+        if self.exhausted:
+            return
+        if self.source is None:
+            self.source = self._source()
+        for size, chunk in self.source:
+            self.chunks.append(chunk)
+            self.decoded_bytes += size
+            yield chunk
+            if self.decoded_bytes >= self.max_bytes:
+                logger.debug(f"Body decoding stopped at the {self.max_bytes} byte cap")
+                break
+        self.exhausted = True
+        self.source = None
+
+    def contains(self, needle: str) -> bool:
+        """Case-insensitive substring search that stops at the first hit."""
+        needle = needle.lower()
+        tail = ''
+        for chunk in self.iter_chunks():
+            window = tail + chunk.lower()
+            if needle in window:
+                return True
+            tail = window[-(len(needle) - 1):] if len(needle) > 1 else ''
+        return False
+
+    def search(self, pattern: re.Pattern) -> bool:
+        """Regex search, retried as text arrives and stopped at the first hit."""
+        text = ''
+        for chunk in self.iter_chunks():
+            text += chunk
+            if pattern.search(text):
+                return True
+        return False
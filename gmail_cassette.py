@@ -0,0 +1,458 @@
+import os
+import re
+import sys
+import gzip
+import hmac
+import json
+import time
+import atexit
+import base64
+import hashlib
+import logging
+import argparse
+import threading
+import collections
+from typing import List, Dict, Any, Optional, Tuple
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+from gmail_rule_store import RuleStore
+
+logger = logging.getLogger(__name__)
+
+# Environment variables that make the window record its Gmail traffic to, or
+# replay it from, a cassette, and scale the replayed latencies.
+RECORD_ENV = 'GMAIL_RECORD'
+REPLAY_ENV = 'GMAIL_REPLAY'
+REPLAY_SCALE_ENV = 'GMAIL_REPLAY_SCALE'
+
+CASSETTE_VERSION = 1
+
+# Arguments ignored when a replayed call has no exact match, so a replay
+# still works after the rules, page sizes, field masks or anonymization
+# changed the queries the run makes.
+LOOSE_ARGS = ('q', 'maxResults', 'fields', 'metadataHeaders')
+
+# Header values kept as they are by the anonymizer; they describe the
+# message format rather than the people or the content.
+KEPT_HEADERS = {'date', 'content-type', 'mime-version', 'content-transfer-encoding'}
+
+# Condition fields whose values are not personal text.
+UNCHANGED_FIELDS = ('Size', 'Age', 'Date', 'Attachment', 'Status')
+
+WORD_PATTERN = re.compile(r'\w+')
+
+def _call_key(method: str, args: Dict[str, Any], loose: bool = False) -> str:
+    if loose:
+        args = {name: value for name, value in args.items() if name not in LOOSE_ARGS}
+    return json.dumps([method, args], sort_keys=True, separators=(',', ':'))
+
+def _error_entry(error: Exception) -> Dict[str, Any]:
+    if isinstance(error, HttpError):
+        content = error.content.decode('utf-8', 'replace') if isinstance(error.content, bytes) else str(error.content)
+        return {'status': error.resp.status, 'content': content}
+    return {'type': type(error).__name__, 'message': str(error)}
+
+def _replayed_error(entry: Dict[str, Any]) -> Exception:
+    if 'status' in entry:
+        return HttpError(httplib2.Response({'status': entry['status']}), entry['content'].encode('utf-8'))
+    return RuntimeError(f"{entry['type']}: {entry['message']}")
+
+class Anonymizer:
+    """Replaces personal text in cassette entries, consistently under one key.
+
+    Every word becomes a keyed hash of the same length (digits stay digits),
+    so the same address, subject word or label name always maps to the same
+    token and header shapes, lengths and frequencies are kept. Punctuation,
+    message and label IDs, dates, sizes and system labels are left alone.
+    Rules anonymized with the same key (see `rule`) match the same messages
+    as before, as long as their values are made of whole words.
+    """
+
+    def __init__(self, key: Optional[bytes] = None):
+        self.key = key if key is not None else os.urandom(32)
+
+    def word(self, word: str) -> str:
+        digest = hmac.new(self.key, word.lower().encode('utf-8'), hashlib.sha256).digest()
+        while len(digest) < len(word):
+            digest += hashlib.sha256(digest).digest()
+        if word.isdigit():
+            return ''.join(str(byte % 10) for byte in digest[:len(word)])
+        return ''.join(chr(ord('a') + byte % 26) for byte in digest[:len(word)])
+
+    def text(self, text: str) -> str:
+        return WORD_PATTERN.sub(lambda match: self.word(match.group(0)), text)
+
+    def body_data(self, data: str) -> str:
+        """Anonymize base64url body data, keeping its decoded length."""
+        raw = base64.urlsafe_b64decode(data + '=' * (-len(data) % 4))
+        try:
+            raw = self.text(raw.decode('utf-8')).encode('utf-8')
+        except UnicodeDecodeError:
+            raw = bytes(len(raw))
+        return base64.urlsafe_b64encode(raw).decode('ascii')
+
+    def payload(self, part: Dict[str, Any]) -> None:
+        for header in part.get('headers', []):
+            if header['name'].lower() not in KEPT_HEADERS:
+                header['value'] = self.text(header['value'])
+        if part.get('filename'):
+            part['filename'] = self.text(part['filename'])
+        if part.get('body', {}).get('data'):
+            part['body']['data'] = self.body_data(part['body']['data'])
+        for child in part.get('parts', []):
+            self.payload(child)
+
+    def response(self, response: Any) -> Any:
+        """Anonymize an API response in place and return it."""
+        if isinstance(response, list):
+            for item in response:
+                self.response(item)
+        elif isinstance(response, dict):
+            if 'payload' in response:
+                self.payload(response['payload'])
+            if response.get('snippet'):
+                response['snippet'] = self.text(response['snippet'])
+            if response.get('emailAddress'):
+                response['emailAddress'] = self.text(response['emailAddress'])
+            if 'name' in response and response.get('type') != 'system':
+                response['name'] = self.text(response['name'])
+            for key in ('labels', 'messages', 'filter', 'criteria'):
+                if key in response:
+                    self.response(response[key])
+            for key in ('from', 'to', 'subject', 'query', 'negatedQuery'):
+                if isinstance(response.get(key), str):
+                    response[key] = self.text(response[key])
+        return response
+
+    def args(self, args: Dict[str, Any]) -> Dict[str, Any]:
+        """Return a call's arguments with queries and label names anonymized."""
+        args = json.loads(json.dumps(args))
+        if args.get('q'):
+            args['q'] = self.text(args['q'])
+        if isinstance(args.get('body'), dict):
+            self.response(args['body'])
+        return args
+
+    def rule(self, rule: Dict[str, Any]) -> Dict[str, Any]:
+        """Return a copy of a rule whose values match the anonymized messages."""
+        rule = json.loads(json.dumps(rule))
+        self._condition(rule, 'condition_field', 'condition_operator', 'condition_value')
+        for condition in rule.get('conditions', []):
+            self._condition(condition, 'field', 'operator', 'value')
+        if rule.get('action_value') and not rule['action_value'].startswith('CATEGORY_'):
+            rule['action_value'] = self.text(rule['action_value'])
+        return rule
+
+    def _condition(self, condition: Dict[str, Any], field_key: str, operator_key: str, value_key: str) -> None:
+        field, value = condition.get(field_key), condition.get(value_key)
+        if condition.get(operator_key) == 'matches regex':
+            logger.warning(f"Regex condition on {field} kept as it is; it will not match anonymized text")
+        elif field not in UNCHANGED_FIELDS and isinstance(value, str) and not (field == 'Label' and value.isupper()):
+            # System label names such as INBOX are not anonymized
+            condition[value_key] = self.text(value)
+
+class RecordingService:
+    """Wraps a Gmail service and records every call it makes to a cassette.
+
+    Each executed request is written as one JSON line (gzip-compressed)
+    with its method, arguments, response or error, and how long it took.
+    HTTP batches are recorded as one entry holding their calls. With an
+    `anonymizer`, what is written is anonymized; callers still get the real
+    responses.
+    """
+
+    def __init__(self, service, cassette_file: str, anonymizer: Optional[Anonymizer] = None):
+        self.service = service
+        self.cassette_file = cassette_file
+        self.anonymizer = anonymizer
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        self.entries = 0
+        self.file = gzip.open(cassette_file, 'wt', encoding='utf-8')
+        self._write({'cassette': CASSETTE_VERSION, 'recorded': time.time(), 'anonymized': anonymizer is not None})
+        atexit.register(self.close)
+
+    def users(self):
+        return _RecordingResource(self, self.service.users(), [])
+
+    def new_batch_http_request(self, callback=None):
+        return _RecordingBatch(self, self.service.new_batch_http_request(), callback)
+
+    def entry(self, method: str, args: Dict[str, Any], seconds: float, response=None,
+              error: Optional[Exception] = None) -> Dict[str, Any]:
+        if self.anonymizer is not None:
+            args = self.anonymizer.args(args)
+            if response is not None:
+                response = self.anonymizer.response(json.loads(json.dumps(response)))
+        entry = {'m': method, 'a': args, 'd': round(seconds, 6)}
+        if error is not None:
+            entry['e'] = _error_entry(error)
+        else:
+            entry['r'] = response
+        return entry
+
+    def record(self, entry: Dict[str, Any]) -> None:
+        entry['t'] = round(time.monotonic() - self.started, 6)
+        self._write(entry)
+
+    def _write(self, entry: Dict[str, Any]) -> None:
+        with self.lock:
+            if self.file is None:
+                return
+            self.file.write(json.dumps(entry, separators=(',', ':')) + '\n')
+            self.entries += 1
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+                logger.info(f"Recorded {self.entries - 1} calls to {self.cassette_file}")
+
+class _RecordingResource:
+    def __init__(self, recorder: RecordingService, resource, path: List[str]):
+        self._recorder = recorder
+        self._resource = resource
+        self._path = path
+
+    def __getattr__(self, name):
+        attribute = getattr(self._resource, name)
+
+        def call(*args, **kwargs):
+            result = attribute(*args, **kwargs)
+            if hasattr(result, 'execute'):
+                return _RecordingRequest(self._recorder, result, '.'.join(self._path + [name]), kwargs)
+            return _RecordingResource(self._recorder, result, self._path + [name])
+        return call
+
+class _RecordingRequest:
+    def __init__(self, recorder: RecordingService, request, method: str, args: Dict[str, Any]):
+        self.recorder = recorder
+        self.request = request
+        self.method = method
+        self.args = args
+
+    def execute(self, *args, **kwargs):
+        started = time.monotonic()
+        try:
+            response = self.request.execute(*args, **kwargs)
+        except Exception as e:
+            self.recorder.record(self.recorder.entry(self.method, self.args, time.monotonic() - started, error=e))
+            raise
+        self.recorder.record(self.recorder.entry(self.method, self.args, time.monotonic() - started, response))
+        return response
+
+class _RecordingBatch:
+    def __init__(self, recorder: RecordingService, batch, callback=None):
+        self.recorder = recorder
+        self.batch = batch
+        self.callback = callback
+        self.calls: List[Tuple[_RecordingRequest, Any, Optional[Exception]]] = []
+
+    def add(self, request: _RecordingRequest, callback=None, request_id=None) -> None:
+        callback = callback or self.callback
+
+        def recorded(request_id, response, exception):
+            self.calls.append((request, response, exception))
+            if callback is not None:
+                callback(request_id, response, exception)
+        self.batch.add(request.request, callback=recorded, request_id=request_id)
+
+    def execute(self, *args, **kwargs) -> None:
+        started = time.monotonic()
+        try:
+            self.batch.execute(*args, **kwargs)
+        finally:
+            seconds = time.monotonic() - started
+            # Batched calls share the batch's latency
+            share = seconds / max(len(self.calls), 1)
+            self.recorder.record({'m': 'batch', 'd': round(seconds, 6), 'b': [
+                self.recorder.entry(request.method, request.args, share, response, exception)
+                for request, response, exception in self.calls
+            ]})
+
+def load_cassette(cassette_file: str) -> Tuple[Dict[str, Any], List[Dict[str, Any]]]:
+    """Return a cassette's header and its entries.
+
+    A cassette cut short, for example by the window being killed, is read up
+    to where it ends.
+    """
+    header, entries = {}, []
+    with gzip.open(cassette_file, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                entry = json.loads(line)
+                if 'cassette' in entry:
+                    header = entry
+                else:
+                    entries.append(entry)
+        except (EOFError, json.JSONDecodeError):
+            logger.warning(f"{cassette_file} ends early; replaying the {len(entries)} entries before that")
+    return header, entries
+
+class ReplayService:
+    """Serves the responses of a cassette in place of a Gmail service.
+
+    Calls are matched on their method and arguments, falling back to a
+    match that ignores LOOSE_ARGS. Repeated calls get the recorded
+    responses in order, and the last one again once those run out. Each
+    call waits its recorded latency multiplied by `time_scale` (0 answers
+    at once), so runs can be benchmarked offline against a real mailbox.
+    Calls with no recorded response raise and are counted in `misses`.
+    """
+
+    def __init__(self, cassette_file: str, time_scale: float = 1.0):
+        self.cassette_file = cassette_file
+        self.time_scale = time_scale
+        self.lock = threading.Lock()
+        self.responses: Dict[str, collections.deque] = {}
+        self.calls = 0
+        self.misses = 0
+        self.header, entries = load_cassette(cassette_file)
+        for entry in entries:
+            for call in entry['b'] if entry['m'] == 'batch' else [entry]:
+                # A call without loose arguments has one key, and must be queued only once
+                for key in {_call_key(call['m'], call['a'], loose) for loose in (False, True)}:
+                    self.responses.setdefault(key, collections.deque()).append(call)
+        logger.info(f"Replaying {len(entries)} recorded calls from {cassette_file}")
+
+    def users(self):
+        return _ReplayResource(self, [])
+
+    def new_batch_http_request(self, callback=None):
+        return _ReplayBatch(self, callback)
+
+    def lookup(self, method: str, args: Dict[str, Any]) -> Dict[str, Any]:
+        with self.lock:
+            self.calls += 1
+            for loose in (False, True):
+                queue = self.responses.get(_call_key(method, args, loose))
+                if queue:
+                    return queue.popleft() if len(queue) > 1 else queue[0]
+            self.misses += 1
+        raise KeyError(f"No recorded response for {method} {json.dumps(args, sort_keys=True)}")
+
+    def wait(self, seconds: float) -> None:
+        if self.time_scale > 0:
+            time.sleep(seconds * self.time_scale)
+
+class _ReplayResource:
+    def __init__(self, replay: ReplayService, path: List[str]):
+        self._replay = replay
+        self._path = path
+
+    def __getattr__(self, name):
+        def call(**kwargs):
+            if not kwargs:
+                return _ReplayResource(self._replay, self._path + [name])
+            return _ReplayRequest(self._replay, '.'.join(self._path + [name]), kwargs)
+        return call
+
+class _ReplayRequest:
+    def __init__(self, replay: ReplayService, method: str, args: Dict[str, Any]):
+        self.replay = replay
+        self.method = method
+        self.args = args
+
+    def result(self) -> Tuple[Any, Optional[Exception], float]:
+        """Return the recorded response, or the error to raise, and the recorded latency."""
+        call = self.replay.lookup(self.method, self.args)
+        if 'e' in call:
+            return None, _replayed_error(call['e']), call['d']
+        return json.loads(json.dumps(call['r'])), None, call['d']
+
+    def execute(self, *args, **kwargs):
+        response, error, seconds = self.result()
+        self.replay.wait(seconds)
+        if error is not None:
+            raise error
+        return response
+
+class _ReplayBatch:
+    def __init__(self, replay: ReplayService, callback=None):
+        self.replay = replay
+        self.callback = callback
+        self.requests: List[Tuple[_ReplayRequest, Any, str]] = []
+
+    def add(self, request: _ReplayRequest, callback=None, request_id=None) -> None:
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests) + 1)))
+
+    def execute(self, *args, **kwargs) -> None:
+        results = []
+        for request, callback, request_id in self.requests:
+            try:
+                results.append((callback, request_id) + request.result())
+            except KeyError as e:
+                results.append((callback, request_id, None, e, 0.0))
+        self.replay.wait(sum(seconds for *_, seconds in results))
+        for callback, request_id, response, error, _ in results:
+            if callback is not None:
+                callback(request_id, response, error)
+
+def record_from_environment(service):
+    """Wrap `service` in a RecordingService if GMAIL_RECORD names a cassette."""
+    cassette_file = os.environ.get(RECORD_ENV)
+    if not cassette_file:
+        return service
+    logger.info(f"Recording Gmail calls to {cassette_file}")
+    return RecordingService(service, cassette_file)
+
+def replay_from_environment() -> Optional[ReplayService]:
+    """Return a ReplayService if GMAIL_REPLAY names a cassette."""
+    cassette_file = os.environ.get(REPLAY_ENV)
+    if not cassette_file:
+        return None
+    return ReplayService(cassette_file, float(os.environ.get(REPLAY_SCALE_ENV, '1')))
+
+def anonymize_cassette(cassette_file: str, output_file: str, anonymizer: Anonymizer) -> int:
+    """Write an anonymized copy of a cassette and return how many calls it holds."""
+    header, entries = load_cassette(cassette_file)
+    calls = 0
+    with gzip.open(output_file, 'wt', encoding='utf-8') as f:
+        f.write(json.dumps(dict(header, anonymized=True), separators=(',', ':')) + '\n')
+        for entry in entries:
+            for call in entry['b'] if entry['m'] == 'batch' else [entry]:
+                call['a'] = anonymizer.args(call['a'])
+                if 'r' in call:
+                    call['r'] = anonymizer.response(call['r'])
+                calls += 1
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+    return calls
+
+def main(argv=None) -> int:
+    """Anonymize a recorded cassette, and optionally the rules to replay it with."""
+    parser = argparse.ArgumentParser(
+        prog='gmail-cassette',
+        description="Anonymize a cassette recorded with gmail-apply-rules --record or GMAIL_RECORD."
+    )
+    parser.add_argument('cassette', help="recorded cassette")
+    parser.add_argument('output', help="anonymized cassette to write")
+    parser.add_argument('--key', help="secret the pseudonyms are derived from; reuse it to anonymize "
+                                      "more cassettes or rules the same way (default: random)")
+    parser.add_argument('--rules', help="rule store, or JSON rules file, to anonymize with the same key")
+    parser.add_argument('--rules-output', default='rules_anonymized.json',
+                        help="where to write the anonymized rules (default: %(default)s)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    anonymizer = Anonymizer(args.key.encode('utf-8') if args.key else None)
+    try:
+        calls = anonymize_cassette(args.cassette, args.output, anonymizer)
+        logger.info(f"Wrote {calls} anonymized calls to {args.output}")
+        if args.rules:
+            if args.rules.endswith('.json'):
+                with open(args.rules, 'r') as f:
+                    rules = json.load(f)
+            else:
+                rules = RuleStore(args.rules).all()
+            with open(args.rules_output, 'w') as f:
+                json.dump([anonymizer.rule(rule) for rule in rules], f, indent=2)
+            logger.info(f"Wrote {len(rules)} anonymized rules to {args.rules_output}")
+        return 0
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
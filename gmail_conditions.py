@@ -0,0 +1,467 @@
+import re
+import datetime
+from datetime import UTC
+from dateutil.relativedelta import relativedelta
+import logging
+from typing import List, Dict, Any, Optional, Callable
+
+logger = logging.getLogger(__name__)
+
+class BodyRequired(Exception):
+    """Raised by a body check on a message that has no body reader attached."""
+
+HEADER_OPERATORS = ['contains', 'equals', 'starts with', 'ends with']
+
+# Condition fields and the operators each one supports, in the order the
+# Rules tab shows them.
+CONDITION_OPERATORS = {
+    'Subject': HEADER_OPERATORS,
+    'From': HEADER_OPERATORS,
+    'To': HEADER_OPERATORS,
+    'Age': ['older than', 'newer than'],
+    'Date': ['before', 'after'],
+    'Size': ['larger than', 'smaller than'],
+    'Attachment': ['present', 'absent'],
+    'Label': ['has', 'does not have'],
+    'Status': ['is unread', 'is read'],
+    'Body': ['contains', 'matches regex'],
+}
+
+# Fields evaluated from message metadata rather than a header value.
+METADATA_FIELDS = {'Age', 'Date', 'Size', 'Attachment', 'Label', 'Status'}
+
+# Fields whose result for a message changes after it arrives: as it gets
+# older, and as it is labeled or read.
+CHANGING_FIELDS = {'Age', 'Label', 'Status'}
+
+# Fields whose operator says everything, so the value is left empty.
+VALUELESS_FIELDS = {'Attachment', 'Status'}
+
+# Headers a metadata field still needs in the metadata response.
+FIELD_HEADERS = {'Attachment': ['Content-Type']}
+
+SIZE_PATTERN = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*$', re.IGNORECASE)
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+AGE_PATTERN = re.compile(r'^\s*(\d+)\s*([dwmy])\s*$', re.IGNORECASE)
+AGE_UNITS = {'d': 'days', 'w': 'weeks', 'm': 'months', 'y': 'years'}
+
+def rule_conditions(rule: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """Return every condition of a rule definition.
+
+    The `condition_*` keys hold the first condition; any further ones are
+    listed under `conditions` and must all match as well.
+    """
+    conditions = [{
+        'field': rule['condition_field'],
+        'operator': rule['condition_operator'],
+        'value': rule['condition_value'],
+    }]
+    conditions.extend(rule.get('conditions', []))
+    return conditions
+
+def describe_condition(condition: Dict[str, Any]) -> str:
+    if condition['field'] in VALUELESS_FIELDS:
+        return f"{condition['field']} {condition['operator']}"
+    return f"{condition['field']} {condition['operator']} '{condition['value']}'"
+
+def describe_conditions(rule: Dict[str, Any]) -> str:
+    return " and ".join(describe_condition(condition) for condition in rule_conditions(rule))
+
+def parse_age(value: str) -> relativedelta:
+    """Parse an age such as '30d', '2w', '6m' or '1y'."""
+    match = AGE_PATTERN.match(value)
+    if not match:
+        raise ValueError(f"Invalid age '{value}', expected a number followed by d, w, m or y")
+    return relativedelta(**{AGE_UNITS[match.group(2).lower()]: int(match.group(1))})
+
+def parse_date(value: str) -> datetime.datetime:
+    """Parse a YYYY-MM-DD or YYYY/MM/DD date as midnight UTC."""
+    return datetime.datetime.strptime(value.strip().replace('/', '-'), '%Y-%m-%d').replace(tzinfo=UTC)
+
+def parse_size(value: str) -> int:
+    """Parse a size such as '500K', '5M' or '1048576' into bytes."""
+    match = SIZE_PATTERN.match(value)
+    if not match:
+        raise ValueError(f"Invalid size '{value}', expected a number optionally followed by K, M or G")
+    return int(float(match.group(1)) * SIZE_UNITS[match.group(2).lower()])
+
+def validate_condition(condition: Dict[str, Any]) -> None:
+    """Raise ValueError if a condition's value cannot be parsed."""
+    field = condition['field']
+    if field not in VALUELESS_FIELDS and not condition['value']:
+        raise ValueError(f"{field} conditions need a value")
+    if field == 'Body' and condition['operator'] == 'matches regex':
+        try:
+            re.compile(condition['value'])
+        except re.error as e:
+            raise ValueError(f"Invalid regular expression: {e}")
+    if field == 'Age':
+        parse_age(condition['value'])
+    elif field == 'Date':
+        parse_date(condition['value'])
+    elif field == 'Size':
+        parse_size(condition['value'])
+
+def message_date(msg: Dict[str, Any]) -> Optional[datetime.datetime]:
+    """Return the message's internalDate, which metadata responses include."""
+    internal_date = msg.get('internalDate')
+    if internal_date is None:
+        return None
+    return datetime.datetime.fromtimestamp(int(internal_date) / 1000, UTC)
+
+def header_value(msg: Dict[str, Any], name: str) -> str:
+    headers = []
+    if 'payload' in msg:
+        headers = msg['payload'].get('headers', [])
+    elif 'headers' in msg:
+        headers = msg['headers']
+    return next((h['value'] for h in headers if h['name'].lower() == name.lower()), '')
+
+def _header_check(condition: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    field = condition['field']
+    operator = condition['operator']
+    expected = condition['value'].lower()
+
+    def check(msg):
+        value = header_value(msg, field).lower()
+        if operator == 'contains':
+            return expected in value
+        elif operator == 'equals':
+            return expected == value
+        elif operator == 'starts with':
+            return value.startswith(expected)
+        elif operator == 'ends with':
+            return value.endswith(expected)
+        return False
+    return check
+
+def _date_threshold(condition: Dict[str, Any], now: datetime.datetime) -> datetime.datetime:
+    if condition['field'] == 'Age':
+        return now - parse_age(condition['value'])
+    return parse_date(condition['value'])
+
+def _date_check(condition: Dict[str, Any], now: datetime.datetime) -> Callable[[Dict[str, Any]], bool]:
+    threshold = _date_threshold(condition, now)
+    # "older than" and "before" both mean received earlier than the threshold
+    earlier = condition['operator'] in ('older than', 'before')
+
+    def check(msg):
+        received = message_date(msg)
+        if received is None:
+            return False
+        return received < threshold if earlier else received >= threshold
+    return check
+
+def _size_check(condition: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    threshold = parse_size(condition['value'])
+    larger = condition['operator'] == 'larger than'
+
+    def check(msg):
+        size = int(msg.get('sizeEstimate', 0))
+        return size > threshold if larger else size < threshold
+    return check
+
+def has_attachment(msg: Dict[str, Any]) -> bool:
+    """Guess attachment presence from the top-level content type.
+
+    Metadata responses carry no parts, but mail with attachments is sent as
+    multipart/mixed, which the payload's mimeType or Content-Type header shows.
+    """
+    mime_type = msg.get('payload', {}).get('mimeType') or header_value(msg, 'Content-Type')
+    return mime_type.lower().startswith('multipart/mixed')
+
+def _attachment_check(condition: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    present = condition['operator'] == 'present'
+
+    def check(msg):
+        return has_attachment(msg) == present
+    return check
+
+def _label_check(condition: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    expected = condition['value'].lower()
+    has = condition['operator'] == 'has'
+
+    def check(msg):
+        # labelNames is filled in by the engine; system label IDs are their names
+        names = msg.get('labelNames', msg.get('labelIds', []))
+        return any(name.lower() == expected for name in names) == has
+    return check
+
+def _status_check(condition: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    unread = condition['operator'] == 'is unread'
+
+    def check(msg):
+        return ('UNREAD' in msg.get('labelIds', [])) == unread
+    return check
+
+def _body_check(condition: Dict[str, Any]) -> Callable[[Dict[str, Any]], bool]:
+    if condition['operator'] == 'matches regex':
+        pattern = re.compile(condition['value'], re.IGNORECASE)
+
+        def check(msg):
+            body = msg.get('bodyReader')
+            if body is None:
+                raise BodyRequired(msg.get('id'))
+            return body.search(pattern)
+    else:
+        needle = condition['value']
+
+        def check(msg):
+            body = msg.get('bodyReader')
+            if body is None:
+                raise BodyRequired(msg.get('id'))
+            return body.contains(needle)
+    return check
+
+def create_check(condition: Dict[str, Any], now: Optional[datetime.datetime] = None) -> Callable[[Dict[str, Any]], bool]:
+    """Create the check function for a single condition."""
+    field = condition['field']
+    if field == 'Body':
+        return _body_check(condition)
+    if field in ('Age', 'Date'):
+        return _date_check(condition, now or datetime.datetime.now(UTC))
+    if field == 'Size':
+        return _size_check(condition)
+    if field == 'Attachment':
+        return _attachment_check(condition)
+    if field == 'Label':
+        return _label_check(condition)
+    if field == 'Status':
+        return _status_check(condition)
+    return _header_check(condition)
+
+def create_condition(rule: Dict[str, Any], now: Optional[datetime.datetime] = None) -> Callable[[Dict[str, Any]], bool]:
+    """Create the condition function for a rule definition.
+
+    Metadata checks run before header checks, and body checks run last, so
+    the body is only fetched for messages that passed everything else. Age
+    conditions are measured from `now`, the current time by default.
+    """
+    now = now or datetime.datetime.now(UTC)
+    conditions = sorted(rule_conditions(rule), key=condition_cost)
+    checks = [create_check(condition, now) for condition in conditions]
+
+    def condition(msg):
+        try:
+            result = all(check(msg) for check in checks)
+            logger.debug(f"Message {msg.get('id', 'unknown')} - Rule check: {describe_conditions(rule)} = {result}")
+            return result
+        except BodyRequired:
+            raise
+        except Exception as e:
+            logger.error(f"Error in condition for message {msg.get('id', 'unknown')}: {e}")
+            return False
+    return condition
+
+def condition_cost(condition: Dict[str, Any]) -> int:
+    """Rank conditions by evaluation cost: metadata, then headers, then body."""
+    if condition['field'] in METADATA_FIELDS:
+        return 0
+    if condition['field'] == 'Body':
+        return 2
+    return 1
+
+def needs_body(rule: Dict[str, Any]) -> bool:
+    return any(condition['field'] == 'Body' for condition in rule_conditions(rule))
+
+def condition_headers(rule: Dict[str, Any]) -> List[str]:
+    """Return the header names a rule's conditions read."""
+    headers = []
+    for condition in rule_conditions(rule):
+        field = condition['field']
+        if field in METADATA_FIELDS:
+            headers.extend(FIELD_HEADERS.get(field, []))
+        elif field != 'Body':
+            headers.append(field)
+    return headers
+
+def label_search_name(name: str) -> str:
+    """Return a label name in the form Gmail's `label:` operator expects."""
+    return re.sub(r'[\s/]+', '-', name.strip()).lower()
+
+def query_term(condition: Dict[str, Any], now: Optional[datetime.datetime] = None) -> Optional[str]:
+    """Translate a condition into a Gmail search term, if it has one.
+
+    Terms are widened by a day so the server returns a superset of the
+    messages the condition matches; the client still makes the exact check.
+    Header and body conditions have no term because Gmail's word-based
+    search does not match substrings, and attachment conditions have none
+    because `has:attachment` disagrees with the content type check.
+    """
+    now = now or datetime.datetime.now(UTC)
+    field = condition['field']
+    operator = condition['operator']
+    if field == 'Age':
+        days = (now - _date_threshold(condition, now)).days
+        if operator == 'older than':
+            return f"older_than:{days - 1}d" if days > 1 else None
+        return f"newer_than:{days + 1}d"
+    if field == 'Date':
+        date = parse_date(condition['value'])
+        if operator == 'before':
+            return f"before:{(date + relativedelta(days=1)).strftime('%Y/%m/%d')}"
+        return f"after:{(date - relativedelta(days=1)).strftime('%Y/%m/%d')}"
+    if field == 'Size':
+        # sizeEstimate is approximate, so leave a 10% margin
+        size = parse_size(condition['value'])
+        if operator == 'larger than':
+            return f"larger:{int(size * 0.9)}"
+        return f"smaller:{int(size * 1.1) + 1}"
+    if field == 'Label':
+        term = f"label:{label_search_name(condition['value'])}"
+        return term if operator == 'has' else f"-{term}"
+    if field == 'Status':
+        return "is:unread" if operator == 'is unread' else "-is:unread"
+    return None
+
+def rule_query(rule: Dict[str, Any], now: Optional[datetime.datetime] = None) -> Optional[str]:
+    """Return the Gmail query that selects a superset of a rule's matches.
+
+    Returns None when no condition can be pushed down, meaning the rule has
+    to see every message. Age terms are measured from `now`.
+    """
+    now = now or datetime.datetime.now(UTC)
+    terms = [term for term in (query_term(c, now) for c in rule_conditions(rule)) if term]
+    return " ".join(terms) if terms else None
+
+def combine_queries(queries: List[Optional[str]]) -> Optional[str]:
+    """OR per-rule queries together; any rule without a query needs a full scan."""
+    if not queries or any(query is None for query in queries):
+        return None
+    unique = list(dict.fromkeys(queries))
+    if len(unique) == 1:
+        return unique[0]
+    return " OR ".join(f"({query})" for query in unique)
+
+def _header_field(field: str) -> bool:
+    return field not in METADATA_FIELDS and field != 'Body'
+
+def _text_matches(operator: str, expected: str, value: str) -> bool:
+    if operator == 'contains':
+        return expected in value
+    if operator == 'equals':
+        return expected == value
+    if operator == 'starts with':
+        return value.startswith(expected)
+    if operator == 'ends with':
+        return value.endswith(expected)
+    return False
+
+def _received_bound(condition: Dict[str, Any], now: datetime.datetime):
+    """Return ('before', t) or ('from', t): received before t, or at or after t."""
+    earlier = condition['operator'] in ('older than', 'before')
+    return ('before' if earlier else 'from'), _date_threshold(condition, now)
+
+def condition_implies(a: Dict[str, Any], b: Dict[str, Any], now: Optional[datetime.datetime] = None) -> bool:
+    """Whether every message matching condition `a` also matches condition `b`."""
+    field = a['field']
+    if field != b['field']:
+        return False
+    try:
+        if _header_field(field) or (field == 'Body' and 'matches regex' not in (a['operator'], b['operator'])):
+            value = a['value'].lower()
+            if a['operator'] == 'equals':
+                return _text_matches(b['operator'], b['value'].lower(), value)
+            # Any text with this prefix, suffix or substring contains it
+            return b['operator'] in (a['operator'], 'contains') and _text_matches(b['operator'], b['value'].lower(), value)
+        if a['operator'] != b['operator']:
+            return False
+        if field == 'Size':
+            if a['operator'] == 'larger than':
+                return parse_size(a['value']) >= parse_size(b['value'])
+            return parse_size(a['value']) <= parse_size(b['value'])
+        if field in ('Age', 'Date'):
+            now = now or datetime.datetime.now(UTC)
+            side, threshold = _received_bound(a, now)
+            other = _date_threshold(b, now)
+            return threshold <= other if side == 'before' else threshold >= other
+    except ValueError:
+        return False
+    if field in VALUELESS_FIELDS:
+        return True
+    if field == 'Body':
+        return a['value'] == b['value']
+    return a['value'].lower() == b['value'].lower()
+
+def conditions_implied(conditions: List[Dict[str, Any]], others: List[Dict[str, Any]],
+                       now: Optional[datetime.datetime] = None) -> bool:
+    """Whether every message matching all `conditions` matches all `others`."""
+    return all(any(condition_implies(condition, other, now) for condition in conditions) for other in others)
+
+def conditions_contradiction(conditions: List[Dict[str, Any]], now: Optional[datetime.datetime] = None) -> Optional[str]:
+    """Return why no message can match all the conditions, or None if one may."""
+    now = now or datetime.datetime.now(UTC)
+    for index, a in enumerate(conditions):
+        for b in conditions[index + 1:]:
+            reason = f"{describe_condition(a)} and {describe_condition(b)} never both hold"
+            try:
+                if a['field'] in ('Age', 'Date') and b['field'] in ('Age', 'Date'):
+                    bounds = dict([_received_bound(a, now), _received_bound(b, now)])
+                    if len(bounds) == 2 and bounds['before'] <= bounds['from']:
+                        return reason
+                    continue
+                if a['field'] != b['field']:
+                    continue
+                field = a['field']
+                if field in ('Attachment', 'Status') and a['operator'] != b['operator']:
+                    return reason
+                if field == 'Label' and a['operator'] != b['operator'] and a['value'].lower() == b['value'].lower():
+                    return reason
+                if field == 'Size' and a['operator'] != b['operator']:
+                    larger, smaller = (a, b) if a['operator'] == 'larger than' else (b, a)
+                    if parse_size(smaller['value']) <= parse_size(larger['value']) + 1:
+                        return reason
+                if _header_field(field):
+                    x, y = a['value'].lower(), b['value'].lower()
+                    for first, second, value in ((a, b, x), (b, a, y)):
+                        if first['operator'] == 'equals' and not _text_matches(second['operator'], second['value'].lower(), value):
+                            return reason
+                    if a['operator'] == b['operator'] == 'starts with' and not (x.startswith(y) or y.startswith(x)):
+                        return reason
+                    if a['operator'] == b['operator'] == 'ends with' and not (x.endswith(y) or y.endswith(x)):
+                        return reason
+            except ValueError:
+                continue
+    return None
+
+def create_any_condition(rules: List[Dict[str, Any]],
+                         now: Optional[datetime.datetime] = None) -> Callable[[Dict[str, Any]], bool]:
+    """Create one condition that matches a message when any of the rule definitions does.
+
+    Rules made of a single header condition are folded into one check per
+    header and operator, a set lookup for `equals` and one regex for the
+    others, so their number barely changes the cost. The remaining rules
+    are checked after those, cheapest first.
+    """
+    equals: Dict[str, set] = {}
+    patterns: Dict[tuple, List[str]] = {}
+    others = []
+    for rule in rules:
+        conditions = rule_conditions(rule)
+        condition = conditions[0]
+        if len(conditions) > 1 or not _header_field(condition['field']):
+            others.append(rule)
+        elif condition['operator'] == 'equals':
+            equals.setdefault(condition['field'], set()).add(condition['value'].lower())
+        else:
+            patterns.setdefault((condition['field'], condition['operator']), []).append(condition['value'].lower())
+
+    checks = []
+    for field, values in equals.items():
+        checks.append(lambda msg, field=field, values=frozenset(values): header_value(msg, field).lower() in values)
+    for (field, operator), values in patterns.items():
+        alternatives = '|'.join(re.escape(value) for value in sorted(set(values)))
+        if operator == 'starts with':
+            pattern = re.compile(f"^(?:{alternatives})")
+        elif operator == 'ends with':
+            pattern = re.compile(f"(?:{alternatives})\\Z")
+        else:
+            pattern = re.compile(alternatives)
+        checks.append(lambda msg, field=field, pattern=pattern: pattern.search(header_value(msg, field).lower()) is not None)
+    others.sort(key=lambda rule: max(condition_cost(condition) for condition in rule_conditions(rule)))
+    checks.extend(create_condition(rule, now) for rule in others)
+
+    def condition(msg):
+        return any(check(msg) for check in checks)
+    return condition
@@ -0,0 +1,227 @@
+import os
+import re
+import json
+import logging
+from typing import List, Dict, Any, Optional, Tuple
+
+from gmail_apply_rules import FIELDS, FIXED_ACTIONS, RunController, default_controller, action_delta, label_table
+from gmail_conditions import rule_conditions, parse_size
+
+logger = logging.getLogger(__name__)
+
+# IDs of the Gmail filters created from rules, so a sync only ever deletes
+# filters it created itself.
+FILTER_STATE_FILE = 'filters_sync.json'
+
+# Condition fields and the Gmail filter criteria they are imported from.
+FILTER_HEADER_CRITERIA = {'From': 'from', 'To': 'to', 'Subject': 'subject'}
+
+# Gmail filters match whole words and addresses while rules match substrings,
+# so the only header condition pushed down is "From contains" a whole address
+ADDRESS_PATTERN = re.compile(r'^[^@\s<>",;]+@[^@\s<>",;]+\.[^@\s<>",;]+$')
+
+def _criteria(rule: Dict[str, Any]) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Return filter criteria matching the same mail as a rule, or None and the reason there are none."""
+    criteria: Dict[str, Any] = {}
+
+    def put(key, value):
+        if key in criteria:
+            raise ValueError(f"more than one condition on {key}")
+        criteria[key] = value
+
+    try:
+        for condition in rule_conditions(rule):
+            field, operator, value = condition['field'], condition['operator'], condition['value']
+            if field == 'From' and operator == 'contains' and ADDRESS_PATTERN.match(value.strip()):
+                put('from', value.strip())
+            elif field == 'Size':
+                put('size', parse_size(value))
+                criteria['sizeComparison'] = 'larger' if operator == 'larger than' else 'smaller'
+            elif field in FILTER_HEADER_CRITERIA or field == 'Body':
+                raise ValueError(f"Gmail filters match whole words, not what {field} {operator} '{value}' checks")
+            elif field == 'Attachment':
+                raise ValueError("Gmail's attachment check differs from the rule's content type check")
+            else:
+                raise ValueError(f"{field} {operator} has no filter equivalent")
+    except ValueError as e:
+        return None, str(e)
+    return criteria, ''
+
+def _action(service, rule: Dict[str, Any], controller: Optional[RunController] = None,
+            create_labels: bool = True) -> Dict[str, Any]:
+    add, remove = action_delta(rule, service, controller, create_labels)
+    action = {}
+    if add:
+        action['addLabelIds'] = add
+    if remove:
+        action['removeLabelIds'] = remove
+    return action
+
+def filter_key(spec: Dict[str, Any]) -> str:
+    """Return a canonical string for comparing filters by what they do."""
+    action = {key: sorted(value) for key, value in spec.get('action', {}).items() if value}
+    return json.dumps({'criteria': spec.get('criteria', {}), 'action': action}, sort_keys=True)
+
+def eligible_rules(rules: List[Dict[str, Any]]) -> List[Tuple[Dict[str, Any], Optional[Dict[str, Any]], str]]:
+    """Return (rule, criteria, reason) for every rule in declared order.
+
+    Criteria is None, with the reason, for rules a filter cannot enforce
+    exactly: pushed-down rules are skipped by client runs with
+    skip_server_filters, so a filter must match the same mail. Only size
+    conditions and "From contains" a whole address qualify. Gmail applies
+    every matching filter, so stop rules, and any rule a stop rule declared
+    before it could suppress, stay with the client engine.
+    """
+    results = []
+    after_stop_rule = False
+    for rule in sorted(rules, key=lambda rule: -rule.get('priority', 0)):
+        if rule.get('stop_processing'):
+            results.append((rule, None, "stops further rules"))
+            after_stop_rule = True
+        elif after_stop_rule:
+            results.append((rule, None, "a stop rule comes before it"))
+        else:
+            criteria, reason = _criteria(rule)
+            results.append((rule, criteria, reason))
+    return results
+
+def _load_state(state_file: str) -> Dict[str, str]:
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as f:
+            return json.load(f)
+    return {}
+
+def _save_state(state_file: str, state: Dict[str, str]) -> None:
+    with open(state_file, 'w') as f:
+        json.dump(state, f, indent=2)
+
+def list_filters(service, controller: Optional[RunController] = None) -> List[Dict[str, Any]]:
+    if controller:
+        controller.consume('filters.list')
+    return service.users().settings().filters().list(userId='me', fields=FIELDS['filters.list']).execute().get('filter', [])
+
+def sync_filters(service, store, state_file: str = FILTER_STATE_FILE, dry_run: bool = False,
+                 log_func=None, controller: Optional[RunController] = None) -> Dict[str, Any]:
+    """Make the Gmail filters created from rules match the current eligible rules.
+
+    Only missing filters are created and only filters an earlier sync
+    created, whose rule is gone or changed, are deleted. Rules a filter now
+    enforces are marked `server_filter` in the store so routine runs can
+    skip them.
+    """
+    if log_func is None:
+        log_func = logger.info
+    if controller is None:
+        controller = default_controller
+    rules = store.all()
+    desired = {}
+    pushed_ids = set()
+    for rule, criteria, reason in eligible_rules(rules):
+        if criteria is None:
+            logger.debug(f"Rule {rule['id']} stays client-side: {reason}")
+            continue
+        spec = {'criteria': criteria, 'action': _action(service, rule, controller, create_labels=not dry_run)}
+        desired[filter_key(spec)] = spec
+        pushed_ids.add(rule['id'])
+
+    existing = {filter_key(f): f['id'] for f in list_filters(service, controller)}
+    state = {key: filter_id for key, filter_id in _load_state(state_file).items() if filter_id in existing.values()}
+    to_create = [spec for key, spec in desired.items() if key not in existing]
+    to_delete = {key: filter_id for key, filter_id in state.items() if key not in desired}
+    log_func(f"Filters: {len(to_create)} to create, {len(to_delete)} to delete, "
+             f"{len(desired) - len(to_create)} already in place")
+
+    if not dry_run:
+        filters = service.users().settings().filters()
+        for key, filter_id in to_delete.items():
+            controller.consume('filters.delete')
+            filters.delete(userId='me', id=filter_id).execute()
+            del state[key]
+        for spec in to_create:
+            controller.consume('filters.create')
+            created = filters.create(userId='me', body=spec, fields=FIELDS['filters.create']).execute()
+            state[filter_key(spec)] = created['id']
+        _save_state(state_file, state)
+        for rule in rules:
+            if bool(rule.get('server_filter')) != (rule['id'] in pushed_ids):
+                store.update(rule['id'], dict(rule, server_filter=rule['id'] in pushed_ids))
+
+    return {
+        'created': len(to_create),
+        'deleted': len(to_delete),
+        'unchanged': len(desired) - len(to_create),
+        'pushed_rules': sorted(pushed_ids),
+        'client_rules': len(rules) - len(pushed_ids),
+    }
+
+def filter_to_rule(gmail_filter: Dict[str, Any], labels) -> Tuple[Optional[Dict[str, Any]], str]:
+    """Convert a Gmail filter into a rule definition, or None and the reason it cannot be."""
+    criteria = gmail_filter.get('criteria', {})
+    action = gmail_filter.get('action', {})
+    conditions = []
+    for field, key in FILTER_HEADER_CRITERIA.items():
+        if criteria.get(key):
+            conditions.append({'field': field, 'operator': 'contains', 'value': criteria[key]})
+    if criteria.get('size'):
+        operator = 'larger than' if criteria.get('sizeComparison') == 'larger' else 'smaller than'
+        conditions.append({'field': 'Size', 'operator': operator, 'value': str(criteria['size'])})
+    if criteria.get('hasAttachment'):
+        conditions.append({'field': 'Attachment', 'operator': 'present', 'value': ''})
+    query = criteria.get('query', '')
+    if query:
+        if not (query.startswith('"') and query.endswith('"') and len(query) > 2):
+            return None, f"search query {query!r} has no rule equivalent"
+        conditions.append({'field': 'Body', 'operator': 'contains', 'value': json.loads(query)})
+    if criteria.get('negatedQuery') or criteria.get('excludeChats'):
+        return None, "negated queries have no rule equivalent"
+    if not conditions:
+        return None, "no conditions"
+
+    added = sorted(action.get('addLabelIds', []))
+    removed = sorted(action.get('removeLabelIds', []))
+    fixed = [action_type for action_type, delta in FIXED_ACTIONS.items() if delta == (added, removed)]
+    if action.get('forward') or not (fixed or (len(added) == 1 and removed in ([], ['INBOX']))):
+        return None, ("only filters that add one label (optionally skipping the inbox), or archive, mark read, "
+                      "star, mark important or trash, can be imported")
+    rule = {
+        'condition_field': conditions[0]['field'],
+        'condition_operator': conditions[0]['operator'],
+        'condition_value': conditions[0]['value'],
+    }
+    if fixed:
+        rule.update(action_type=fixed[0], action_value='')
+    else:
+        rule.update(action_type='Move to' if removed else 'Label as',
+                    action_value=added[0] if added[0].startswith('CATEGORY_') else labels.name_for(added[0]))
+    if conditions[1:]:
+        rule['conditions'] = conditions[1:]
+    return rule, ''
+
+def import_filters(service, store, log_func=None, controller: Optional[RunController] = None) -> List[str]:
+    """Add a rule for every Gmail filter that has one and no matching rule yet.
+
+    Returns the IDs of the new rules; filters with no rule equivalent are
+    logged and left alone.
+    """
+    if log_func is None:
+        log_func = logger.info
+    labels = label_table(service)
+    labels.ensure_loaded(controller)
+    known = set()
+    for rule, criteria, _ in eligible_rules(store.all()):
+        if criteria is not None:
+            known.add(filter_key({'criteria': criteria,
+                                  'action': _action(service, rule, controller, create_labels=False)}))
+
+    new_rules = []
+    for gmail_filter in list_filters(service, controller):
+        rule, reason = filter_to_rule(gmail_filter, labels)
+        if rule is None:
+            log_func(f"Skipped filter {gmail_filter['id']}: {reason}")
+        elif filter_key(gmail_filter) not in known:
+            # The filter already enforces this rule on new mail, if it matches the same mail
+            new_rules.append(dict(rule, server_filter=_criteria(rule)[0] is not None))
+            known.add(filter_key(gmail_filter))
+    ids = store.import_rules(new_rules) if new_rules else []
+    log_func(f"Imported {len(ids)} rules from Gmail filters")
+    return ids
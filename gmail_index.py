@@ -0,0 +1,224 @@
+import re
+import json
+import time
+import sqlite3
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Set
+
+from gmail_conditions import create_condition, rule_conditions, query_term, HEADER_OPERATORS
+from gmail_apply_rules import FIELDS
+
+logger = logging.getLogger(__name__)
+
+HEADER_INDEX_FILE = 'header_index.db'
+
+# Headers kept per message, and therefore searchable in previews.
+INDEXED_HEADERS = ['From', 'To', 'Subject']
+
+# Below this many messages the index is too cold to preview against.
+MIN_INDEXED_MESSAGES = 100
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+def tokenize(text: str) -> Set[str]:
+    return set(TOKEN_PATTERN.findall(text.lower()))
+
+class HeaderIndex:
+    """Local index of message headers and labels, filled in by processing runs.
+
+    Records are stored in SQLite and kept in memory with posting lists per
+    header token and label, so a draft rule can be previewed without
+    touching the mailbox.
+    """
+
+    def __init__(self, index_file: Optional[str] = HEADER_INDEX_FILE):
+        self.index_file = index_file
+        self.headers = INDEXED_HEADERS
+        self.records: Dict[str, Dict[str, Any]] = {}
+        # header -> token -> message IDs, and label ID -> message IDs
+        self.tokens: Dict[str, Dict[str, Set[str]]] = {header: {} for header in INDEXED_HEADERS}
+        self.labels: Dict[str, Set[str]] = {}
+        self.pending: List[Dict[str, Any]] = []
+        self.lock = threading.Lock()
+        self.connection = None
+        if index_file:
+            self.connection = sqlite3.connect(index_file, check_same_thread=False)
+            self.connection.execute('CREATE TABLE IF NOT EXISTS messages (id TEXT PRIMARY KEY, record TEXT NOT NULL)')
+            self.load()
+
+    def load(self) -> None:
+        start = time.perf_counter()
+        for (record,) in self.connection.execute('SELECT record FROM messages'):
+            self._index(json.loads(record))
+        logger.info(f"Loaded {len(self.records)} messages into the header index in {time.perf_counter() - start:.2f}s")
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    @property
+    def is_cold(self) -> bool:
+        return len(self.records) < MIN_INDEXED_MESSAGES
+
+    def _index(self, record: Dict[str, Any]) -> None:
+        old = self.records.get(record['id'])
+        if old:
+            self._unindex(old)
+        self.records[record['id']] = record
+        for header in INDEXED_HEADERS:
+            for token in tokenize(record['headers'].get(header, '')):
+                self.tokens[header].setdefault(token, set()).add(record['id'])
+        for label_id in record['labelIds']:
+            self.labels.setdefault(label_id, set()).add(record['id'])
+
+    def _unindex(self, record: Dict[str, Any]) -> None:
+        for header in INDEXED_HEADERS:
+            for token in tokenize(record['headers'].get(header, '')):
+                self.tokens[header].get(token, set()).discard(record['id'])
+        for label_id in record['labelIds']:
+            self.labels.get(label_id, set()).discard(record['id'])
+
+    def add(self, message: Dict[str, Any]) -> None:
+        """Index a message fetched by the engine (metadata or full format)."""
+        headers = message.get('payload', {}).get('headers', [])
+        record = {
+            'id': message['id'],
+            'threadId': message.get('threadId'),
+            'headers': {h['name']: h['value'] for h in headers if h['name'] in INDEXED_HEADERS},
+            'labelIds': list(message.get('labelIds', [])),
+            'internalDate': message.get('internalDate'),
+            'sizeEstimate': message.get('sizeEstimate', 0),
+            'mimeType': message.get('payload', {}).get('mimeType', ''),
+        }
+        with self.lock:
+            self._index(record)
+            self.pending.append(record)
+
+    def flush(self) -> None:
+        """Write records added since the last flush."""
+        if not self.connection:
+            return
+        with self.lock:
+            pending, self.pending = self.pending, []
+            self.connection.executemany(
+                'INSERT OR REPLACE INTO messages (id, record) VALUES (?, ?)',
+                [(record['id'], json.dumps(record)) for record in pending]
+            )
+            self.connection.commit()
+
+    def as_message(self, record: Dict[str, Any], label_names: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+        """Rebuild the message shape that conditions read from a record."""
+        label_names = label_names or {}
+        return {
+            'id': record['id'],
+            'labelIds': record['labelIds'],
+            'labelNames': [label_names.get(label_id, label_id) for label_id in record['labelIds']],
+            'internalDate': record['internalDate'],
+            'sizeEstimate': record['sizeEstimate'],
+            'payload': {
+                'mimeType': record['mimeType'],
+                'headers': [{'name': name, 'value': value} for name, value in record['headers'].items()],
+            },
+        }
+
+    def _candidates(self, condition: Dict[str, Any], label_ids: Dict[str, str]) -> Optional[Set[str]]:
+        """Return a superset of the IDs a condition can match, or None to scan everything."""
+        field = condition['field']
+        if field in INDEXED_HEADERS and condition['operator'] in HEADER_OPERATORS:
+            words = tokenize(condition['value'])
+            if not words:
+                return None
+            # Every word of the value must be part of some token of the header
+            candidates = None
+            for word in words:
+                matches = set()
+                for token, ids in self.tokens[field].items():
+                    if word in token:
+                        matches |= ids
+                candidates = matches if candidates is None else candidates & matches
+            return candidates
+        if field == 'Label' and condition['operator'] == 'has':
+            label_id = label_ids.get(condition['value'].lower(), condition['value'])
+            return set(self.labels.get(label_id, set()))
+        return None
+
+    def preview(self, rule: Dict[str, Any], label_names: Optional[Dict[str, str]] = None,
+                sample_size: int = 10) -> Dict[str, Any]:
+        """Count indexed messages matching a draft rule and return a few samples.
+
+        Body conditions cannot be checked locally and are left out, so the
+        count is an upper bound for rules that have them.
+        """
+        start = time.perf_counter()
+        label_names = label_names or {}
+        label_ids = {name.lower(): label_id for label_id, name in label_names.items()}
+        conditions = rule_conditions(rule)
+        local = [c for c in conditions if c['field'] != 'Body']
+        with self.lock:
+            candidates = None
+            for condition in local:
+                ids = self._candidates(condition, label_ids)
+                if ids is not None:
+                    candidates = ids if candidates is None else candidates & ids
+            records = [self.records[i] for i in candidates] if candidates is not None else list(self.records.values())
+            total = len(self.records)
+
+        matched = []
+        if local:
+            draft = {
+                'condition_field': local[0]['field'],
+                'condition_operator': local[0]['operator'],
+                'condition_value': local[0]['value'],
+                'conditions': local[1:],
+            }
+            condition = create_condition(draft)
+            matched = [record for record in records if condition(self.as_message(record, label_names))]
+        else:
+            matched = records
+        matched.sort(key=lambda record: int(record['internalDate'] or 0), reverse=True)
+        return {
+            'source': 'index',
+            'count': len(matched),
+            'indexed': total,
+            'samples': [record['headers'] for record in matched[:sample_size]],
+            'body_unchecked': len(local) < len(conditions),
+            'elapsed': time.perf_counter() - start,
+        }
+
+def preview_query(rule: Dict[str, Any]) -> str:
+    """Return a Gmail query approximating a rule, for server-side estimates.
+
+    Unlike rule_query this includes word searches for header and body
+    conditions, which are close enough for a count estimate.
+    """
+    terms = []
+    for condition in rule_conditions(rule):
+        term = query_term(condition)
+        if term:
+            terms.append(term)
+        elif condition['field'] == 'Body':
+            terms.append(json.dumps(condition['value']))
+        elif condition['field'] in INDEXED_HEADERS:
+            terms.append(f"{condition['field'].lower()}:{json.dumps(condition['value'])}")
+    return " ".join(terms)
+
+def estimate_on_server(service, rule: Dict[str, Any], sample_size: int = 5) -> Dict[str, Any]:
+    """Ask Gmail for resultSizeEstimate and a few samples of a rule's query."""
+    start = time.perf_counter()
+    query = preview_query(rule)
+    response = service.users().messages().list(userId='me', q=query, maxResults=sample_size,
+                                               fields=f"{FIELDS['messages.list']},resultSizeEstimate").execute()
+    samples = []
+    for message in response.get('messages', []):
+        metadata = service.users().messages().get(
+            userId='me', id=message['id'], format='metadata', metadataHeaders=INDEXED_HEADERS,
+            fields='payload/headers'
+        ).execute()
+        samples.append({h['name']: h['value'] for h in metadata.get('payload', {}).get('headers', [])})
+    return {
+        'source': 'server',
+        'query': query,
+        'count': response.get('resultSizeEstimate', 0),
+        'samples': samples,
+        'elapsed': time.perf_counter() - start,
+    }
@@ -0,0 +1,171 @@
+import time
+import uuid
+import sqlite3
+import logging
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+from gmail_apply_rules import BATCH_MODIFY_SIZE, RunController, default_controller
+
+logger = logging.getLogger(__name__)
+
+JOURNAL_FILE = 'journal.db'
+
+# Journal rows buffered in memory before they are written.
+JOURNAL_FLUSH_SIZE = 500
+
+class MutationJournal:
+    """Append-only log of the label changes each run made, for undoing runs.
+
+    Every message change is one row: run ID, message ID, and the label IDs
+    actually added and removed. Rows are only ever inserted; undoing a run
+    marks the run as undone in a separate table and records the reverting
+    changes as a run of their own.
+    """
+
+    def __init__(self, journal_file: str = JOURNAL_FILE):
+        self.journal_file = journal_file
+        self.lock = threading.Lock()
+        self.pending: List[Tuple[str, str, str, str]] = []
+        self.connection = sqlite3.connect(journal_file, check_same_thread=False)
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                started REAL NOT NULL,
+                description TEXT NOT NULL,
+                undone REAL
+            );
+            CREATE TABLE IF NOT EXISTS mutations (
+                run_id TEXT NOT NULL,
+                message_id TEXT NOT NULL,
+                added TEXT NOT NULL,
+                removed TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS mutations_run ON mutations (run_id);
+        ''')
+
+    def start_run(self, description: str = '') -> str:
+        """Register a new run and return its ID."""
+        run_id = uuid.uuid4().hex[:12]
+        with self.lock:
+            self.connection.execute('INSERT INTO runs (run_id, started, description) VALUES (?, ?, ?)',
+                                    (run_id, time.time(), description))
+            self.connection.commit()
+        return run_id
+
+    def record(self, run_id: str, message_id: str, added: List[str], removed: List[str]) -> None:
+        if not added and not removed:
+            return
+        with self.lock:
+            self.pending.append((run_id, message_id, ','.join(added), ','.join(removed)))
+            full = len(self.pending) >= JOURNAL_FLUSH_SIZE
+        if full:
+            self.flush()
+
+    def flush(self) -> None:
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if pending:
+                self.connection.executemany(
+                    'INSERT INTO mutations (run_id, message_id, added, removed) VALUES (?, ?, ?, ?)', pending)
+                self.connection.commit()
+
+    def runs(self, limit: int = 20) -> List[Dict[str, Any]]:
+        """Return the most recent runs, newest first, with their change counts."""
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute('''
+                SELECT runs.run_id, started, description, undone, COUNT(mutations.run_id)
+                FROM runs LEFT JOIN mutations ON mutations.run_id = runs.run_id
+                GROUP BY runs.run_id ORDER BY started DESC LIMIT ?
+            ''', (limit,)).fetchall()
+        return [
+            {'run_id': run_id, 'started': started, 'description': description, 'undone': undone, 'changes': changes}
+            for run_id, started, description, undone, changes in rows
+        ]
+
+    def run(self, run_id: str) -> Optional[Dict[str, Any]]:
+        """Return a run's ID, start time, description and undo time, or None if there is no such run."""
+        with self.lock:
+            row = self.connection.execute('SELECT run_id, started, description, undone FROM runs WHERE run_id = ?',
+                                          (run_id,)).fetchone()
+        if row is None:
+            return None
+        return dict(zip(('run_id', 'started', 'description', 'undone'), row))
+
+    def net_changes(self, run_id: str) -> Dict[str, Tuple[set, set]]:
+        """Return each message's net (added, removed) label IDs over a run."""
+        self.flush()
+        with self.lock:
+            rows = self.connection.execute(
+                'SELECT message_id, added, removed FROM mutations WHERE run_id = ? ORDER BY rowid', (run_id,)
+            ).fetchall()
+        changes: Dict[str, Tuple[set, set]] = {}
+        for message_id, added, removed in rows:
+            net_added, net_removed = changes.setdefault(message_id, (set(), set()))
+            for label_id in filter(None, added.split(',')):
+                if label_id in net_removed:
+                    net_removed.discard(label_id)
+                else:
+                    net_added.add(label_id)
+            for label_id in filter(None, removed.split(',')):
+                if label_id in net_added:
+                    net_added.discard(label_id)
+                else:
+                    net_removed.add(label_id)
+        return changes
+
+    def mark_undone(self, run_id: str) -> None:
+        with self.lock:
+            self.connection.execute('UPDATE runs SET undone = ? WHERE run_id = ?', (time.time(), run_id))
+            self.connection.commit()
+
+    def close(self) -> None:
+        self.flush()
+        self.connection.close()
+
+def undo_run(service, journal: MutationJournal, run_id: str, log_func=None,
+             controller: Optional[RunController] = None) -> int:
+    """Revert the label changes of a run and return how many messages were restored.
+
+    Messages that need the same inverse change are grouped, so each
+    batchModify call restores up to 1000 of them. The reverting changes are
+    journaled as a new run, which can be undone in turn. Raises ValueError
+    for an unknown run or one that was already undone.
+    """
+    if log_func is None:
+        log_func = logger.info
+    if controller is None:
+        controller = default_controller
+    run = journal.run(run_id)
+    if run is None:
+        raise ValueError(f"No run {run_id} in the journal")
+    if run['undone'] is not None:
+        undone = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(run['undone']))
+        raise ValueError(f"Run {run_id} was already undone on {undone}")
+    groups: Dict[Tuple[Tuple[str, ...], Tuple[str, ...]], List[str]] = {}
+    for message_id, (added, removed) in journal.net_changes(run_id).items():
+        if added or removed:
+            # Undo removes what the run added and adds back what it removed
+            groups.setdefault((tuple(sorted(removed)), tuple(sorted(added))), []).append(message_id)
+
+    undo_id = journal.start_run(f"undo of run {run_id}")
+    restored = 0
+    for (add_label_ids, remove_label_ids), message_ids in groups.items():
+        for start in range(0, len(message_ids), BATCH_MODIFY_SIZE):
+            controller.check_pause(log_func)
+            controller.consume('messages.batchModify')
+            batch = message_ids[start:start + BATCH_MODIFY_SIZE]
+            service.users().messages().batchModify(userId='me', body={
+                'ids': batch,
+                'addLabelIds': list(add_label_ids),
+                'removeLabelIds': list(remove_label_ids),
+            }).execute()
+            for message_id in batch:
+                journal.record(undo_id, message_id, list(add_label_ids), list(remove_label_ids))
+            restored += len(batch)
+            log_func(f"Restored {restored} messages from run {run_id}")
+    journal.flush()
+    journal.mark_undone(run_id)
+    log_func(f"Undid run {run_id}: {restored} messages in {len(groups)} groups, recorded as run {undo_id}")
+    return restored
@@ -1,25 +1,115 @@
 import os
-import datetime
-from datetime import UTC
-from dateutil.relativedelta import relativedelta
 import google.auth
-from google.auth.transport.requests import Request
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import InstalledAppFlow
-from googleapiclient.discovery import build
 import wx
 import threading
+import time
+import multiprocessing
 import json
+from concurrent.futures import ThreadPoolExecutor
 import gmail_apply_rules
-from gmail_apply_rules import GmailRule
+import gmail_rule_store
+import gmail_index
+import gmail_profiler
+import gmail_journal
+import gmail_filters
+import gmail_cassette
+import gmail_analytics
+from gmail_conditions import CONDITION_OPERATORS, VALUELESS_FIELDS, describe_condition, describe_conditions, validate_condition
 
-# If modifying these SCOPES, delete the file token.json.
-SCOPES = ['https://www.googleapis.com/auth/gmail.modify']
+# Background threads for the Gmail API calls the window makes.
+GUI_API_WORKERS = 4
+
+class ApiCallback:
+    def __init__(self, on_done, on_error, group):
+        self.on_done = on_done
+        self.on_error = on_error
+        self.group = group
+        self.cancelled = False
+
+class ApiExecutor:
+    """Runs the window's Gmail API calls on background threads.
+
+    Results are handed to `on_done` (and errors to `on_error`, or a message
+    box) on the UI thread with wx.CallAfter. Calls submitted with the same
+    `key` while one is in flight share it, so the API is called once and
+    every caller gets the result. Cancelling a group, such as the panel of
+    a tab being left, drops the callbacks made for it; queued calls nobody
+    waits for any more are not sent, and results of calls already sent are
+    discarded. The workers share the window's service, which gives every
+    thread its own connection (see gmail_apply_rules.build_service).
+    """
+
+    def __init__(self, workers=GUI_API_WORKERS):
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='gmail-api')
+        self.lock = threading.Lock()
+        self.inflight = {}  # key -> (future, callbacks)
+        self.callbacks = {}  # future -> callbacks
+
+    def submit(self, fn, on_done=None, error_message="Gmail request failed", on_error=None, key=None, group=None):
+        if on_error is None:
+            on_error = lambda error: wx.MessageBox(f"{error_message}: {error}", "Error", wx.OK | wx.ICON_ERROR)
+        callback = ApiCallback(on_done, on_error, group)
+        with self.lock:
+            if key is not None and key in self.inflight:
+                future, callbacks = self.inflight[key]
+                callbacks.append(callback)
+                return future
+            callbacks = [callback]
+            future = self.pool.submit(fn)
+            self.callbacks[future] = callbacks
+            if key is not None:
+                self.inflight[key] = (future, callbacks)
+        future.add_done_callback(lambda future: self._finished(future, key))
+        return future
+
+    def _finished(self, future, key):
+        with self.lock:
+            callbacks = self.callbacks.pop(future, [])
+            if key is not None and self.inflight.get(key, (None,))[0] is future:
+                del self.inflight[key]
+        if future.cancelled():
+            return
+        error = future.exception()
+        for callback in callbacks:
+            wx.CallAfter(self._deliver, callback, future.result() if error is None else None, error)
+
+    def _deliver(self, callback, result, error):
+        # Checked on the UI thread, where cancel() runs, so a cancelled callback never fires
+        if callback.cancelled:
+            return
+        if error is not None:
+            callback.on_error(str(error))
+        elif callback.on_done:
+            callback.on_done(result)
+
+    def cancel(self, group=None):
+        """Drop the callbacks made for `group`, or every callback if None."""
+        unwanted = []
+        with self.lock:
+            for future, callbacks in self.callbacks.items():
+                for callback in callbacks:
+                    if group is None or callback.group is group:
+                        callback.cancelled = True
+                if all(callback.cancelled for callback in callbacks):
+                    unwanted.append(future)
+        # Outside the lock, since cancelling runs _finished
+        for future in unwanted:
+            future.cancel()
+
+    def shutdown(self):
+        """Cancel everything and let the threads finish in the background."""
+        self.cancel()
+        self.pool.shutdown(wait=False)
 
 class MainApp(wx.App):
     def OnInit(self):
         self.frame = None
-        self.show_auth_frame()
+        # GMAIL_REPLAY runs the window against a recorded cassette, offline
+        replay = gmail_cassette.replay_from_environment()
+        if replay is not None:
+            self.show_main_frame(replay)
+        else:
+            self.show_auth_frame()
         return True
         
     def show_auth_frame(self):
@@ -89,7 +179,7 @@ class AuthFrame(wx.Frame):
         
         def auth_thread():
             try:
-                service = authenticate_gmail()
+                service = gmail_cassette.record_from_environment(authenticate_gmail())
                 wx.CallAfter(self.on_auth_success, service)
             except Exception as e:
                 wx.CallAfter(self.on_auth_error)
@@ -121,6 +211,18 @@ class MainFrame(wx.Frame):
         super().__init__(parent=None, title='Gmail Labeler', size=(800, 600))
         self.app = app
         self.service = service
+        self.controller = gmail_apply_rules.RunController()
+        self.executor = ApiExecutor()
+        self.header_index = gmail_index.HeaderIndex()
+        self.journal = gmail_journal.MutationJournal()
+        # Kept next to the rule store: per-rule costs that order evaluation, and
+        # which mail each rule has been evaluated against, so unchanged rules skip the backlog
+        self.stats = gmail_apply_rules.RuleStats(gmail_apply_rules.stats_file_for(gmail_rule_store.RULES_DB_FILE))
+        self.ledger = gmail_apply_rules.EvaluationLedger(
+            gmail_apply_rules.ledger_file_for(gmail_rule_store.RULES_DB_FILE))
+        # Columnar sender, subject and label metadata behind the rule suggestions
+        self.metadata_export = gmail_analytics.MetadataExport()
+        self.last_run_id = None
         
         # Set minimum window size to ensure buttons fit
         # Width: 3 buttons (150px each) + margins (20px each) + padding (20px each side) = ~550px
@@ -177,6 +279,20 @@ class MainFrame(wx.Frame):
         
         operations_sizer.Add(button_container, 0, wx.ALIGN_CENTER | wx.ALL, 20)
         
+        # Opt-in profiling for diagnosing slow runs
+        options_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        self.profile_checkbox = wx.CheckBox(operations_panel, label="Profile this run (writes a report to the profiles folder)")
+        options_sizer.Add(self.profile_checkbox, 1, wx.ALIGN_CENTER_VERTICAL)
+        self.full_run_checkbox = wx.CheckBox(operations_panel, label="Re-check all mail with every rule")
+        options_sizer.Add(self.full_run_checkbox, 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 10)
+        
+        # Revert every label change the last run made
+        self.undo_button = wx.Button(operations_panel, label="Undo Last Run")
+        self.undo_button.Bind(wx.EVT_BUTTON, self.on_undo_run)
+        self.undo_button.Disable()
+        options_sizer.Add(self.undo_button, 0)
+        operations_sizer.Add(options_sizer, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 20)
+        
         # Status text
         self.status_text = wx.TextCtrl(operations_panel, style=wx.TE_MULTILINE | wx.TE_READONLY)
         operations_sizer.Add(self.status_text, 1, wx.EXPAND | wx.ALL, 20)
@@ -184,47 +300,69 @@ class MainFrame(wx.Frame):
         operations_panel.SetSizer(operations_sizer)
         
         # Rules tab
-        self.rules_panel = RulesPanel(self.notebook, self.service)
+        self.rules_panel = RulesPanel(self.notebook, self.service, self.executor, self.header_index)
         
         # Labels tab
-        self.labels_panel = LabelsPanel(self.notebook, self.service)
+        self.labels_panel = LabelsPanel(self.notebook, self.service, self.executor)
         
         # Settings tab
-        self.settings_panel = SettingsPanel(self.notebook, self.service, self.app)
+        self.settings_panel = SettingsPanel(self.notebook, self.service, self.app, self.executor)
         
         # Add tabs to notebook
         self.notebook.AddPage(operations_panel, "Operations")
         self.notebook.AddPage(self.rules_panel, "Rules")
         self.notebook.AddPage(self.labels_panel, "Labels")
         self.notebook.AddPage(self.settings_panel, "Settings")
+        self.notebook.Bind(wx.EVT_NOTEBOOK_PAGE_CHANGED, self.on_page_changed)
         
         vbox.Add(self.notebook, 1, wx.EXPAND | wx.ALL, 5)
         
         panel.SetSizer(vbox)
         self.Centre()
         
+    def on_page_changed(self, event):
+        # Requests made for the tab being left are no longer wanted
+        old_page = self.notebook.GetPage(event.GetOldSelection()) if event.GetOldSelection() != wx.NOT_FOUND else None
+        if old_page is not None:
+            self.executor.cancel(group=old_page)
+        new_page = self.notebook.GetPage(event.GetSelection())
+        if hasattr(new_page, 'on_show'):
+            new_page.on_show()
+        event.Skip()
+        
     def on_start_processing(self, event):
         self.power_button.Disable()
         self.pause_button.Enable()
         self.stop_button.Enable()
         self.status_text.AppendText("Starting to process emails...\n")
+        profiler = None
+        if self.profile_checkbox.GetValue():
+            profiler = gmail_profiler.RunProfiler(use_cprofile=True, trace_memory=True)
+        if self.full_run_checkbox.GetValue():
+            self.ledger.reset()
         
         def process_thread():
             try:
-                gmail_apply_rules.set_pause(False)  # Ensure we start unpaused
+                self.controller.set_pause(False)  # Ensure we start unpaused
                 
                 # Get rules from the rules panel
-                rules = []
-                for rule_data in self.rules_panel.get_rules():
-                    rules.append(GmailRule(
-                        name=rule_data['name'],
-                        condition=rule_data['condition'],
-                        action=rule_data['action']
-                    ))
+                rules = self.rules_panel.get_rules()
                 
                 # Apply the rules with UI logging
-                gmail_apply_rules.apply_rules(self.service, rules, log_func=self.log)
-                wx.CallAfter(self.on_processing_complete)
+                # Heavy rulesets are matched in worker processes so this thread and the UI stay responsive
+                summary = gmail_apply_rules.apply_rules(self.service, rules, log_func=self.log, controller=self.controller,
+                                                        stats=self.stats,
+                                                        eval_workers=gmail_apply_rules.default_eval_workers(rules),
+                                                        index=self.header_index, profiler=profiler,
+                                                        journal=self.journal, ledger=self.ledger,
+                                                        tuner=gmail_apply_rules.AdaptiveTuner(),
+                                                        export=self.metadata_export)
+                self.last_run_id = summary['run_id']
+                if profiler:
+                    text_path, json_path = profiler.write_report()
+                    self.log(f"Profile written to {text_path} and {json_path}")
+                changed = set(summary['changed_labels'])
+                wx.CallAfter(self.on_processing_complete, changed, summary['status'])
             except Exception as e:
                 wx.CallAfter(self.on_processing_error, str(e))
         
@@ -232,29 +370,59 @@ class MainFrame(wx.Frame):
         
     def on_pause(self, event):
         if self.pause_button.GetLabel() == "⏸\nPause":
-            gmail_apply_rules.set_pause(True)
+            self.controller.set_pause(True)
             self.pause_button.SetLabel("▶\nResume")
             self.status_text.AppendText("Processing paused...\n")
         else:
-            gmail_apply_rules.set_pause(False)
+            self.controller.set_pause(False)
             self.pause_button.SetLabel("⏸\nPause")
             self.status_text.AppendText("Processing resumed...\n")
             
     def on_stop(self, event):
-        gmail_apply_rules.set_stop()
+        # The run winds down in milliseconds and reports back through on_processing_complete
+        self.controller.set_stop()
         self.status_text.AppendText("Stopping processing...\n")
-        self.power_button.Enable()
         self.pause_button.Disable()
         self.stop_button.Disable()
         self.pause_button.SetLabel("⏸\nPause")
         
-    def on_processing_complete(self):
-        self.status_text.AppendText("Processing completed!\n")
+    def on_processing_complete(self, changed_labels=(), status='complete'):
+        self.status_text.AppendText("Processing stopped.\n" if status == 'stopped' else "Processing completed!\n")
+        self.undo_button.Enable(self.last_run_id is not None)
+        # Only the labels the run touched need their counts fetched again
+        self.labels_panel.refresh_counts(changed_labels, invalidate=True)
+        self.settings_panel.update_account_info()
         self.power_button.Enable()
         self.pause_button.Disable()
         self.stop_button.Disable()
         self.pause_button.SetLabel("⏸\nPause")
         
+    def on_undo_run(self, event):
+        msg = f"Revert every label change made by the last run ({self.last_run_id})?"
+        if wx.MessageBox(msg, "Undo Last Run", wx.YES_NO | wx.ICON_QUESTION) != wx.YES:
+            return
+        self.undo_button.Disable()
+        self.power_button.Disable()
+        run_id = self.last_run_id
+        
+        def undo():
+            self.controller.reset()
+            return gmail_journal.undo_run(self.service, self.journal, run_id, log_func=self.log,
+                                          controller=self.controller)
+        
+        self.executor.submit(undo, on_done=lambda restored: self.on_undo_complete(None),
+                             on_error=self.on_undo_complete)
+        
+    def on_undo_complete(self, error):
+        if error:
+            self.status_text.AppendText(f"Error undoing run: {error}\n")
+            self.undo_button.Enable()
+        else:
+            self.last_run_id = None
+            self.status_text.AppendText("Run undone.\n")
+            self.labels_panel.refresh_counts(invalidate=True)
+        self.power_button.Enable()
+        
     def on_processing_error(self, error):
         self.status_text.AppendText(f"Error: {error}\n")
         self.power_button.Enable()
@@ -265,10 +433,122 @@ class MainFrame(wx.Frame):
     def log(self, message):
         wx.CallAfter(self.status_text.AppendText, f"{message}\n")
 
+class VirtualListCtrl(wx.ListCtrl):
+    """Report list that draws only the visible rows from an in-memory model.
+
+    `row_text(item)` returns the column strings for a model item and `key(item)`
+    a stable identity. Filtering, sorting and updates work on an index of
+    visible items, and only rows whose text actually changed are redrawn.
+    """
+
+    def __init__(self, parent, columns, row_text, key, style=wx.LC_SINGLE_SEL):
+        super().__init__(parent, style=wx.LC_REPORT | wx.LC_VIRTUAL | style)
+        for column, (title, width) in enumerate(columns):
+            self.InsertColumn(column, title, width=width)
+        self.row_text = row_text
+        self.key = key
+        self.items = {}  # key -> model item
+        self.rows = {}  # key -> column strings
+        self.search_text = {}  # key -> lowercased text searched by the filter
+        self.visible = []  # keys in display order
+        self.filter_text = ""
+        self.sort_column = None
+        self.sort_ascending = True
+        self.Bind(wx.EVT_LIST_COL_CLICK, self.on_col_click)
+
+    def OnGetItemText(self, item, column):
+        return self.rows[self.visible[item]][column]
+
+    def set_items(self, items):
+        """Replace the model, redrawing only rows that were added or changed."""
+        self.items = {self.key(item): item for item in items}
+        rows = {}
+        for key, item in self.items.items():
+            rows[key] = self.row_text(item)
+            if self.rows.get(key) != rows[key]:
+                self.search_text[key] = " ".join(rows[key]).lower()
+        for key in set(self.search_text) - set(rows):
+            del self.search_text[key]
+        old_rows = self.rows
+        self.rows = rows
+        self._update_visible(list(self.items), old_rows)
+
+    def set_filter(self, text):
+        """Show only rows containing `text`; narrowing a filter only rescans visible rows."""
+        text = text.strip().lower()
+        candidates = self.visible if self.filter_text and text.startswith(self.filter_text) else list(self.items)
+        self.filter_text = text
+        self._update_visible(candidates, self.rows)
+
+    def on_col_click(self, event):
+        column = event.GetColumn()
+        self.sort_ascending = not self.sort_ascending if column == self.sort_column else True
+        self.sort_column = column
+        self._update_visible(self.visible, self.rows)
+
+    def _sort_key(self, key):
+        text = self.rows[key][self.sort_column]
+        # Numeric columns such as priority or message counts ("1,234") sort by value
+        try:
+            return (0, float(text.replace(',', '')), "")
+        except ValueError:
+            return (1, 0, text.lower())
+
+    def _update_visible(self, candidates, old_rows):
+        selected_indexes = self.selected_indexes()
+        selected = [self.visible[index] for index in selected_indexes if index < len(self.visible)]
+        old_visible = self.visible
+        visible = [key for key in candidates if self.filter_text in self.search_text[key]]
+        if self.sort_column is not None:
+            visible.sort(key=self._sort_key, reverse=not self.sort_ascending)
+        self.visible = visible
+
+        if len(visible) != len(old_visible):
+            self.SetItemCount(len(visible))
+        changed = [index for index, key in enumerate(visible)
+                   if index >= len(old_visible) or old_visible[index] != key or old_rows.get(key) != self.rows[key]]
+        if changed:
+            self.RefreshItems(changed[0], changed[-1])
+
+        # Keep the selection on the same items after filtering or sorting
+        positions = {key: index for index, key in enumerate(visible)}
+        for index in selected_indexes:
+            if index < len(visible):
+                self.SetItemState(index, 0, wx.LIST_STATE_SELECTED)
+        for key in selected:
+            if key in positions:
+                self.SetItemState(positions[key], wx.LIST_STATE_SELECTED, wx.LIST_STATE_SELECTED)
+
+    def selected_indexes(self):
+        indexes = []
+        index = self.GetFirstSelected()
+        while index != -1:
+            indexes.append(index)
+            index = self.GetNextSelected(index)
+        return indexes
+
+    def selected_keys(self):
+        return [self.visible[index] for index in self.selected_indexes() if index < len(self.visible)]
+
+    def selected_items(self):
+        """Return the model items of the selected rows."""
+        return [self.items[key] for key in self.selected_keys() if key in self.items]
+
+def rule_row(rule):
+    action = gmail_apply_rules.describe_action(rule)
+    stop = "Yes" if rule.get('stop_processing') else ""
+    if rule.get('server_filter'):
+        action += " (Gmail filter)"
+    return [str(rule.get('priority', 0)), describe_conditions(rule), action, stop]
+
 class RulesPanel(wx.Panel):
-    def __init__(self, parent, service):
+    def __init__(self, parent, service, executor, header_index=None):
         super().__init__(parent)
         self.service = service  # Get the Gmail service directly from the parameter
+        self.executor = executor
+        self.header_index = header_index
+        self.store = gmail_rule_store.RuleStore()
+        self.compiled_rules = gmail_apply_rules.CompiledRules(self.store)
         self.rules = self.load_rules()
         self.init_ui()
         
@@ -279,16 +559,46 @@ class RulesPanel(wx.Panel):
         rules_box = wx.StaticBox(self, label="Current Rules")
         rules_sizer = wx.StaticBoxSizer(rules_box, wx.VERTICAL)
         
-        # Add delete button above the list
+        # Add import, export and delete buttons above the list
+        list_buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        import_button = wx.Button(self, label="Import...")
+        import_button.Bind(wx.EVT_BUTTON, self.on_import_rules)
+        list_buttons_sizer.Add(import_button, 0, wx.RIGHT, 5)
+        export_button = wx.Button(self, label="Export...")
+        export_button.Bind(wx.EVT_BUTTON, self.on_export_rules)
+        list_buttons_sizer.Add(export_button, 0, wx.RIGHT, 5)
+        filters_button = wx.Button(self, label="Sync Gmail Filters...")
+        filters_button.Bind(wx.EVT_BUTTON, self.on_sync_filters)
+        list_buttons_sizer.Add(filters_button, 0, wx.RIGHT, 5)
+        optimizer_button = wx.Button(self, label="Optimizer Report...")
+        optimizer_button.Bind(wx.EVT_BUTTON, self.on_optimizer_report)
+        list_buttons_sizer.Add(optimizer_button, 0, wx.RIGHT, 5)
+        suggest_button = wx.Button(self, label="Suggest Rules...")
+        suggest_button.Bind(wx.EVT_BUTTON, self.on_suggest_rules)
+        list_buttons_sizer.Add(suggest_button, 0, wx.RIGHT, 5)
         delete_button = wx.Button(self, label="Delete Selected Rule")
         delete_button.Bind(wx.EVT_BUTTON, self.on_delete_rule)
-        rules_sizer.Add(delete_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
-        
-        self.rules_list = wx.ListCtrl(self, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
-        self.rules_list.InsertColumn(0, "Condition", width=300)
-        self.rules_list.InsertColumn(1, "Action", width=300)
+        list_buttons_sizer.Add(delete_button, 0)
+        rules_sizer.Add(list_buttons_sizer, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
+        
+        self.rules_filter = wx.SearchCtrl(self)
+        self.rules_filter.SetDescriptiveText("Filter rules")
+        self.rules_filter.Bind(wx.EVT_TEXT, lambda event: self.rules_list.set_filter(self.rules_filter.GetValue()))
+        rules_sizer.Add(self.rules_filter, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 5)
+        
+        self.rules_list = VirtualListCtrl(
+            self,
+            [("Priority", 60), ("Condition", 260), ("Action", 220), ("Stop", 50)],
+            row_text=rule_row,
+            key=lambda rule: rule['id']
+        )
         rules_sizer.Add(self.rules_list, 1, wx.EXPAND | wx.ALL, 5)
         
+        # What the run-time optimizer will drop or merge in the current rules
+        self.analysis = None
+        self.optimizer_text = wx.StaticText(self, label="")
+        rules_sizer.Add(self.optimizer_text, 0, wx.EXPAND | wx.LEFT | wx.RIGHT | wx.BOTTOM, 5)
+        
         # Add rule section
         add_rule_box = wx.StaticBox(self, label="Add New Rule")
         add_rule_sizer = wx.StaticBoxSizer(add_rule_box, wx.VERTICAL)
@@ -297,22 +607,34 @@ class RulesPanel(wx.Panel):
         condition_sizer = wx.BoxSizer(wx.HORIZONTAL)
         condition_sizer.Add(wx.StaticText(self, label="If"), 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
         
-        self.condition_field = wx.Choice(self, choices=["Subject", "From", "To"])
+        self.condition_field = wx.Choice(self, choices=list(CONDITION_OPERATORS))
+        self.condition_field.Bind(wx.EVT_CHOICE, self.on_condition_field)
         condition_sizer.Add(self.condition_field, 0, wx.RIGHT, 5)
         
-        self.condition_operator = wx.Choice(self, choices=["contains", "equals", "starts with", "ends with"])
+        self.condition_operator = wx.Choice(self, choices=CONDITION_OPERATORS['Subject'])
         condition_sizer.Add(self.condition_operator, 0, wx.RIGHT, 5)
         
         self.condition_value = wx.TextCtrl(self)
-        condition_sizer.Add(self.condition_value, 1)
+        self.condition_value.SetToolTip("Ages look like 30d, 2w, 6m or 1y; dates like 2024-01-31; sizes like 500K or 5M; body regexes are case-insensitive")
+        condition_sizer.Add(self.condition_value, 1, wx.RIGHT, 5)
+        
+        # Add the current condition and start another one that must also match
+        and_button = wx.Button(self, label="And...")
+        and_button.Bind(wx.EVT_BUTTON, self.on_add_condition)
+        condition_sizer.Add(and_button, 0)
         
         add_rule_sizer.Add(condition_sizer, 0, wx.EXPAND | wx.ALL, 5)
         
+        self.extra_conditions = []
+        self.extra_conditions_text = wx.StaticText(self, label="")
+        add_rule_sizer.Add(self.extra_conditions_text, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 5)
+        
         # Action
         action_sizer = wx.BoxSizer(wx.HORIZONTAL)
         action_sizer.Add(wx.StaticText(self, label="Then"), 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
         
-        self.action_type = wx.Choice(self, choices=["Label as", "Move to"])
+        self.action_type = wx.Choice(self, choices=gmail_apply_rules.ACTION_TYPES)
+        self.action_type.Bind(wx.EVT_CHOICE, self.on_action_type)
         action_sizer.Add(self.action_type, 0, wx.RIGHT, 5)
         
         # Replace text input with label choice
@@ -322,10 +644,25 @@ class RulesPanel(wx.Panel):
         
         add_rule_sizer.Add(action_sizer, 0, wx.EXPAND | wx.ALL, 5)
         
-        # Add rule button
+        # Priority and short-circuit options
+        options_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        options_sizer.Add(wx.StaticText(self, label="Priority"), 0, wx.ALIGN_CENTER_VERTICAL | wx.RIGHT, 5)
+        self.priority = wx.SpinCtrl(self, min=-100, max=100, initial=0)
+        options_sizer.Add(self.priority, 0, wx.RIGHT, 15)
+        self.stop_processing = wx.CheckBox(self, label="Stop processing further rules")
+        options_sizer.Add(self.stop_processing, 0, wx.ALIGN_CENTER_VERTICAL)
+        
+        add_rule_sizer.Add(options_sizer, 0, wx.EXPAND | wx.ALL, 5)
+        
+        # Preview and add rule buttons
+        buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        preview_button = wx.Button(self, label="Preview")
+        preview_button.Bind(wx.EVT_BUTTON, self.on_preview_rule)
+        buttons_sizer.Add(preview_button, 0, wx.RIGHT, 5)
         add_button = wx.Button(self, label="Add Rule")
         add_button.Bind(wx.EVT_BUTTON, self.on_add_rule)
-        add_rule_sizer.Add(add_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
+        buttons_sizer.Add(add_button, 0)
+        add_rule_sizer.Add(buttons_sizer, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
         
         # Add refresh button for labels
         refresh_button = wx.Button(self, label="Refresh Labels")
@@ -340,76 +677,277 @@ class RulesPanel(wx.Panel):
         self.update_rules_list()
         
     def update_label_choices(self):
-        try:
-            # Fetch labels from Gmail API
-            labels = self.service.users().labels().list(userId='me').execute().get('labels', [])
-            # Get all labels, including system labels
-            all_labels = [label['name'] for label in labels]
-            # Sort labels alphabetically
-            all_labels.sort()
-            # Update the choice control
-            self.action_value.SetItems(all_labels)
-            if all_labels:
-                self.action_value.SetSelection(0)
-        except Exception as e:
-            wx.MessageBox(f"Error fetching labels: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        """Fetch labels into the shared label table off the UI thread, then list them."""
+        table = gmail_apply_rules.label_table(self.service)
+        # Shares the request with the Labels tab when both refresh at once
+        self.executor.submit(table.refresh, lambda _: self.show_label_choices(table),
+                             "Error fetching labels", key='labels')
+        
+    def show_label_choices(self, table):
+        # Get all labels, including system labels
+        all_labels = [label['name'] for label in table.labels()]
+        # Sort labels alphabetically
+        all_labels.sort()
+        # Update the choice control
+        self.action_value.SetItems(all_labels)
+        if all_labels:
+            self.action_value.SetSelection(0)
         
     def on_refresh_labels(self, event):
         self.update_label_choices()
         
     def load_rules(self):
         try:
-            if os.path.exists('rules.json'):
-                with open('rules.json', 'r') as f:
-                    return json.load(f)
-        except Exception:
-            pass
+            return self.store.all()
+        except Exception as e:
+            wx.MessageBox(f"Error loading rules: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
         return []
         
-    def save_rules(self):
-        with open('rules.json', 'w') as f:
-            json.dump(self.rules, f)
+    def reload_rules(self):
+        """Re-read the rules, which also picks up changes made from the command line."""
+        self.rules = self.load_rules()
+        self.update_rules_list()
+        
+    def on_import_rules(self, event):
+        dlg = wx.FileDialog(self, "Import Rules", wildcard="JSON files (*.json)|*.json",
+                            style=wx.FD_OPEN | wx.FD_FILE_MUST_EXIST)
+        if dlg.ShowModal() == wx.ID_OK:
+            try:
+                with open(dlg.GetPath(), 'r') as f:
+                    ids = self.store.import_rules(json.load(f))
+                self.reload_rules()
+                wx.MessageBox(f"Imported {len(ids)} rules", "Success", wx.OK | wx.ICON_INFORMATION)
+            except Exception as e:
+                wx.MessageBox(f"Error importing rules: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        dlg.Destroy()
+        
+    def on_export_rules(self, event):
+        dlg = wx.FileDialog(self, "Export Rules", defaultFile="rules.json", wildcard="JSON files (*.json)|*.json",
+                            style=wx.FD_SAVE | wx.FD_OVERWRITE_PROMPT)
+        if dlg.ShowModal() == wx.ID_OK:
+            try:
+                count = self.store.export_rules(dlg.GetPath())
+                wx.MessageBox(f"Exported {count} rules", "Success", wx.OK | wx.ICON_INFORMATION)
+            except Exception as e:
+                wx.MessageBox(f"Error exporting rules: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        dlg.Destroy()
+            
+    def on_sync_filters(self, event):
+        choices = ["Push eligible rules to Gmail filters", "Import Gmail filters as rules"]
+        dlg = wx.SingleChoiceDialog(self, "Rules that only match on size or on a sender's complete address can be "
+                                    "applied by Gmail itself as mail arrives.",
+                                    "Gmail Filters", choices)
+        if dlg.ShowModal() == wx.ID_OK:
+            importing = dlg.GetSelection() == 1
+            
+            def sync():
+                if importing:
+                    ids = gmail_filters.import_filters(self.service, self.store)
+                    return f"Imported {len(ids)} rules from Gmail filters"
+                result = gmail_filters.sync_filters(self.service, self.store)
+                return (f"Created {result['created']} and deleted {result['deleted']} filters; "
+                        f"{len(result['pushed_rules'])} rules are now enforced by Gmail, "
+                        f"{result['client_rules']} stay with this app")
+            
+            self.executor.submit(sync, self.on_filters_synced, "Error syncing filters", key='filters')
+        dlg.Destroy()
+        
+    def on_filters_synced(self, message):
+        self.reload_rules()
+        wx.MessageBox(message, "Gmail Filters", wx.OK | wx.ICON_INFORMATION)
             
     def update_rules_list(self):
-        self.rules_list.DeleteAllItems()
-        for rule in self.rules:
-            condition = f"{rule['condition_field']} {rule['condition_operator']} '{rule['condition_value']}'"
-            action = f"{rule['action_type']} '{rule['action_value']}'"
-            self.rules_list.Append([condition, action])
+        self.rules_list.set_items(self.rules)
+        try:
+            self.analysis = gmail_apply_rules.analyze_rules(self.rules)
+            self.optimizer_text.SetLabel(f"Optimizer: {gmail_apply_rules.describe_analysis(self.analysis)}")
+        except Exception as e:
+            self.analysis = None
+            self.optimizer_text.SetLabel(f"Optimizer: could not analyze rules ({e})")
+        
+    def on_optimizer_report(self, event):
+        if self.analysis is None:
+            return
+        names = {rule['id']: f"{describe_conditions(rule)} → {gmail_apply_rules.describe_action(rule)}"
+                 for rule in self.rules}
+        lines = [gmail_apply_rules.describe_analysis(self.analysis)]
+        lines += [f"Never matches: {names[rule_id]} ({reason})" for rule_id, reason in self.analysis['never_match']]
+        lines += [f"Only matches where stop rule {names[stop_id]} already did: {names[rule_id]}"
+                  for rule_id, stop_id in self.analysis['shadowed']]
+        lines += [f"Duplicate of {names[kept_id]}: {names[rule_id]}" for rule_id, kept_id in self.analysis['duplicates']]
+        lines += [f"Covered by {names[kept_id]}: {names[rule_id]}" for rule_id, kept_id in self.analysis['subsumed']]
+        lines += [f"Evaluated as one: " + "; ".join(names[rule_id] for rule_id in members)
+                  for members in self.analysis['merged']]
+        wx.MessageBox("\n".join(lines[:50]) + ("\n..." if len(lines) > 50 else ""), "Optimizer Report",
+                      wx.OK | wx.ICON_INFORMATION)
             
-    def on_add_rule(self, event):
+    def on_suggest_rules(self, event):
+        rules = list(self.rules)
+        metadata_file = gmail_analytics.METADATA_FILE
+        refresh = True
+        if os.path.exists(metadata_file):
+            exported = time.strftime('%Y-%m-%d %H:%M', time.localtime(os.path.getmtime(metadata_file)))
+            answer = wx.MessageBox(f"The mailbox metadata was exported on {exported}. Export it again first? "
+                                   "This fetches the headers of every message.", "Suggest Rules",
+                                   wx.YES_NO | wx.CANCEL | wx.NO_DEFAULT | wx.ICON_QUESTION)
+            if answer == wx.CANCEL:
+                return
+            refresh = answer == wx.YES
+        
+        def analyze():
+            if refresh:
+                summary = gmail_apply_rules.export_mailbox(self.service, gmail_analytics.MetadataExport(metadata_file),
+                                                           controller=gmail_apply_rules.RunController())
+                if summary['status'] != 'complete' or not os.path.exists(metadata_file):
+                    raise RuntimeError("not every message could be listed, so no metadata was exported")
+            table = gmail_analytics.MailboxMetadata.load(metadata_file)
+            labels = gmail_apply_rules.label_table(self.service)
+            labels.ensure_loaded()
+            label_names = {label['id']: label['name'] for label in labels.labels()}
+            return (gmail_analytics.analyze_mailbox(table, label_names),
+                    gmail_analytics.suggest_rules(table, rules))
+        
+        self.executor.submit(analyze, lambda result: self.show_suggestions(*result),
+                             "Error analyzing the mailbox", key='suggestions')
+        
+    def show_suggestions(self, analytics, suggestions):
+        report = gmail_analytics.describe_analytics(analytics, top=5)
+        if not suggestions:
+            wx.MessageBox(report + "\n\nNo rules to suggest.", "Suggested Rules", wx.OK | wx.ICON_INFORMATION)
+            return
+        dlg = wx.MultiChoiceDialog(self, report + "\n\nSelect the rules to add:", "Suggested Rules",
+                                   [suggestion['reason'] for suggestion in suggestions])
+        if dlg.ShowModal() == wx.ID_OK and dlg.GetSelections():
+            try:
+                ids = self.store.import_rules([suggestions[i]['rule'] for i in dlg.GetSelections()])
+                self.reload_rules()
+                wx.MessageBox(f"Added {len(ids)} rules", "Success", wx.OK | wx.ICON_INFORMATION)
+            except Exception as e:
+                wx.MessageBox(f"Error adding rules: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        dlg.Destroy()
+            
+    def on_action_type(self, event):
+        # Archive, mark read, star, important and trash need no label
+        self.action_value.Enable(self.action_type.GetStringSelection() in gmail_apply_rules.LABEL_ACTIONS)
+            
+    def on_condition_field(self, event):
+        operators = CONDITION_OPERATORS.get(self.condition_field.GetStringSelection(), [])
+        self.condition_operator.SetItems(operators)
+        if operators:
+            self.condition_operator.SetSelection(0)
+        # Attachment and status conditions take no value
+        self.condition_value.Enable(self.condition_field.GetStringSelection() not in VALUELESS_FIELDS)
+            
+    def read_condition(self):
+        """Return the condition in the editor row, or None after reporting what is wrong."""
+        condition = {
+            'field': self.condition_field.GetStringSelection(),
+            'operator': self.condition_operator.GetStringSelection(),
+            'value': self.condition_value.GetValue().strip()
+        }
+        if condition['field'] in VALUELESS_FIELDS:
+            condition['value'] = ''
+        if not (condition['field'] and condition['operator']):
+            wx.MessageBox("Please fill in all fields", "Error", wx.OK | wx.ICON_ERROR)
+            return None
+        try:
+            validate_condition(condition)
+        except ValueError as e:
+            wx.MessageBox(f"Invalid {condition['field'].lower()}: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            return None
+        return condition
+        
+    def on_add_condition(self, event):
+        condition = self.read_condition()
+        if not condition:
+            return
+        self.extra_conditions.append(condition)
+        self.extra_conditions_text.SetLabel(
+            "Also requires: " + " and ".join(describe_condition(c) for c in self.extra_conditions))
+        self.condition_value.SetValue("")
+        self.Layout()
+        
+    def read_draft_rule(self):
+        """Return the rule being edited, or None after reporting what is wrong."""
+        condition = self.read_condition()
+        if not condition:
+            return None
         rule = {
-            'condition_field': self.condition_field.GetStringSelection(),
-            'condition_operator': self.condition_operator.GetStringSelection(),
-            'condition_value': self.condition_value.GetValue(),
+            'condition_field': condition['field'],
+            'condition_operator': condition['operator'],
+            'condition_value': condition['value'],
             'action_type': self.action_type.GetStringSelection(),
-            'action_value': self.action_value.GetStringSelection()
+            'action_value': (self.action_value.GetStringSelection()
+                             if self.action_type.GetStringSelection() in gmail_apply_rules.LABEL_ACTIONS else ''),
+            'priority': self.priority.GetValue(),
+            'stop_processing': self.stop_processing.GetValue()
         }
+        if self.extra_conditions:
+            rule['conditions'] = list(self.extra_conditions)
+        return rule
         
-        if not all([rule['condition_field'], rule['condition_operator'], 
-                   rule['condition_value'], rule['action_type'], rule['action_value']]):
+    def on_preview_rule(self, event):
+        rule = self.read_draft_rule()
+        if not rule:
+            return
+        if self.header_index is not None and not self.header_index.is_cold:
+            label_names = {label['id']: label['name'] for label in gmail_apply_rules.label_table(self.service).labels()}
+            self.show_preview(self.header_index.preview(rule, label_names))
+            return
+        
+        # Not enough mail indexed yet, so ask Gmail for an estimate instead
+        self.executor.submit(lambda: gmail_index.estimate_on_server(self.service, rule), self.show_preview,
+                             "Error estimating matches", group=self)
+        
+    def show_preview(self, result):
+        if result['source'] == 'index':
+            summary = (f"About {result['count']:,} of {result['indexed']:,} indexed messages match "
+                       f"({result['elapsed'] * 1000:.0f} ms).")
+            if result['body_unchecked']:
+                summary += "\nBody conditions were not checked, so this is an upper bound."
+        else:
+            summary = (f"Gmail estimates {result['count']:,} messages match '{result['query']}'.\n"
+                       "Run the rules once to build the local index for faster, exact previews.")
+        samples = "\n".join(f"• {sample.get('Subject', '(no subject)')} — {sample.get('From', '')}"
+                             for sample in result['samples'])
+        wx.MessageBox(f"{summary}\n\n{samples}" if samples else summary, "Rule Preview", wx.OK | wx.ICON_INFORMATION)
+        
+    def on_add_rule(self, event):
+        rule = self.read_draft_rule()
+        if not rule:
+            return
+        
+        if not rule['action_type'] or (rule['action_type'] in gmail_apply_rules.LABEL_ACTIONS
+                                       and not rule['action_value']):
             wx.MessageBox("Please fill in all fields", "Error", wx.OK | wx.ICON_ERROR)
             return
             
-        self.rules.append(rule)
-        self.save_rules()
-        self.update_rules_list()
+        try:
+            self.store.add(rule)
+        except Exception as e:
+            wx.MessageBox(f"Error saving rule: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            return
+        self.reload_rules()
         
         # Clear fields
         self.condition_value.SetValue("")
         self.action_value.SetSelection(0)  # Reset to first label
+        self.priority.SetValue(0)
+        self.stop_processing.SetValue(False)
+        self.extra_conditions = []
+        self.extra_conditions_text.SetLabel("")
         
     def on_delete_rule(self, event):
-        selected_index = self.rules_list.GetFirstSelected()
-        if selected_index == -1:
+        selected = self.rules_list.selected_items()
+        if not selected:
             wx.MessageBox("Please select a rule to delete", "No Rule Selected", 
                          wx.OK | wx.ICON_INFORMATION)
             return
             
         # Get the rule details for confirmation
-        rule = self.rules[selected_index]
-        condition = f"{rule['condition_field']} {rule['condition_operator']} '{rule['condition_value']}'"
-        action = f"{rule['action_type']} '{rule['action_value']}'"
+        rule = selected[0]
+        condition = describe_conditions(rule)
+        action = gmail_apply_rules.describe_action(rule)
         
         # Show confirmation dialog
         msg = f"Are you sure you want to delete this rule?\n\nIf {condition}\nThen {action}"
@@ -418,51 +956,20 @@ class RulesPanel(wx.Panel):
         
         if dlg.ShowModal() == wx.ID_YES:
             # Remove the rule
-            self.rules.pop(selected_index)
-            self.save_rules()
-            self.update_rules_list()
+            try:
+                self.store.delete([rule['id']])
+            except Exception as e:
+                wx.MessageBox(f"Error deleting rule: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            self.reload_rules()
             
         dlg.Destroy()
 
     def get_rules(self):
-        """Return the current rules with their conditions and actions formatted for evaluation."""
-        formatted_rules = []
-        for rule in self.rules:
-            # Create condition function based on the rule type
-            def create_condition(rule):
-                def condition(msg):
-                    headers = msg.get('payload', {}).get('headers', [])
-                    header_value = next((h['value'] for h in headers if h['name'] == rule['condition_field']), '')
-                    
-                    if rule['condition_operator'] == 'contains':
-                        return rule['condition_value'].lower() in header_value.lower()
-                    elif rule['condition_operator'] == 'equals':
-                        return rule['condition_value'].lower() == header_value.lower()
-                    elif rule['condition_operator'] == 'starts with':
-                        return header_value.lower().startswith(rule['condition_value'].lower())
-                    elif rule['condition_operator'] == 'ends with':
-                        return header_value.lower().endswith(rule['condition_value'].lower())
-                    return False
-                return condition
-
-            # Create action function
-            def create_action(rule):
-                def action(msg, service):
-                    label_id = gmail_apply_rules.get_or_create_label(service, rule['action_value'])
-                    service.users().messages().modify(
-                        userId='me',
-                        id=msg['id'],
-                        body={'addLabelIds': [label_id]}
-                    ).execute()
-                return action
-
-            formatted_rules.append({
-                'name': f"{rule['condition_field']} {rule['condition_operator']} '{rule['condition_value']}' -> {rule['action_type']} '{rule['action_value']}'",
-                'condition': create_condition(rule),
-                'action': create_action(rule)
-            })
-        
-        return formatted_rules
+        """Return the current rules as GmailRules ready for evaluation.
+
+        Only rules changed since the last call are rebuilt.
+        """
+        return self.compiled_rules.rules()
 
 class CreateLabelDialog(wx.Dialog):
     def __init__(self, parent):
@@ -506,9 +1013,12 @@ class CreateLabelDialog(wx.Dialog):
         self.EndModal(wx.ID_OK)
 
 class LabelsPanel(wx.Panel):
-    def __init__(self, parent, service):
+    def __init__(self, parent, service, executor):
         super().__init__(parent)
         self.service = service  # Get the Gmail service directly from the parameter
+        self.executor = executor
+        self.label_table = gmail_apply_rules.label_table(service)
+        self.label_counts = gmail_apply_rules.LabelCounts(service)
         self.init_ui()
         
     def init_ui(self):
@@ -523,15 +1033,33 @@ class LabelsPanel(wx.Panel):
         create_button.Bind(wx.EVT_BUTTON, self.on_create_label)
         labels_sizer.Add(create_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
         
-        self.labels_list = wx.ListCtrl(self, style=wx.LC_REPORT | wx.LC_SINGLE_SEL)
-        self.labels_list.InsertColumn(0, "Label Name", width=300)
-        self.labels_list.InsertColumn(1, "Type", width=200)
+        self.labels_filter = wx.SearchCtrl(self)
+        self.labels_filter.SetDescriptiveText("Filter labels")
+        self.labels_filter.Bind(wx.EVT_TEXT, lambda event: self.labels_list.set_filter(self.labels_filter.GetValue()))
+        labels_sizer.Add(self.labels_filter, 0, wx.EXPAND | wx.LEFT | wx.RIGHT, 5)
+        
+        # Several labels can be selected for bulk deletion
+        self.labels_list = VirtualListCtrl(
+            self,
+            [("Label Name", 260), ("Type", 80), ("Messages", 90), ("Unread", 80), ("Threads", 90)],
+            row_text=self.label_row,
+            key=lambda label: label['id'],
+            style=0
+        )
         labels_sizer.Add(self.labels_list, 1, wx.EXPAND | wx.ALL, 5)
         
-        # Add delete button below the list
-        delete_button = wx.Button(self, label="Delete Selected Label")
+        # Add rename, merge and delete buttons below the list
+        buttons_sizer = wx.BoxSizer(wx.HORIZONTAL)
+        rename_button = wx.Button(self, label="Rename...")
+        rename_button.Bind(wx.EVT_BUTTON, self.on_rename_label)
+        buttons_sizer.Add(rename_button, 0, wx.RIGHT, 5)
+        merge_button = wx.Button(self, label="Merge Into...")
+        merge_button.Bind(wx.EVT_BUTTON, self.on_merge_label)
+        buttons_sizer.Add(merge_button, 0, wx.RIGHT, 5)
+        delete_button = wx.Button(self, label="Delete Selected Labels")
         delete_button.Bind(wx.EVT_BUTTON, self.on_delete_label)
-        labels_sizer.Add(delete_button, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
+        buttons_sizer.Add(delete_button, 0)
+        labels_sizer.Add(buttons_sizer, 0, wx.ALIGN_RIGHT | wx.ALL, 5)
         
         vbox.Add(labels_sizer, 1, wx.EXPAND | wx.ALL, 10)
         
@@ -539,78 +1067,141 @@ class LabelsPanel(wx.Panel):
         self.update_labels_list()
         
     def update_labels_list(self):
-        self.labels_list.DeleteAllItems()
-        try:
-            # Fetch labels from Gmail API
-            labels = self.service.users().labels().list(userId='me').execute().get('labels', [])
-            for label in labels:
-                label_name = label['name']
-                label_type = label.get('type', 'User')
-                self.labels_list.Append([label_name, label_type])
-        except Exception as e:
-            wx.MessageBox(f"Error fetching labels: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+        """Fetch the labels off the UI thread, then show them and fetch their counts."""
+        self.executor.submit(self.label_table.refresh, self.on_labels_loaded, "Error fetching labels", key='labels')
+        
+    def on_labels_loaded(self, _):
+        self.show_labels()
+        self.refresh_counts()
+        
+    def on_show(self):
+        # Counts cancelled when the tab was left, or gone stale since, are fetched again
+        self.refresh_counts()
+            
+    def label_row(self, label):
+        counts = self.label_counts.get(label['id'])
+        return [label['name'], label.get('type', 'User').capitalize()] + [
+            f"{counts[key]:,}" if key in counts else "" for key in ('messagesTotal', 'messagesUnread', 'threadsTotal')
+        ]
+        
+    def refresh_counts(self, label_ids=None, invalidate=False):
+        """Fetch message counts for stale labels (all labels by default) off the UI thread."""
+        label_ids = list(label_ids) if label_ids is not None else [label['id'] for label in self.label_table.labels()]
+        if invalidate:
+            self.label_counts.invalidate(label_ids)
+        label_ids = self.label_counts.stale(label_ids)
+        if not label_ids:
+            return
+        self.executor.submit(lambda: self.label_counts.refresh(label_ids),
+                             lambda fetched: self.show_labels() if fetched else None,
+                             "Error fetching label counts", key=('counts', tuple(sorted(label_ids))), group=self)
+            
+    def show_labels(self):
+        """Redraw the list from the local label table without calling Gmail."""
+        self.labels_list.set_items(self.label_table.labels())
+        
+    def selected_user_labels(self, action):
+        """Return the selected labels, or None after reporting why they cannot be used."""
+        selected = self.labels_list.selected_items()
+        if not selected:
+            wx.MessageBox(f"Please select a label to {action}", "No Label Selected", 
+                         wx.OK | wx.ICON_INFORMATION)
+            return None
+        # System labels cannot be renamed, merged or deleted
+        if any(label.get('type') == 'system' for label in selected):
+            wx.MessageBox(f"Cannot {action} system labels", "Error", wx.OK | wx.ICON_ERROR)
+            return None
+        return selected
         
     def on_create_label(self, event):
         dlg = CreateLabelDialog(self)
         if dlg.ShowModal() == wx.ID_OK:
             label_name = dlg.label_name
-            try:
-                # Create label using Gmail API
-                label_body = {
-                    'name': label_name,
-                    'labelListVisibility': 'labelShow',
-                    'messageListVisibility': 'show'
-                }
-                self.service.users().labels().create(userId='me', body=label_body).execute()
-                self.update_labels_list()
-                wx.MessageBox(f"Label '{label_name}' created successfully!", "Success", wx.OK | wx.ICON_INFORMATION)
-            except Exception as e:
-                wx.MessageBox(f"Error creating label: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            self.executor.submit(lambda: gmail_apply_rules.get_or_create_label(self.service, label_name),
+                                 lambda label_id: self.on_label_created(label_name, label_id), "Error creating label")
         dlg.Destroy()
         
-    def on_delete_label(self, event):
-        selected_index = self.labels_list.GetFirstSelected()
-        if selected_index == -1:
-            wx.MessageBox("Please select a label to delete", "No Label Selected", 
-                         wx.OK | wx.ICON_INFORMATION)
+    def on_label_created(self, label_name, label_id):
+        self.show_labels()
+        self.refresh_counts([label_id])
+        wx.MessageBox(f"Label '{label_name}' created successfully!", "Success", wx.OK | wx.ICON_INFORMATION)
+        
+    def on_rename_label(self, event):
+        selected = self.selected_user_labels("rename")
+        if not selected:
+            return
+        label = selected[0]
+        dlg = wx.TextEntryDialog(self, "New label name:", "Rename Label", value=label['name'])
+        if dlg.ShowModal() == wx.ID_OK:
+            new_name = dlg.GetValue().strip()
+            if new_name and new_name != label['name']:
+                self.executor.submit(lambda: gmail_apply_rules.rename_label(self.service, label['id'], new_name),
+                                     lambda _: self.show_labels(), "Error renaming label")
+        dlg.Destroy()
+        
+    def on_merge_label(self, event):
+        selected = self.selected_user_labels("merge")
+        if not selected:
             return
+        source = selected[0]
+        targets = sorted((label for label in self.label_table.labels() if label['id'] != source['id']),
+                         key=lambda label: label['name'].lower())
+        dlg = wx.SingleChoiceDialog(self, f"Move all messages from '{source['name']}' to:", "Merge Label",
+                                    [label['name'] for label in targets])
+        if dlg.ShowModal() == wx.ID_OK:
+            target = targets[dlg.GetSelection()]
+            delete_source = wx.MessageBox(f"Delete '{source['name']}' after moving its messages?", "Merge Label",
+                                          wx.YES_NO | wx.ICON_QUESTION) == wx.YES
             
-        label_name = self.labels_list.GetItem(selected_index, 0).GetText()
-        label_type = self.labels_list.GetItem(selected_index, 1).GetText()
+            self.executor.submit(
+                lambda: gmail_apply_rules.merge_labels(self.service, source['id'], target['id'],
+                                                       delete_source=delete_source),
+                lambda moved: self.on_merge_complete(f"Moved {moved} messages to '{target['name']}'",
+                                                     [source['id'], target['id']]),
+                "Error merging labels")
+        dlg.Destroy()
         
-        # Don't allow deletion of system labels
-        if label_type == 'System':
-            wx.MessageBox("Cannot delete system labels", "Error", wx.OK | wx.ICON_ERROR)
+    def on_merge_complete(self, message, label_ids):
+        self.show_labels()
+        self.refresh_counts(label_ids, invalidate=True)
+        wx.MessageBox(message, "Success", wx.OK | wx.ICON_INFORMATION)
+        
+    def on_delete_label(self, event):
+        selected = self.selected_user_labels("delete")
+        if not selected:
             return
         
         # Show confirmation dialog
-        msg = f"Are you sure you want to delete the label '{label_name}'?"
+        if len(selected) == 1:
+            msg = f"Are you sure you want to delete the label '{selected[0]['name']}'?"
+        else:
+            msg = f"Are you sure you want to delete these {len(selected)} labels?"
         dlg = wx.MessageDialog(self, msg, "Confirm Deletion",
                              wx.YES_NO | wx.ICON_QUESTION)
         
         if dlg.ShowModal() == wx.ID_YES:
-            try:
-                # Get the label ID
-                labels = self.service.users().labels().list(userId='me').execute().get('labels', [])
-                label_id = next((label['id'] for label in labels if label['name'] == label_name), None)
-                
-                if label_id:
-                    # Delete label using Gmail API
-                    self.service.users().labels().delete(userId='me', id=label_id).execute()
-                    self.update_labels_list()
-                    wx.MessageBox(f"Label '{label_name}' deleted successfully!", "Success", wx.OK | wx.ICON_INFORMATION)
-                else:
-                    wx.MessageBox(f"Label '{label_name}' not found", "Error", wx.OK | wx.ICON_ERROR)
-            except Exception as e:
-                wx.MessageBox(f"Error deleting label: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
+            # Delete labels using batched Gmail API requests
+            names = {label['id']: label['name'] for label in selected}
+            self.executor.submit(lambda: gmail_apply_rules.delete_labels(self.service, list(names)),
+                                 lambda errors: self.on_labels_deleted(names, errors), "Error deleting labels")
             
         dlg.Destroy()
+        
+    def on_labels_deleted(self, names, errors):
+        self.show_labels()
+        if errors:
+            details = "\n".join(f"{names[label_id]}: {error}" for label_id, error in errors.items())
+            wx.MessageBox(f"Some labels could not be deleted:\n\n{details}", "Error", wx.OK | wx.ICON_ERROR)
+        else:
+            wx.MessageBox(f"Deleted {len(names)} labels", "Success", wx.OK | wx.ICON_INFORMATION)
 
 class SettingsPanel(wx.Panel):
-    def __init__(self, parent, service, app):
+    def __init__(self, parent, service, app, executor):
         super().__init__(parent)
         self.service = service
         self.app = app
+        self.executor = executor
+        self.account_loaded = False
         self.init_ui()
         
     def init_ui(self):
@@ -691,19 +1282,31 @@ class SettingsPanel(wx.Panel):
             self.threads_value.SetLabel("")
             return
             
-        try:
-            profile = self.service.users().getProfile(userId='me').execute()
-            email = profile.get('emailAddress', 'Unknown')
-            total_messages = profile.get('messagesTotal', 'Unknown')
-            threads_total = profile.get('threadsTotal', 'Unknown')
-            
-            self.email_value.SetLabel(email)
-            self.messages_value.SetLabel(f"{total_messages:,}")
-            self.threads_value.SetLabel(f"{threads_total:,}")
-        except Exception as e:
-            self.email_value.SetLabel(f"Error: {str(e)}")
-            self.messages_value.SetLabel("")
-            self.threads_value.SetLabel("")
+        # Fetch the profile off the UI thread
+        profile = self.service.users().getProfile(userId='me', fields=gmail_apply_rules.FIELDS['getProfile'])
+        self.executor.submit(profile.execute,
+                             self.show_account_info, on_error=self.show_account_error, key='profile', group=self)
+        
+    def on_show(self):
+        # Fetch again if the request was cancelled when the tab was left
+        if not self.account_loaded:
+            self.update_account_info()
+        
+    def show_account_info(self, profile):
+        email = profile.get('emailAddress', 'Unknown')
+        total_messages = profile.get('messagesTotal', 'Unknown')
+        threads_total = profile.get('threadsTotal', 'Unknown')
+        
+        self.email_value.SetLabel(email)
+        self.messages_value.SetLabel(f"{total_messages:,}")
+        self.threads_value.SetLabel(f"{threads_total:,}")
+        self.account_loaded = True
+        self.Layout()
+        
+    def show_account_error(self, error):
+        self.email_value.SetLabel(f"Error: {error}")
+        self.messages_value.SetLabel("")
+        self.threads_value.SetLabel("")
             
     def on_logout(self, event):
         if os.path.exists('token.json'):
@@ -713,24 +1316,17 @@ class SettingsPanel(wx.Panel):
                 wx.MessageBox(f"Error removing token file: {str(e)}", "Error", wx.OK | wx.ICON_ERROR)
                 return
         
+        # Results of requests still in flight are not wanted by the next account
+        self.executor.shutdown()
         # Show the auth frame through the app
         self.app.show_auth_frame()
 
 def authenticate_gmail():
-    creds = None
-    if os.path.exists('token.json'):
-        creds = Credentials.from_authorized_user_file('token.json', SCOPES)
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
-        else:
-            flow = InstalledAppFlow.from_client_secrets_file('credentials.json', SCOPES)
-            creds = flow.run_local_server(port=0)
-        with open('token.json', 'w') as token:
-            token.write(creds.to_json())
-    return build('gmail', 'v1', credentials=creds)
+    # Shared with the command line, which also asks again for scopes a saved token lacks
+    return gmail_apply_rules.authenticate_gmail()
 
 def main():
+    multiprocessing.freeze_support()
     app = MainApp()
     app.MainLoop()
 
@@ -0,0 +1,152 @@
+import os
+import sys
+import json
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Dict, Any, Optional
+
+import gmail_apply_rules
+from gmail_apply_rules import RunController, StopProcessing
+
+logger = logging.getLogger(__name__)
+
+def load_accounts(accounts_file: str = 'accounts.json') -> List[Dict[str, Any]]:
+    """Load account definitions from a JSON file.
+
+    Each entry needs a `name`, a `token_file` and a `rules_file` (a rule store,
+    or a JSON rules file if it ends in .json), for example
+    `{"name": "support", "token_file": "tokens/support.json", "rules_file": "rules/support.json"}`.
+    """
+    with open(accounts_file, 'r') as f:
+        accounts = json.load(f)
+    for account in accounts:
+        for key in ('name', 'token_file', 'rules_file'):
+            if key not in account:
+                raise ValueError(f"Account entry is missing '{key}': {account}")
+    return accounts
+
+def _run_account(account: Dict[str, Any], pause_event, stop_event, progress,
+                 quota_per_second: float) -> Dict[str, Any]:
+    """Process one account inside a pool worker."""
+    name = account['name']
+
+    def publish(snapshot):
+        progress[name] = snapshot
+
+    def log(message):
+        logger.info(f"[{name}] {message}")
+
+    controller = RunController(
+        name=name,
+        pause_event=pause_event,
+        stop_event=stop_event,
+        quota_per_second=quota_per_second,
+        progress_callback=publish
+    )
+    try:
+        if controller.stopped():
+            raise StopProcessing("Stopped before the account started")
+        service = gmail_apply_rules.authenticate_gmail(
+            token_file=account['token_file'],
+            credentials_file=account.get('credentials_file', 'credentials.json'),
+            interactive=False
+        )
+        rules = gmail_apply_rules.load_rules(account['rules_file'])
+        if not rules:
+            raise RuntimeError(f"No rules loaded from {account['rules_file']}")
+        stats = gmail_apply_rules.RuleStats(gmail_apply_rules.stats_file_for(account['rules_file']))
+        ledger = gmail_apply_rules.EvaluationLedger(gmail_apply_rules.ledger_file_for(account['rules_file']))
+        # A stopped run returns its summary with status 'stopped'
+        return gmail_apply_rules.apply_rules(service, rules, log_func=log, controller=controller, stats=stats,
+                                             ledger=ledger, tuner=gmail_apply_rules.AdaptiveTuner())
+    except StopProcessing:
+        controller.update_progress(state='stopped')
+        return {'status': 'stopped', **controller.progress}
+    except Exception as e:
+        controller.update_progress(state='error', error=str(e))
+        return {'status': 'error', 'error': str(e)}
+
+class MultiAccountRunner:
+    """Process several accounts concurrently, one pool worker per account.
+
+    Every account has its own pause and stop events, progress entry and quota
+    pacer, so pausing or stopping one mailbox leaves the others running.
+    """
+
+    def __init__(self, accounts: List[Dict[str, Any]], max_workers: Optional[int] = None,
+                 quota_per_second: float = gmail_apply_rules.DEFAULT_QUOTA_PER_SECOND):
+        self.accounts = {account['name']: account for account in accounts}
+        self.max_workers = max_workers or min(len(accounts), os.cpu_count() or 1) or 1
+        self.quota_per_second = quota_per_second
+        self.manager = None
+        self.executor = None
+        self.pause_events = {}
+        self.stop_events = {}
+        self.shared_progress = None
+        self.futures = {}
+
+    def start(self) -> None:
+        """Submit every account to the process pool."""
+        self.manager = multiprocessing.Manager()
+        self.shared_progress = self.manager.dict()
+        self.executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        for name, account in self.accounts.items():
+            self.pause_events[name] = self.manager.Event()
+            self.stop_events[name] = self.manager.Event()
+            self.shared_progress[name] = {'state': 'queued', 'processed': 0, 'total': 0, 'rules_applied': {}}
+            self.futures[name] = self.executor.submit(
+                _run_account,
+                account,
+                self.pause_events[name],
+                self.stop_events[name],
+                self.shared_progress,
+                self.quota_per_second
+            )
+        logger.info(f"Started processing {len(self.accounts)} accounts with {self.max_workers} workers")
+
+    def pause(self, name: str, pause: bool = True) -> None:
+        """Pause or resume a single account."""
+        if pause:
+            self.pause_events[name].set()
+        else:
+            self.pause_events[name].clear()
+
+    def stop(self, name: str) -> None:
+        """Stop a single account."""
+        self.stop_events[name].set()
+
+    def stop_all(self) -> None:
+        for name in self.stop_events:
+            self.stop(name)
+
+    def progress(self) -> Dict[str, Dict[str, Any]]:
+        """Return a snapshot of every account's progress."""
+        return dict(self.shared_progress) if self.shared_progress is not None else {}
+
+    def wait(self) -> Dict[str, Dict[str, Any]]:
+        """Block until all accounts finish and return their summaries."""
+        results = {}
+        try:
+            for name, future in self.futures.items():
+                try:
+                    results[name] = future.result()
+                except Exception as e:
+                    results[name] = {'status': 'error', 'error': str(e)}
+        finally:
+            self.executor.shutdown()
+            self.manager.shutdown()
+        return results
+
+def main():
+    """Process every account listed in accounts.json (or the file given as argument)."""
+    multiprocessing.freeze_support()
+    accounts_file = sys.argv[1] if len(sys.argv) > 1 else 'accounts.json'
+    runner = MultiAccountRunner(load_accounts(accounts_file))
+    runner.start()
+    results = runner.wait()
+    for name, result in results.items():
+        logger.info(f"[{name}] {result['status']}: {result.get('processed', 0)} messages processed")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,181 @@
+import os
+import io
+import json
+import time
+import pstats
+import cProfile
+import logging
+import datetime
+import contextlib
+import tracemalloc
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PROFILE_DIR = 'profiles'
+
+# Run stages in the order they happen.
+STAGES = ['labels', 'list', 'fetch', 'evaluate', 'modify']
+
+class RunProfiler:
+    """Opt-in timing of one apply_rules run, by stage and by rule.
+
+    Wall and CPU time (of the run's thread) are recorded for each stage:
+    loading labels, listing, fetching, evaluating and modifying. Per-rule
+    evaluation counts and cost come from the run's RuleStats, and the time
+    spent in each rule's action is measured directly. With the pool,
+    `evaluate` is the time spent waiting for worker results. Optionally
+    cProfile and tracemalloc run for the whole run.
+    """
+
+    def __init__(self, use_cprofile: bool = False, trace_memory: bool = False, top: int = 20):
+        self.use_cprofile = use_cprofile
+        self.trace_memory = trace_memory
+        self.top = top
+        self.stages: Dict[str, Dict[str, float]] = {}
+        self.actions: Dict[str, Dict[str, float]] = {}
+        self.rules: Dict[str, Dict[str, Any]] = {}
+        self.profile = None
+        self.memory: Dict[str, Any] = {}
+        self.wall = 0.0
+        self.cpu = 0.0
+        self._rule_names: Dict[str, str] = {}
+        self._counters_at_start: Dict[str, Dict[str, int]] = {}
+        self._started = None
+
+    def start(self, rules=None, stats=None) -> None:
+        self._rule_names = {rule.id: rule.name for rule in rules or []}
+        if stats is not None:
+            self._counters_at_start = {rule_id: dict(counters) for rule_id, counters in stats.counters.items()}
+        if self.trace_memory:
+            tracemalloc.start()
+        if self.use_cprofile:
+            self.profile = cProfile.Profile()
+            self.profile.enable()
+        self._started = (time.perf_counter(), time.process_time())
+
+    def stop(self, stats=None) -> None:
+        self.wall = time.perf_counter() - self._started[0]
+        self.cpu = time.process_time() - self._started[1]
+        if self.profile:
+            self.profile.disable()
+        if self.trace_memory:
+            snapshot = tracemalloc.take_snapshot()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            self.memory = {
+                'peak_bytes': peak,
+                'top': [
+                    {'location': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+                    for stat in snapshot.statistics('lineno')[:self.top]
+                ],
+            }
+        if stats is not None:
+            for rule_id, counters in stats.counters.items():
+                before = self._counters_at_start.get(rule_id, {})
+                evaluations = counters['evaluations'] - before.get('evaluations', 0)
+                if evaluations:
+                    self.rules[self._rule_names.get(rule_id, rule_id)] = {
+                        'evaluations': evaluations,
+                        'matches': counters['matches'] - before.get('matches', 0),
+                        'evaluate_seconds': (counters['cost_ns'] - before.get('cost_ns', 0)) / 1e9,
+                    }
+
+    @contextlib.contextmanager
+    def stage(self, name: str, rule: Optional[str] = None):
+        """Time a block as part of a stage, and of a rule's actions if `rule` is given."""
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+            for timings in [self.stages.setdefault(name, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})] + (
+                    [self.actions.setdefault(rule, {'wall': 0.0, 'cpu': 0.0, 'calls': 0})] if rule else []):
+                timings['wall'] += wall
+                timings['cpu'] += cpu
+                timings['calls'] += 1
+
+    def _top_functions(self) -> List[Dict[str, Any]]:
+        if not self.profile:
+            return []
+        stats = pstats.Stats(self.profile)
+        rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:self.top]
+        return [
+            {'function': f"{filename}:{line}({function})", 'calls': calls, 'tottime': tottime, 'cumtime': cumtime}
+            for (filename, line, function), (_, calls, tottime, cumtime, _) in rows
+        ]
+
+    def report(self) -> Dict[str, Any]:
+        """Return the whole profile as a JSON-serializable dict."""
+        rules = {}
+        for name in set(self.rules) | set(self.actions):
+            action = self.actions.get(name, {})
+            rules[name] = dict(self.rules.get(name, {}), actions=action.get('calls', 0),
+                               action_wall=action.get('wall', 0.0), action_cpu=action.get('cpu', 0.0))
+        return {
+            'wall': self.wall,
+            'cpu': self.cpu,
+            'stages': {name: self.stages[name] for name in STAGES if name in self.stages},
+            'rules': rules,
+            'memory': self.memory,
+            'top_functions': self._top_functions(),
+        }
+
+    def format_report(self) -> str:
+        """Return the profile as a plain-text report, costliest entries first."""
+        report = self.report()
+        lines = [f"Run profile: {report['wall']:.2f}s wall, {report['cpu']:.2f}s CPU", "",
+                 f"{'Stage':<12}{'Wall s':>10}{'CPU s':>10}{'Calls':>10}{'Share':>8}"]
+        for name, timings in report['stages'].items():
+            share = timings['wall'] / report['wall'] if report['wall'] else 0
+            lines.append(f"{name:<12}{timings['wall']:>10.2f}{timings['cpu']:>10.2f}{timings['calls']:>10}{share:>8.0%}")
+        # Mostly quota pacing and pauses, which happen between stages
+        other = report['wall'] - sum(timings['wall'] for timings in report['stages'].values())
+        if report['wall']:
+            lines.append(f"{'other':<12}{other:>10.2f}{'':>10}{'':>10}{other / report['wall']:>8.0%}")
+
+        lines += ["", f"{'Rule':<40}{'Evals':>8}{'Matches':>9}{'Eval s':>9}{'Actions':>9}{'Action s':>10}"]
+        ranked = sorted(report['rules'].items(),
+                        key=lambda item: item[1].get('evaluate_seconds', 0) + item[1]['action_wall'], reverse=True)
+        for name, rule in ranked[:self.top]:
+            lines.append(f"{name[:39]:<40}{rule.get('evaluations', 0):>8}{rule.get('matches', 0):>9}"
+                         f"{rule.get('evaluate_seconds', 0):>9.3f}{rule['actions']:>9}{rule['action_wall']:>10.2f}")
+
+        if report['memory']:
+            lines += ["", f"Peak traced memory: {report['memory']['peak_bytes'] / 1024 / 1024:.1f} MB"]
+            for stat in report['memory']['top']:
+                lines.append(f"  {stat['size_bytes'] / 1024:>10.1f} KB  {stat['count']:>7} blocks  {stat['location']}")
+
+        if self.profile:
+            lines += ["", "Top functions by cumulative time:"]
+            output = io.StringIO()
+            pstats.Stats(self.profile, stream=output).sort_stats('cumulative').print_stats(self.top)
+            lines.append(output.getvalue())
+        return "\n".join(lines)
+
+    def write_report(self, directory: str = PROFILE_DIR) -> Tuple[str, str]:
+        """Write the text and JSON reports (and raw cProfile data) and return their paths."""
+        os.makedirs(directory, exist_ok=True)
+        base = os.path.join(directory, f"run-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}")
+        with open(f"{base}.txt", 'w') as f:
+            f.write(self.format_report())
+        with open(f"{base}.json", 'w') as f:
+            json.dump(self.report(), f, indent=2)
+        if self.profile:
+            self.profile.dump_stats(f"{base}.prof")
+        logger.info(f"Wrote run profile to {base}.txt")
+        return f"{base}.txt", f"{base}.json"
+
+class NullProfiler:
+    """Stand-in used when a run is not profiled."""
+
+    _nothing = contextlib.nullcontext()
+
+    def start(self, rules=None, stats=None) -> None:
+        pass
+
+    def stop(self, stats=None) -> None:
+        pass
+
+    def stage(self, name: str, rule: Optional[str] = None):
+        return self._nothing
@@ -0,0 +1,158 @@
+import os
+import json
+import uuid
+import sqlite3
+import logging
+import tempfile
+import threading
+from typing import List, Dict, Any, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+RULES_DB_FILE = 'rules.db'
+LEGACY_RULES_FILE = 'rules.json'
+
+def new_rule_id() -> str:
+    return uuid.uuid4().hex[:12]
+
+class RuleStore:
+    """Transactional rule storage shared by the GUI and the command line.
+
+    Rules live in SQLite, so every add, edit or delete is an atomic
+    transaction that touches only the affected rows, and concurrent writers
+    are serialized by the database. Every write bumps a store-wide version;
+    each rule records the version it was last changed at, and deleted rules
+    are kept as tombstones, so readers can ask what changed since the version
+    they last saw.
+
+    A new, empty store imports the rules of `legacy_json`, which defaults to
+    the rules.json of earlier versions for the default store only; stores at
+    other paths, such as per-account ones, start empty.
+    """
+
+    def __init__(self, path: str = RULES_DB_FILE, legacy_json: Optional[str] = None):
+        if legacy_json is None and path == RULES_DB_FILE:
+            legacy_json = LEGACY_RULES_FILE
+        self.path = path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.executescript('''
+            CREATE TABLE IF NOT EXISTS rules (
+                id TEXT PRIMARY KEY,
+                position INTEGER NOT NULL,
+                definition TEXT NOT NULL,
+                version INTEGER NOT NULL,
+                deleted INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL);
+            INSERT OR IGNORE INTO meta (key, value) VALUES ('version', 0);
+        ''')
+        if legacy_json and self.version() == 0 and os.path.exists(legacy_json):
+            with open(legacy_json, 'r') as f:
+                ids = self.import_rules(json.load(f))
+            logger.info(f"Imported {len(ids)} rules from {legacy_json} into {path}")
+
+    def _write(self, operation):
+        """Run `operation(cursor, version)` in one write transaction at a new version."""
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute('BEGIN IMMEDIATE')
+            try:
+                version = cursor.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0] + 1
+                cursor.execute("UPDATE meta SET value = ? WHERE key = 'version'", (version,))
+                result = operation(cursor, version)
+                cursor.execute('COMMIT')
+                return result
+            except Exception:
+                cursor.execute('ROLLBACK')
+                raise
+
+    def _read(self, sql: str, parameters=()) -> List[tuple]:
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def version(self) -> int:
+        """Return the store version; it changes whenever any rule changes."""
+        return self._read("SELECT value FROM meta WHERE key = 'version'")[0][0]
+
+    def all(self) -> List[Dict[str, Any]]:
+        """Return every live rule in order, each with its `id`."""
+        rows = self._read('SELECT id, definition FROM rules WHERE deleted = 0 ORDER BY position')
+        return [dict(json.loads(definition), id=rule_id) for rule_id, definition in rows]
+
+    def ids(self) -> List[str]:
+        return [row[0] for row in self._read('SELECT id FROM rules WHERE deleted = 0 ORDER BY position')]
+
+    def get(self, rule_id: str) -> Optional[Dict[str, Any]]:
+        rows = self._read('SELECT definition FROM rules WHERE id = ? AND deleted = 0', (rule_id,))
+        return dict(json.loads(rows[0][0]), id=rule_id) if rows else None
+
+    def changes_since(self, version: int) -> Tuple[List[Dict[str, Any]], List[str], int]:
+        """Return rules changed and IDs deleted after `version`, plus the current version."""
+        with self.lock:
+            current = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()[0]
+            rows = self.connection.execute(
+                'SELECT id, definition, deleted FROM rules WHERE version > ?', (version,)).fetchall()
+        changed = [dict(json.loads(definition), id=rule_id) for rule_id, definition, deleted in rows if not deleted]
+        deleted = [rule_id for rule_id, _, deleted in rows if deleted]
+        return changed, deleted, current
+
+    def add(self, rule: Dict[str, Any]) -> str:
+        """Append a rule and return its ID."""
+        return self.import_rules([rule])[0]
+
+    def update(self, rule_id: str, rule: Dict[str, Any]) -> None:
+        definition = json.dumps({k: v for k, v in rule.items() if k != 'id'})
+
+        def operation(cursor, version):
+            cursor.execute('UPDATE rules SET definition = ?, version = ? WHERE id = ? AND deleted = 0',
+                           (definition, version, rule_id))
+            if cursor.rowcount == 0:
+                raise KeyError(f"No rule with ID {rule_id}")
+        self._write(operation)
+
+    def delete(self, rule_ids: List[str]) -> None:
+        def operation(cursor, version):
+            cursor.executemany('UPDATE rules SET deleted = 1, version = ? WHERE id = ?',
+                               [(version, rule_id) for rule_id in rule_ids])
+        self._write(operation)
+
+    def import_rules(self, rules: List[Dict[str, Any]], replace: bool = False) -> List[str]:
+        """Add many rules in one transaction and return their IDs.
+
+        Rules keep an existing `id` (replacing the stored rule with that ID)
+        or get a new one. With `replace`, rules not in the import are deleted.
+        """
+        def operation(cursor, version):
+            if replace:
+                cursor.execute('UPDATE rules SET deleted = 1, version = ? WHERE deleted = 0', (version,))
+            position = cursor.execute('SELECT COALESCE(MAX(position), -1) FROM rules').fetchone()[0]
+            ids = []
+            for rule in rules:
+                position += 1
+                rule_id = rule.get('id') or new_rule_id()
+                cursor.execute(
+                    'INSERT OR REPLACE INTO rules (id, position, definition, version, deleted) VALUES (?, ?, ?, ?, 0)',
+                    (rule_id, position, json.dumps({k: v for k, v in rule.items() if k != 'id'}), version)
+                )
+                ids.append(rule_id)
+            return ids
+        return self._write(operation)
+
+    def export_rules(self, path: str) -> int:
+        """Write every rule to a JSON file atomically and return the count."""
+        rules = self.all()
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temp_path = tempfile.mkstemp(dir=directory, prefix='.rules-', suffix='.json')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(rules, f, indent=2)
+            os.replace(temp_path, path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        return len(rules)
+
+    def close(self) -> None:
+        self.connection.close()
@@ -3,7 +3,21 @@ from setuptools import setup
 setup(
     name="gmail-labeler",
     version="1.0.0",
-    packages=["gmail_labeler"],
+    # The app is a set of top-level modules, which the console scripts import
+    py_modules=[
+        "gmail_labeler_gui",
+        "gmail_apply_rules",
+        "gmail_conditions",
+        "gmail_body",
+        "gmail_rule_store",
+        "gmail_index",
+        "gmail_profiler",
+        "gmail_journal",
+        "gmail_filters",
+        "gmail_multi_account",
+        "gmail_cassette",
+        "gmail_analytics",
+    ],
     install_requires=[
         "google-auth-oauthlib",
         "google-auth-httplib2",
@@ -11,9 +25,17 @@ setup(
         "python-dateutil",
         "wxPython",
     ],
+    extras_require={
+        # Faster mailbox analytics, and Parquet export of the mailbox metadata
+        "analytics": ["numpy"],
+        "parquet": ["pyarrow"],
+    },
     entry_points={
         "console_scripts": [
             "gmail-labeler=gmail_labeler_gui:main",
+            "gmail-apply-rules=gmail_apply_rules:main",
+            "gmail-cassette=gmail_cassette:main",
+            "gmail-mailbox-stats=gmail_analytics:main",
         ],
     },
     author="Your Name",
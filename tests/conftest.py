@@ -0,0 +1,132 @@
+import os
+import sys
+import copy
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+SYSTEM_LABELS = ('INBOX', 'UNREAD', 'STARRED', 'IMPORTANT', 'TRASH')
+
+class FakeRequest:
+    def __init__(self, fn):
+        self.fn = fn
+
+    def execute(self, *args, **kwargs):
+        return self.fn()
+
+class FakeBatch:
+    def __init__(self, callback=None):
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request, callback=None, request_id=None):
+        self.requests.append((request, callback or self.callback, request_id or str(len(self.requests) + 1)))
+
+    def execute(self, *args, **kwargs):
+        for request, callback, request_id in self.requests:
+            try:
+                response, error = request.execute(), None
+            except Exception as e:
+                response, error = None, e
+            callback(request_id, response, error)
+
+class FakeGmail:
+    """In-memory stand-in for the parts of the Gmail service the tests use.
+
+    `calls` lists each executed call as (method, arguments). Calls to a
+    method in `failures` raise its error instead.
+    """
+
+    def __init__(self, messages=None, labels=None):
+        self.messages_by_id = {message['id']: message for message in messages or []}
+        self.user_labels = [{'id': label_id, 'name': name, 'type': 'user'} for label_id, name in (labels or {}).items()]
+        self.calls = []
+        self.failures = {}
+
+    def users(self):
+        return self
+
+    def messages(self):
+        return FakeMessages(self)
+
+    def labels(self):
+        return FakeLabels(self)
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(callback)
+
+    def call(self, method, args, fn):
+        def execute():
+            self.calls.append((method, args))
+            if method in self.failures:
+                raise self.failures[method]
+            return fn()
+        return FakeRequest(execute)
+
+    def matches(self, message, query):
+        """Whether a message matches the `label:` terms of a query; other terms are ignored."""
+        names = {label['id']: label['name'] for label in self.user_labels}
+        for term in (query or '').split():
+            if term.startswith('label:'):
+                wanted = term[len('label:'):]
+                if not any(names.get(label_id, label_id).lower().replace(' ', '-') == wanted
+                           for label_id in message.get('labelIds', [])):
+                    return False
+        return True
+
+    def calls_to(self, method):
+        return [args for name, args in self.calls if name == method]
+
+class FakeMessages:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId, q=None, maxResults=100, pageToken=None, **kwargs):
+        def page():
+            ids = sorted(message_id for message_id, message in self.gmail.messages_by_id.items()
+                         if self.gmail.matches(message, q))
+            start = int(pageToken or 0)
+            response = {'messages': [{'id': message_id} for message_id in ids[start:start + maxResults]]}
+            if start + maxResults < len(ids):
+                response['nextPageToken'] = str(start + maxResults)
+            return response
+        return self.gmail.call('messages.list', {'q': q, 'maxResults': maxResults, 'pageToken': pageToken}, page)
+
+    def get(self, userId, id, **kwargs):
+        return self.gmail.call('messages.get', {'id': id}, lambda: copy.deepcopy(self.gmail.messages_by_id[id]))
+
+    def batchModify(self, userId, body):
+        def modify():
+            for message_id in body['ids']:
+                label_ids = self.gmail.messages_by_id[message_id].setdefault('labelIds', [])
+                label_ids[:] = [label_id for label_id in label_ids if label_id not in body['removeLabelIds']]
+                label_ids.extend(label_id for label_id in body['addLabelIds'] if label_id not in label_ids)
+            return ''
+        return self.gmail.call('messages.batchModify', copy.deepcopy(body), modify)
+
+class FakeLabels:
+    def __init__(self, gmail):
+        self.gmail = gmail
+
+    def list(self, userId, **kwargs):
+        system = [{'id': label_id, 'name': label_id, 'type': 'system'} for label_id in SYSTEM_LABELS]
+        return self.gmail.call('labels.list', {}, lambda: {'labels': system + copy.deepcopy(self.gmail.user_labels)})
+
+    def delete(self, userId, id):
+        def delete():
+            self.gmail.user_labels = [label for label in self.gmail.user_labels if label['id'] != id]
+            return ''
+        return self.gmail.call('labels.delete', {'id': id}, delete)
+
+def make_message(message_id, label_ids=(), headers=None, **fields):
+    """Return a message resource with the given label IDs and headers."""
+    message = {'id': message_id, 'labelIds': list(label_ids),
+               'payload': {'headers': [{'name': name, 'value': value} for name, value in (headers or {}).items()]}}
+    message.update(fields)
+    return message
+
+@pytest.fixture
+def controller():
+    from gmail_apply_rules import RunController
+    return RunController(name='test', quota_per_second=None)
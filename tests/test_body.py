@@ -0,0 +1,75 @@
+import re
+import base64
+
+import gmail_body
+from gmail_body import BodyReader
+
+def encode(text, charset='utf-8'):
+    # Gmail sends base64url, here without padding
+    return base64.urlsafe_b64encode(text.encode(charset)).decode('ascii').rstrip('=')
+
+def text_part(text, mime_type='text/plain', charset=None, **fields):
+    part = {'mimeType': mime_type, 'body': {'data': encode(text, charset or 'utf-8')}}
+    if charset:
+        part['headers'] = [{'name': 'Content-Type', 'value': f'{mime_type}; charset="{charset}"'}]
+    part.update(fields)
+    return part
+
+def reader(payload, **kwargs):
+    fetches = []
+
+    def fetch():
+        fetches.append(1)
+        return {'payload': payload}
+    return BodyReader(fetch, **kwargs), fetches
+
+def test_body_is_only_fetched_when_read_and_then_reused():
+    body, fetches = reader(text_part('Hello there, please unsubscribe here'))
+    assert fetches == []
+    assert body.contains('UNSUBSCRIBE')
+    assert body.contains('hello') and not body.contains('goodbye')
+    assert body.search(re.compile(r'please\s+\w+', re.IGNORECASE))
+    assert fetches == [1]
+
+def test_plain_alternative_is_read_and_attachments_are_skipped():
+    payload = {'mimeType': 'multipart/mixed', 'parts': [
+        {'mimeType': 'multipart/alternative', 'parts': [
+            text_part('plain version'),
+            text_part('<b>html version</b>', mime_type='text/html'),
+        ]},
+        text_part('attached secret', filename='notes.txt'),
+        {'mimeType': 'text/plain', 'body': {'attachmentId': 'a1', 'data': encode('other secret')}},
+    ]}
+    body, _ = reader(payload)
+    assert body.contains('plain version')
+    assert not body.contains('html version')
+    assert not body.contains('secret')
+
+def test_html_is_read_when_there_is_no_plain_version():
+    body, _ = reader({'mimeType': 'multipart/alternative', 'parts': [text_part('<p>only html</p>', mime_type='text/html')]})
+    assert body.contains('only html')
+
+def test_declared_charset_is_used():
+    body, _ = reader(text_part('Café crème', charset='iso-8859-1'))
+    assert body.contains('café crème')
+
+def test_unknown_charset_falls_back_to_utf8():
+    part = text_part('naïve')
+    part['headers'] = [{'name': 'Content-Type', 'value': 'text/plain; charset=x-unknown'}]
+    body, _ = reader(part)
+    assert body.contains('naïve')
+
+def test_matches_across_decoding_chunks(monkeypatch):
+    monkeypatch.setattr(gmail_body, 'DECODE_CHUNK_CHARS', 8)
+    text = 'ab€cdéfgh' * 5 + 'the needle ends here'
+    body, _ = reader(text_part(text))
+    assert ''.join(body.iter_chunks()) == text
+    assert body.contains('NEEDLE ENDS')
+    assert body.search(re.compile('needle ends here$'))
+
+def test_decoding_stops_at_the_byte_cap(monkeypatch):
+    monkeypatch.setattr(gmail_body, 'DECODE_CHUNK_CHARS', 16)
+    body, _ = reader(text_part('x' * 200 + 'late word'), max_bytes=60)
+    assert body.contains('xxx')
+    assert not body.contains('late word')
+    assert body.decoded_bytes < 200
@@ -0,0 +1,91 @@
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from conftest import FakeGmail, FakeRequest, make_message
+from gmail_cassette import RecordingService, ReplayService
+
+class ThrottledGmail(FakeGmail):
+    """A mailbox whose first messages.get call is throttled."""
+
+    def __init__(self, messages):
+        super().__init__(messages)
+        self.throttled = False
+
+    def messages(self):
+        messages = super().messages()
+        get = messages.get
+
+        def throttled_get(userId, id, **kwargs):
+            if not self.throttled:
+                self.throttled = True
+
+                def fail():
+                    raise HttpError(httplib2.Response({'status': 429}), b'rateLimitExceeded')
+                return FakeRequest(fail)
+            return get(userId=userId, id=id, **kwargs)
+        messages.get = throttled_get
+        return messages
+
+@pytest.fixture
+def cassette(tmp_path):
+    """Record a short session and return the cassette file."""
+    cassette_file = str(tmp_path / 'session.jsonl.gz')
+    gmail = ThrottledGmail([make_message(f"m{index}", ['INBOX'], {'Subject': f"Hello {index}"}) for index in range(3)])
+    service = RecordingService(gmail, cassette_file)
+    messages = service.users().messages()
+    with pytest.raises(HttpError):
+        messages.get(userId='me', id='m0', format='metadata').execute()
+    messages.get(userId='me', id='m0', format='metadata').execute()
+    messages.list(userId='me', q='is:unread', maxResults=2).execute()
+    messages.list(userId='me', q='is:unread', maxResults=2, pageToken='2').execute()
+    gmail.messages_by_id['m1']['labelIds'] = ['STARRED']
+    batch = service.new_batch_http_request()
+    for message_id in ('m1', 'm2'):
+        batch.add(messages.get(userId='me', id=message_id, format='metadata'), callback=lambda *args: None)
+    batch.execute()
+    service.close()
+    return cassette_file
+
+def test_calls_are_matched_on_method_and_arguments(cassette):
+    replay = ReplayService(cassette, time_scale=0)
+    messages = replay.users().messages()
+    first = messages.list(userId='me', q='is:unread', maxResults=2).execute()
+    second = messages.list(userId='me', q='is:unread', maxResults=2, pageToken='2').execute()
+    assert [message['id'] for message in first['messages']] == ['m0', 'm1']
+    assert [message['id'] for message in second['messages']] == ['m2']
+
+def test_repeated_calls_replay_in_order_then_repeat_the_last(cassette):
+    replay = ReplayService(cassette, time_scale=0)
+    messages = replay.users().messages()
+    with pytest.raises(HttpError) as error:
+        messages.get(userId='me', id='m0', format='metadata').execute()
+    assert error.value.resp.status == 429
+    for _ in range(2):
+        assert messages.get(userId='me', id='m0', format='metadata').execute()['id'] == 'm0'
+
+def test_loose_match_ignores_query_page_size_and_field_mask(cassette):
+    replay = ReplayService(cassette, time_scale=0)
+    messages = replay.users().messages()
+    page = messages.list(userId='me', q='label:other', maxResults=500, fields='messages(id)').execute()
+    assert [message['id'] for message in page['messages']] == ['m0', 'm1']
+    assert replay.misses == 0
+
+def test_unrecorded_calls_raise_and_are_counted(cassette):
+    replay = ReplayService(cassette, time_scale=0)
+    with pytest.raises(KeyError):
+        replay.users().messages().get(userId='me', id='m9', format='metadata').execute()
+    with pytest.raises(KeyError):
+        replay.users().labels().list(userId='me').execute()
+    assert (replay.calls, replay.misses) == (2, 2)
+
+def test_batches_replay_each_call_to_its_callback(cassette):
+    replay = ReplayService(cassette, time_scale=0)
+    messages = replay.users().messages()
+    results = {}
+    batch = replay.new_batch_http_request(callback=lambda request_id, response, error: results.update(
+        {request_id: (response and response['labelIds'], type(error).__name__ if error else None)}))
+    for message_id in ('m1', 'm2', 'm9'):
+        batch.add(messages.get(userId='me', id=message_id, format='metadata'), request_id=message_id)
+    batch.execute()
+    assert results == {'m1': (['STARRED'], None), 'm2': (['INBOX'], None), 'm9': (None, 'KeyError')}
@@ -0,0 +1,173 @@
+import datetime
+from datetime import UTC
+
+import pytest
+
+from conftest import FakeGmail, make_message
+from gmail_apply_rules import apply_rules, build_rule
+from gmail_conditions import (combine_queries, condition_implies, conditions_contradiction, conditions_implied,
+                              create_check, create_condition, query_term, rule_query)
+
+NOW = datetime.datetime(2024, 3, 15, 12, 0, tzinfo=UTC)
+
+# Gmail reads dates in the account's time zone, which can be up to 14 hours off UTC
+ZONE_SLACK = datetime.timedelta(hours=14)
+
+def condition(field, operator, value=''):
+    return {'field': field, 'operator': operator, 'value': value}
+
+def server_matches(term, received, size):
+    """Model of what Gmail returns for one of the terms query_term emits."""
+    operator, value = term.split(':')
+    if operator in ('older_than', 'newer_than'):
+        threshold = NOW - datetime.timedelta(days=int(value[:-1]))
+        return received < threshold if operator == 'older_than' else received > threshold
+    if operator in ('before', 'after'):
+        date = datetime.datetime.strptime(value, '%Y/%m/%d').replace(tzinfo=UTC)
+        return received < date - ZONE_SLACK if operator == 'before' else received >= date + ZONE_SLACK
+    if operator == 'larger':
+        return size > int(value)
+    return size < int(value)
+
+@pytest.mark.parametrize('field, operator, value, term', [
+    ('Age', 'older than', '30d', 'older_than:29d'),
+    ('Age', 'newer than', '7d', 'newer_than:8d'),
+    ('Age', 'older than', '1d', None),
+    ('Date', 'before', '2024-03-10', 'before:2024/03/11'),
+    ('Date', 'after', '2024/03/10', 'after:2024/03/09'),
+    ('Size', 'larger than', '1M', 'larger:943718'),
+    ('Size', 'smaller than', '1K', 'smaller:1127'),
+])
+def test_query_terms_are_widened(field, operator, value, term):
+    assert query_term(condition(field, operator, value), NOW) == term
+
+@pytest.mark.parametrize('field, operator, value', [
+    ('Age', 'older than', '30d'),
+    ('Age', 'newer than', '7d'),
+    ('Age', 'older than', '2m'),
+    ('Date', 'before', '2024-03-10'),
+    ('Date', 'after', '2024-03-10'),
+    ('Size', 'larger than', '1M'),
+    ('Size', 'smaller than', '500K'),
+])
+def test_query_terms_select_a_superset(field, operator, value):
+    rule_condition = condition(field, operator, value)
+    term = query_term(rule_condition, NOW)
+    check = create_check(rule_condition, NOW)
+    for hours in range(0, 24 * 120, 7):
+        received = NOW - datetime.timedelta(hours=hours)
+        for size in (0, 400_000, 510_000, 900_000, 1_000_000, 1_048_577, 5_000_000):
+            msg = {'internalDate': str(int(received.timestamp() * 1000)), 'sizeEstimate': size}
+            if check(msg):
+                assert server_matches(term, received, size), (received, size)
+
+def test_label_and_status_terms():
+    assert query_term(condition('Label', 'has', 'Work/Clients 2024'), NOW) == 'label:work-clients-2024'
+    assert query_term(condition('Label', 'does not have', 'News'), NOW) == '-label:news'
+    assert query_term(condition('Status', 'is unread'), NOW) == 'is:unread'
+    assert query_term(condition('Status', 'is read'), NOW) == '-is:unread'
+
+@pytest.mark.parametrize('field, operator, value', [
+    ('From', 'contains', 'example.com'),
+    ('Subject', 'starts with', 'Invoice'),
+    ('Body', 'contains', 'unsubscribe'),
+    ('Attachment', 'present', ''),
+])
+def test_conditions_without_an_exact_term_are_not_pushed_down(field, operator, value):
+    assert query_term(condition(field, operator, value), NOW) is None
+
+def test_rule_query_joins_the_terms_of_all_conditions():
+    rule = {'condition_field': 'From', 'condition_operator': 'contains', 'condition_value': 'shop',
+            'conditions': [condition('Age', 'newer than', '7d'), condition('Date', 'after', '2024-03-10')]}
+    assert rule_query(rule, NOW) == 'newer_than:8d after:2024/03/09'
+    assert rule_query({'condition_field': 'From', 'condition_operator': 'contains', 'condition_value': 'shop'}) is None
+
+def test_combined_queries_need_every_rule_to_have_one():
+    assert combine_queries(['newer_than:8d', 'after:2024/03/09', 'newer_than:8d']) == \
+        '(newer_than:8d) OR (after:2024/03/09)'
+    assert combine_queries(['newer_than:8d']) == 'newer_than:8d'
+    assert combine_queries(['newer_than:8d', None]) is None
+    assert combine_queries([]) is None
+
+@pytest.mark.parametrize('a, b', [
+    (('From', 'equals', 'A@Example.com'), ('From', 'contains', 'example.com')),
+    (('From', 'equals', 'a@example.com'), ('From', 'ends with', '@example.com')),
+    (('From', 'starts with', 'news@'), ('From', 'starts with', 'news')),
+    (('From', 'ends with', '@shop.example.com'), ('From', 'contains', 'example.com')),
+    (('Body', 'contains', 'unsubscribe now'), ('Body', 'contains', 'unsubscribe')),
+    (('Size', 'larger than', '2M'), ('Size', 'larger than', '1M')),
+    (('Size', 'smaller than', '1K'), ('Size', 'smaller than', '2K')),
+    (('Age', 'older than', '1y'), ('Age', 'older than', '30d')),
+    (('Date', 'after', '2024-03-01'), ('Date', 'after', '2024-01-01')),
+    (('Label', 'has', 'WORK'), ('Label', 'has', 'work')),
+    (('Attachment', 'present', ''), ('Attachment', 'present', '')),
+])
+def test_implied_conditions(a, b):
+    assert condition_implies(condition(*a), condition(*b), NOW)
+
+@pytest.mark.parametrize('a, b', [
+    (('From', 'contains', 'example.com'), ('From', 'equals', 'a@example.com')),
+    (('From', 'starts with', 'news'), ('From', 'ends with', 'news')),
+    (('From', 'contains', 'example.com'), ('To', 'contains', 'example.com')),
+    (('Body', 'matches regex', 'unsub.*'), ('Body', 'matches regex', 'unsub')),
+    (('Size', 'larger than', '1M'), ('Size', 'larger than', '2M')),
+    (('Size', 'larger than', '1M'), ('Size', 'smaller than', '2M')),
+    (('Age', 'older than', '30d'), ('Age', 'older than', '1y')),
+    (('Size', 'larger than', 'lots'), ('Size', 'larger than', '1M')),
+    (('Label', 'has', 'Work'), ('Label', 'does not have', 'Work')),
+])
+def test_conditions_not_implied(a, b):
+    assert not condition_implies(condition(*a), condition(*b), NOW)
+
+def test_every_condition_must_be_implied():
+    narrow = [condition('From', 'equals', 'a@example.com'), condition('Status', 'is unread')]
+    wide = [condition('From', 'contains', 'example.com'), condition('Status', 'is unread')]
+    assert conditions_implied(narrow, wide[:1], NOW)
+    assert conditions_implied(narrow, wide, NOW)
+    assert not conditions_implied(narrow[:1], wide, NOW)
+
+@pytest.mark.parametrize('conditions', [
+    [('Size', 'larger than', '5M'), ('Size', 'smaller than', '1M')],
+    [('Status', 'is unread', ''), ('Status', 'is read', '')],
+    [('Attachment', 'present', ''), ('Attachment', 'absent', '')],
+    [('Label', 'has', 'Work'), ('Label', 'does not have', 'WORK')],
+    [('From', 'equals', 'a@example.com'), ('From', 'contains', 'other.org')],
+    [('Subject', 'starts with', 'news'), ('Subject', 'starts with', 'weekly')],
+    [('Subject', 'ends with', 'news'), ('Subject', 'ends with', 'digest')],
+    [('Age', 'older than', '1y'), ('Age', 'newer than', '30d')],
+    [('Date', 'before', '2024-01-01'), ('Date', 'after', '2024-02-01')],
+    [('Date', 'before', '2024-01-01'), ('Age', 'newer than', '7d')],
+])
+def test_contradicting_conditions(conditions):
+    assert conditions_contradiction([condition(*c) for c in conditions], NOW)
+
+@pytest.mark.parametrize('conditions', [
+    [('Size', 'larger than', '1M'), ('Size', 'smaller than', '5M')],
+    [('Label', 'has', 'Work'), ('Label', 'does not have', 'News')],
+    [('From', 'equals', 'a@example.com'), ('From', 'contains', 'example')],
+    [('Subject', 'starts with', 'news'), ('Subject', 'starts with', 'newsletter')],
+    [('Age', 'older than', '30d'), ('Age', 'newer than', '1y')],
+    [('From', 'contains', 'a'), ('Subject', 'contains', 'b')],
+    [('Size', 'larger than', 'lots'), ('Size', 'smaller than', '1M')],
+])
+def test_satisfiable_conditions(conditions):
+    assert conditions_contradiction([condition(*c) for c in conditions], NOW) is None
+
+def test_age_thresholds_are_measured_from_the_given_time():
+    rule = {'condition_field': 'Age', 'condition_operator': 'older than', 'condition_value': '30d'}
+    received = NOW - datetime.timedelta(days=31)
+    msg = {'internalDate': str(int(received.timestamp() * 1000))}
+    assert create_condition(rule, NOW)(msg)
+    assert not create_condition(rule, NOW - datetime.timedelta(days=2))(msg)
+    assert rule_query({'condition_field': 'Age', 'condition_operator': 'newer than', 'condition_value': '7d'},
+                      NOW) == 'newer_than:8d'
+
+def test_runs_measure_ages_from_their_start(controller):
+    received = datetime.datetime.now(UTC) - datetime.timedelta(days=31)
+    gmail = FakeGmail([make_message('m1', ['INBOX'], internalDate=str(int(received.timestamp() * 1000)))])
+    # Built five days ago, as a window left open keeps its compiled rules
+    stale = build_rule({'condition_field': 'Age', 'condition_operator': 'older than', 'condition_value': '30d',
+                        'action_type': 'Archive'}, datetime.datetime.now(UTC) - datetime.timedelta(days=5))
+    assert not stale.condition(gmail.messages_by_id['m1'])
+    apply_rules(gmail, [stale], log_func=lambda text: None, controller=controller, prioritize=False)
+    assert gmail.messages_by_id['m1']['labelIds'] == []
@@ -0,0 +1,67 @@
+import pytest
+
+from conftest import FakeGmail, make_message
+from gmail_journal import MutationJournal, undo_run
+
+@pytest.fixture
+def journal(tmp_path):
+    journal = MutationJournal(str(tmp_path / 'journal.db'))
+    yield journal
+    journal.close()
+
+@pytest.fixture
+def gmail():
+    return FakeGmail([make_message(f"m{index}", ['INBOX']) for index in range(1, 6)])
+
+def labels(gmail):
+    return {message_id: sorted(message['labelIds']) for message_id, message in gmail.messages_by_id.items()}
+
+def archive_run(journal, gmail):
+    """Journal a run that archived m1-m3 and labeled m4, as a run would, and apply it to `gmail`."""
+    run_id = journal.start_run('archive')
+    for message_id in ('m1', 'm2', 'm3'):
+        gmail.messages_by_id[message_id]['labelIds'].remove('INBOX')
+        journal.record(run_id, message_id, [], ['INBOX'])
+    gmail.messages_by_id['m4']['labelIds'].append('Label_1')
+    journal.record(run_id, 'm4', ['Label_1'], [])
+    return run_id
+
+def test_undo_restores_labels_with_one_call_per_change(journal, gmail, controller):
+    before = labels(gmail)
+    run_id = archive_run(journal, gmail)
+    assert undo_run(gmail, journal, run_id, log_func=lambda text: None, controller=controller) == 4
+    assert labels(gmail) == before
+    calls = gmail.calls_to('messages.batchModify')
+    assert sorted((call['addLabelIds'], call['removeLabelIds'], sorted(call['ids'])) for call in calls) == [
+        ([], ['Label_1'], ['m4']),
+        (['INBOX'], [], ['m1', 'm2', 'm3']),
+    ]
+
+def test_changes_reverted_within_a_run_are_not_undone(journal, gmail, controller):
+    run_id = journal.start_run('relabel')
+    journal.record(run_id, 'm1', ['Label_1'], [])
+    journal.record(run_id, 'm1', [], ['Label_1'])
+    journal.record(run_id, 'm2', ['STARRED'], ['INBOX'])
+    assert journal.net_changes(run_id) == {'m1': (set(), set()), 'm2': ({'STARRED'}, {'INBOX'})}
+    assert undo_run(gmail, journal, run_id, log_func=lambda text: None, controller=controller) == 1
+
+def test_undo_is_journaled_and_can_itself_be_undone(journal, gmail, controller):
+    run_id = archive_run(journal, gmail)
+    after_run = labels(gmail)
+    undo_run(gmail, journal, run_id, log_func=lambda text: None, controller=controller)
+    runs = journal.runs()
+    undo = next(run for run in runs if run['description'] == f"undo of run {run_id}")
+    assert undo['changes'] == 4
+    assert journal.run(run_id)['undone'] is not None
+    undo_run(gmail, journal, undo['run_id'], log_func=lambda text: None, controller=controller)
+    assert labels(gmail) == after_run
+
+def test_undone_and_unknown_runs_are_rejected(journal, gmail, controller):
+    run_id = archive_run(journal, gmail)
+    undo_run(gmail, journal, run_id, log_func=lambda text: None, controller=controller)
+    calls = len(gmail.calls)
+    with pytest.raises(ValueError, match='already undone'):
+        undo_run(gmail, journal, run_id, log_func=lambda text: None, controller=controller)
+    with pytest.raises(ValueError, match='No run'):
+        undo_run(gmail, journal, 'missing', log_func=lambda text: None, controller=controller)
+    assert len(gmail.calls) == calls
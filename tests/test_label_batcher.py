@@ -0,0 +1,86 @@
+import pytest
+
+from conftest import FakeGmail, FakeRequest, make_message
+from gmail_apply_rules import (CancellationToken, FixedTuning, LabelChangeBatcher, StopProcessing, apply_rules,
+                               build_rules)
+
+class FailingMessages:
+    def batchModify(self, userId, body):
+        def fail():
+            raise ValueError('invalid label')
+        return FakeRequest(fail)
+
+class FailingGmail(FakeGmail):
+    def messages(self):
+        return FailingMessages()
+
+def mailbox(count):
+    return FakeGmail([make_message(f"m{index}", ['INBOX', 'UNREAD']) for index in range(count)])
+
+def sent_groups(gmail):
+    return sorted((tuple(call['addLabelIds']), tuple(call['removeLabelIds']), tuple(call['ids']))
+                  for call in gmail.calls_to('messages.batchModify'))
+
+def test_messages_with_the_same_change_share_a_call(controller):
+    gmail = mailbox(4)
+    batcher = LabelChangeBatcher(gmail, controller, log_func=lambda text: None)
+    batcher.add('m0', ['STARRED', 'IMPORTANT'], ['INBOX'])
+    batcher.add('m1', [], ['UNREAD'])
+    batcher.add('m2', ['IMPORTANT', 'STARRED'], ['INBOX'])
+    batcher.add('m3', [], [])
+    assert batcher.queued == 3
+    batcher.flush()
+    assert sent_groups(gmail) == [
+        ((), ('UNREAD',), ('m1',)),
+        (('IMPORTANT', 'STARRED'), ('INBOX',), ('m0', 'm2')),
+    ]
+    assert batcher.requests == 2 and batcher.queued == 0
+
+def test_full_groups_are_sent_as_they_fill(controller):
+    gmail = mailbox(5)
+    tuner = FixedTuning()
+    tuner.modify_batch_size = 2
+    sent = []
+    batcher = LabelChangeBatcher(gmail, controller, log_func=lambda text: None, tuner=tuner,
+                                 on_sent=lambda message_ids, added, removed: sent.append(message_ids))
+    for index in range(5):
+        batcher.add(f"m{index}", [], ['INBOX'])
+    assert sent == [['m0', 'm1'], ['m2', 'm3']]
+    batcher.flush()
+    assert sent[-1] == ['m4']
+    assert all(message['labelIds'] == ['UNREAD'] for message in gmail.messages_by_id.values())
+
+def test_failed_calls_are_reported_not_raised(controller):
+    failed = []
+    batcher = LabelChangeBatcher(FailingGmail(), controller, log_func=lambda text: None,
+                                 on_failed=lambda message_ids, error: failed.append((message_ids, str(error))))
+    batcher.add('m0', ['STARRED'], [])
+    batcher.flush()
+    assert failed == [(['m0'], 'invalid label')]
+    assert batcher.queued == 0
+
+def test_changes_stay_queued_when_the_run_is_stopped(controller):
+    gmail = mailbox(2)
+    batcher = LabelChangeBatcher(gmail, controller, log_func=lambda text: None)
+    batcher.add('m0', [], ['INBOX'])
+    batcher.add('m1', [], ['INBOX'])
+    controller.set_stop()
+    with pytest.raises(StopProcessing):
+        batcher.flush()
+    assert batcher.queued == 2 and gmail.calls == []
+    batcher.flush(CancellationToken())
+    assert sent_groups(gmail) == [((), ('INBOX',), ('m0', 'm1'))]
+
+def test_a_run_sends_one_call_per_distinct_change(controller):
+    gmail = mailbox(30)
+    rules = build_rules([
+        {'condition_field': 'Status', 'condition_operator': 'is unread', 'condition_value': '',
+         'action_type': 'Archive'},
+        {'condition_field': 'Status', 'condition_operator': 'is unread', 'condition_value': '',
+         'action_type': 'Mark read'},
+    ])
+    summary = apply_rules(gmail, rules, log_func=lambda text: None, controller=controller, prioritize=False,
+                          optimize=False)
+    assert summary['processed'] == 30
+    assert sorted(call['removeLabelIds'] for call in gmail.calls_to('messages.batchModify')) == [['INBOX', 'UNREAD']]
+    assert all(message['labelIds'] == [] for message in gmail.messages_by_id.values())
@@ -0,0 +1,46 @@
+import pytest
+
+import gmail_apply_rules
+from conftest import FakeGmail, make_message
+from gmail_apply_rules import merge_labels
+
+@pytest.fixture
+def gmail(monkeypatch):
+    # Small pages, so merges span several of them
+    monkeypatch.setattr(gmail_apply_rules, 'LIST_PAGE_SIZE', 3)
+    messages = [make_message(f"m{index}", ['INBOX', 'Label_1']) for index in range(8)]
+    messages += [make_message(f"x{index}", ['INBOX']) for index in range(2)]
+    return FakeGmail(messages, labels={'Label_1': 'Old', 'Label_2': 'New'})
+
+def labeled(gmail, label_id):
+    return sorted(message_id for message_id, message in gmail.messages_by_id.items() if label_id in message['labelIds'])
+
+def test_merge_moves_every_page_and_deletes_the_emptied_label(gmail, controller):
+    assert merge_labels(gmail, 'Label_1', 'Label_2', log_func=lambda text: None, controller=controller,
+                        delete_source=True) == 8
+    assert labeled(gmail, 'Label_1') == []
+    assert labeled(gmail, 'Label_2') == [f"m{index}" for index in range(8)]
+    assert [label['id'] for label in gmail.user_labels] == ['Label_2']
+
+def test_listing_errors_stop_the_merge(gmail, controller):
+    gmail.failures['messages.list'] = ValueError('backend error')
+    with pytest.raises(ValueError):
+        merge_labels(gmail, 'Label_1', 'Label_2', log_func=lambda text: None, controller=controller,
+                     delete_source=True)
+    assert gmail.calls_to('messages.batchModify') == []
+    assert len(gmail.user_labels) == 2
+
+def test_source_label_is_kept_while_messages_remain(gmail, controller):
+    call = gmail.call
+
+    def call_delivering_mail(method, args, fn):
+        if method == 'messages.batchModify':
+            # New mail labeled by a filter while the merge runs
+            gmail.messages_by_id['late'] = make_message('late', ['Label_1'])
+        return call(method, args, fn)
+    gmail.call = call_delivering_mail
+    with pytest.raises(RuntimeError, match='still labeled Old'):
+        merge_labels(gmail, 'Label_1', 'Label_2', log_func=lambda text: None, controller=controller,
+                     delete_source=True)
+    assert len(gmail.user_labels) == 2
+    assert labeled(gmail, 'Label_2') == [f"m{index}" for index in range(8)]
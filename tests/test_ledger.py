@@ -0,0 +1,127 @@
+import json
+
+from conftest import FakeGmail, make_message
+from gmail_apply_rules import (LEDGER_OVERLAP_MS, EvaluationLedger, GmailRule, apply_rules, build_rule,
+                               covered_query)
+
+STARTED = 1_700_000_000.0
+COVERED = int(STARTED * 1000) - LEDGER_OVERLAP_MS
+
+def definition(value='news', **fields):
+    rule = {'id': 'r1', 'condition_field': 'Subject', 'condition_operator': 'contains', 'condition_value': value,
+            'action_type': 'Label as', 'action_value': 'News'}
+    rule.update(fields)
+    return rule
+
+def test_a_complete_run_covers_mail_before_it_started(tmp_path):
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    rule = build_rule(definition())
+    assert ledger.covered_until(rule) == 0
+    ledger.record([rule], STARTED)
+    assert ledger.covered_until(rule) == COVERED
+    assert EvaluationLedger(str(tmp_path / 'ledger.json')).covered_until(rule) == COVERED
+
+def test_editing_a_rule_invalidates_its_coverage(tmp_path):
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    ledger.record([build_rule(definition())], STARTED)
+    assert ledger.covered_until(build_rule(definition(value='offers'))) == 0
+    assert ledger.covered_until(build_rule(definition(action_value='Offers'))) == 0
+    assert ledger.covered_until(build_rule(definition(stop_processing=True))) == 0
+
+def test_filter_sync_does_not_invalidate_coverage(tmp_path):
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    ledger.record([build_rule(definition())], STARTED)
+    assert ledger.covered_until(build_rule(definition(server_filter=True))) == COVERED
+
+def test_coverage_only_grows(tmp_path):
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    rule = build_rule(definition())
+    ledger.record([rule], STARTED)
+    ledger.record([rule], STARTED - 86400)
+    assert ledger.covered_until(rule) == COVERED
+    assert ledger.runs[-1]['evaluated'] == {'r1': [COVERED, COVERED - 86400 * 1000]}
+
+def test_rules_without_a_definition_are_never_covered(tmp_path):
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    rule = GmailRule('adhoc', lambda msg: True, lambda msg, service: None)
+    ledger.record([rule], STARTED)
+    assert ledger.covered_until(rule) == 0
+    assert ledger.rules == {}
+
+def test_reset_and_unreadable_files_forget_coverage(tmp_path):
+    ledger_file = tmp_path / 'ledger.json'
+    ledger = EvaluationLedger(str(ledger_file))
+    rule = build_rule(definition())
+    ledger.record([rule], STARTED)
+    ledger.reset()
+    assert ledger.covered_until(rule) == 0
+    assert json.loads(ledger_file.read_text()) == {'rules': {}, 'runs': []}
+    ledger_file.write_text('{not json')
+    assert EvaluationLedger(str(ledger_file)).covered_until(rule) == 0
+
+def test_run_history_is_capped(tmp_path):
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    rule = build_rule(definition())
+    for index in range(EvaluationLedger.MAX_RUNS + 5):
+        ledger.record([rule], STARTED + index)
+    assert len(ledger.runs) == EvaluationLedger.MAX_RUNS
+
+def test_covered_query_narrows_to_mail_received_since():
+    assert covered_query(build_rule(definition()), 0) is None
+    assert covered_query(build_rule(definition()), COVERED) == f"after:{COVERED // 1000}"
+    sized = build_rule(definition(condition_field='Size', condition_operator='larger than', condition_value='100'))
+    assert covered_query(sized, 0) == 'larger:90'
+    assert covered_query(sized, COVERED) == f"(larger:90) after:{COVERED // 1000}"
+
+def archive_rules(value='news'):
+    return [build_rule(definition(value=value, action_type='Archive', action_value=''))]
+
+def listed_queries(gmail):
+    return [call['q'] for call in gmail.calls_to('messages.list')]
+
+def run(gmail, rules, ledger, controller, **kwargs):
+    return apply_rules(gmail, rules, log_func=lambda text: None, controller=controller, ledger=ledger,
+                       prioritize=False, **kwargs)
+
+def test_runs_only_list_mail_newer_than_the_coverage(tmp_path, controller):
+    gmail = FakeGmail([make_message('m1', ['INBOX'], {'Subject': 'Weekly news'}, internalDate='0')])
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    assert run(gmail, archive_rules(), ledger, controller)['status'] == 'complete'
+    assert gmail.messages_by_id['m1']['labelIds'] == []
+    assert listed_queries(gmail) == [None]
+    covered = ledger.covered_until(archive_rules()[0])
+    assert covered > 0
+    run(gmail, archive_rules(), ledger, controller)
+    assert listed_queries(gmail)[-1] == f"after:{covered // 1000}"
+    run(gmail, archive_rules('offers'), ledger, controller)
+    assert listed_queries(gmail)[-1] is None
+
+def test_partial_runs_do_not_extend_coverage(tmp_path, controller):
+    gmail = FakeGmail([make_message('m1', ['INBOX'], {'Subject': 'Weekly news'}, internalDate='0')])
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    run(gmail, archive_rules(), ledger, controller, query='is:unread')
+    run(gmail, archive_rules(), ledger, controller, dry_run=True)
+    controller.set_stop()
+    run(gmail, archive_rules(), EvaluationLedger(str(tmp_path / 'ledger.json')), controller)
+    assert ledger.covered_until(archive_rules()[0]) == 0
+
+def test_rules_whose_result_changes_later_are_never_covered(tmp_path):
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    for field, operator, value in (('Age', 'older than', '30d'), ('Status', 'is unread', ''), ('Label', 'has', 'Work')):
+        changing = build_rule(definition(conditions=[{'field': field, 'operator': operator, 'value': value}]))
+        ledger.record([changing], STARTED)
+        assert ledger.covered_until(changing) == 0
+    merged = build_rule({'id': 'merged-1', 'action_type': 'Archive', 'action_value': '', 'any_of': [
+        definition(), definition(condition_field='Age', condition_operator='older than', condition_value='1y')]})
+    ledger.record([merged], STARTED)
+    assert ledger.covered_until(merged) == 0
+    assert ledger.rules == {}
+
+def test_aging_mail_is_listed_again_on_every_run(tmp_path, controller):
+    gmail = FakeGmail([make_message('m1', ['INBOX'], internalDate='0')])
+    ledger = EvaluationLedger(str(tmp_path / 'ledger.json'))
+    rules = [build_rule(definition(condition_field='Age', condition_operator='older than', condition_value='30d',
+                                   action_type='Archive', action_value=''))]
+    for _ in range(2):
+        assert run(gmail, rules, ledger, controller)['status'] == 'complete'
+    assert listed_queries(gmail) == ['older_than:29d', 'older_than:29d']
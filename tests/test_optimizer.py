@@ -0,0 +1,137 @@
+import random
+
+from gmail_apply_rules import GmailRule, _action_labels, build_rules, optimize_rules
+
+def rule(identifier, field, operator, value, action_type='Add label', action_value='News', **fields):
+    definition = {'id': identifier, 'condition_field': field, 'condition_operator': operator,
+                  'condition_value': value, 'action_type': action_type, 'action_value': action_value}
+    definition.update(fields)
+    return definition
+
+def optimize(definitions, coverage=None):
+    return optimize_rules(build_rules(definitions), coverage)
+
+def outcome(rules, msg):
+    """The labels a message ends up with when `rules` are applied in declared order."""
+    labels = set(msg['labelNames'])
+    for candidate in sorted(rules, key=lambda candidate: -candidate.priority):
+        if candidate.condition(msg):
+            added, removed = _action_labels(candidate.definition)
+            labels = (labels | added) - removed
+            if candidate.stop_processing:
+                break
+    return labels
+
+def test_duplicates_and_subsumed_rules_are_dropped():
+    optimized, _, report = optimize([
+        rule('a', 'From', 'contains', 'example.com'),
+        rule('b', 'From', 'contains', 'EXAMPLE.com'),
+        rule('c', 'From', 'ends with', '@shop.example.com'),
+        rule('d', 'From', 'contains', 'other.org', action_value='Other'),
+    ])
+    assert report['duplicates'] == [('b', 'a')]
+    assert report['subsumed'] == [('c', 'a')]
+    assert [candidate.id for candidate in optimized] == ['a', 'd']
+
+def test_rules_are_kept_across_a_stop_rule():
+    _, _, report = optimize([
+        rule('a', 'From', 'contains', 'example.com'),
+        rule('stop', 'Subject', 'contains', 'urgent', action_type='Star', action_value='', stop_processing=True),
+        rule('b', 'From', 'contains', 'example.com'),
+    ])
+    assert report['duplicates'] == [] and report['merged'] == []
+
+def test_rules_implied_by_an_earlier_stop_rule_are_shadowed():
+    optimized, _, report = optimize([
+        rule('stop', 'From', 'contains', 'example.com', action_type='Archive', action_value='', stop_processing=True),
+        rule('late', 'From', 'equals', 'news@example.com'),
+    ])
+    assert report['shadowed'] == [('late', 'stop')]
+    assert [candidate.id for candidate in optimized] == ['stop']
+
+def test_contradicting_rules_never_match():
+    _, _, report = optimize([
+        rule('sizes', 'Size', 'larger than', '5M', conditions=[
+            {'field': 'Size', 'operator': 'smaller than', 'value': '1M'}]),
+    ])
+    assert report['never_match'][0][0] == 'sizes'
+
+def test_rules_another_rule_undoes_are_left_alone():
+    _, _, report = optimize([
+        rule('a', 'From', 'contains', 'example.com', action_type='Archive', action_value=''),
+        rule('b', 'From', 'contains', 'example.com', action_type='Archive', action_value=''),
+        rule('back', 'Subject', 'contains', 'keep', action_value='Inbox'),
+    ])
+    assert report['duplicates'] == []
+
+def test_rules_sharing_an_action_are_merged_at_the_first_position():
+    optimized, coverage, report = optimize([
+        rule('first', 'From', 'equals', 'a@example.com'),
+        rule('other', 'Subject', 'contains', 'invoice', action_value='Bills'),
+        rule('second', 'Subject', 'starts with', 'weekly'),
+        rule('third', 'Size', 'larger than', '1M'),
+    ], coverage={'first': 5, 'second': 5, 'third': 5})
+    assert report['merged'] == [['first', 'second', 'third']]
+    merged = optimized[0]
+    assert merged.definition['any_of'][0]['id'] == 'first'
+    assert [candidate.id for candidate in optimized[1:]] == ['other']
+    assert coverage[merged.id] == 5
+    assert merged.condition({'payload': {'headers': [{'name': 'Subject', 'value': 'Weekly digest'}]}})
+    assert not merged.condition({'payload': {'headers': [{'name': 'Subject', 'value': 'Daily digest'}]}})
+
+def test_rules_with_different_coverage_are_not_merged():
+    _, _, report = optimize([
+        rule('a', 'From', 'equals', 'a@example.com'),
+        rule('b', 'From', 'equals', 'b@example.com'),
+    ], coverage={'a': 5})
+    assert report['merged'] == []
+
+def test_rulesets_without_definitions_or_with_shared_ids_are_unchanged():
+    adhoc = GmailRule('adhoc', lambda msg: True, lambda msg, service: None)
+    rules = build_rules([rule('a', 'From', 'contains', 'x')]) + [adhoc]
+    assert optimize_rules(rules) == (rules, {}, None)
+    shared = build_rules([rule('a', 'From', 'contains', 'x'), rule('a', 'From', 'contains', 'x')])
+    assert optimize_rules(shared)[2] is None
+
+CONDITIONS = [
+    ('From', 'contains', 'example.com'), ('From', 'ends with', '@example.com'), ('From', 'equals', 'a@example.com'),
+    ('From', 'starts with', 'a@'), ('From', 'contains', 'shop'), ('Subject', 'contains', 'news'),
+    ('Subject', 'starts with', 'weekly news'), ('Subject', 'equals', 'weekly news'), ('Size', 'larger than', '1K'),
+    ('Size', 'larger than', '10K'), ('Size', 'smaller than', '5K'), ('Status', 'is unread', ''),
+    ('Status', 'is read', ''), ('Label', 'has', 'Work'), ('Label', 'does not have', 'Work'),
+]
+ACTIONS = [('Add label', 'News'), ('Add label', 'Work'), ('Move to', 'Shops'), ('Archive', ''), ('Star', ''),
+           ('Mark read', '')]
+SENDERS = ['a@example.com', 'b@example.com', 'a@shop.example.com', 'shop@other.org', 'x@y.z']
+SUBJECTS = ['weekly news', 'Weekly News today', 'news', 'hello']
+
+def random_definition(generator, index):
+    conditions = generator.sample(CONDITIONS, generator.choice([1, 1, 2]))
+    action_type, action_value = generator.choice(ACTIONS)
+    definition = rule(f"r{index}", *conditions[0], action_type=action_type, action_value=action_value,
+                      priority=generator.choice([0, 0, 0, 1]), stop_processing=generator.random() < 0.15)
+    definition['conditions'] = [{'field': field, 'operator': operator, 'value': value}
+                                for field, operator, value in conditions[1:]]
+    return definition
+
+def random_message(generator):
+    labels = generator.sample(['INBOX', 'UNREAD', 'WORK', 'STARRED'], generator.randint(0, 3))
+    return {
+        'payload': {'headers': [{'name': 'From', 'value': generator.choice(SENDERS)},
+                                {'name': 'Subject', 'value': generator.choice(SUBJECTS)}]},
+        'sizeEstimate': generator.choice([500, 3000, 8000, 20000]),
+        'labelIds': labels,
+        'labelNames': labels,
+    }
+
+def test_optimized_rulesets_give_the_same_labels():
+    generator = random.Random(48)
+    optimized_any = False
+    for _ in range(200):
+        rules = build_rules([random_definition(generator, index) for index in range(generator.randint(2, 10))])
+        optimized, _, report = optimize_rules(rules)
+        optimized_any = optimized_any or len(optimized) < len(rules)
+        for _ in range(20):
+            msg = random_message(generator)
+            assert outcome(optimized, msg) == outcome(rules, msg), report
+    assert optimized_any
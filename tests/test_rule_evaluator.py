@@ -0,0 +1,68 @@
+import random
+
+from gmail_apply_rules import GmailRule, RuleEvaluator, RuleStats
+
+def make_rule(name, matches, priority=0, stop=False, calls=None):
+    def condition(msg):
+        if calls is not None:
+            calls.append(name)
+        return name in msg['matches'] if matches is None else matches
+    return GmailRule(name, condition, lambda msg, service: None, priority=priority, stop_processing=stop)
+
+def declared_walk(rules, msg):
+    """What applying the rules one by one in declared order gives."""
+    matched = []
+    for rule in sorted(rules, key=lambda rule: -rule.priority):
+        if rule.condition(msg):
+            matched.append(rule)
+            if rule.stop_processing:
+                break
+    return matched
+
+def test_results_follow_priority_then_file_order():
+    rules = [make_rule('a', True), make_rule('b', True, priority=5), make_rule('c', True), make_rule('d', True, priority=5)]
+    evaluator = RuleEvaluator(rules)
+    assert [rule.name for rule in evaluator.evaluate({})] == ['b', 'd', 'a', 'c']
+
+def test_stop_rule_suppresses_only_later_rules():
+    rules = [make_rule('first', True), make_rule('stop', True, stop=True), make_rule('after', True)]
+    assert [rule.name for rule in RuleEvaluator(rules).evaluate({})] == ['first', 'stop']
+
+def test_stop_rule_that_does_not_match_suppresses_nothing():
+    rules = [make_rule('stop', False, stop=True), make_rule('after', True)]
+    assert [rule.name for rule in RuleEvaluator(rules).evaluate({})] == ['after']
+
+def test_suppressed_rules_are_not_evaluated():
+    calls = []
+    rules = [make_rule('stop', True, stop=True, calls=calls), make_rule('later', True, calls=calls),
+             make_rule('last', True, stop=True, calls=calls)]
+    assert [rule.name for rule in RuleEvaluator(rules).evaluate({})] == ['stop']
+    assert calls == ['stop']
+
+def test_cost_based_order_gives_declared_order_results():
+    generator = random.Random(27)
+    for _ in range(50):
+        names = [f"r{index}" for index in range(generator.randint(1, 12))]
+        rules = [make_rule(name, None, priority=generator.choice([0, 0, 1, 2]), stop=generator.random() < 0.4)
+                 for name in names]
+        stats = RuleStats()
+        for name in names:
+            # Skewed statistics so the evaluation order differs from the declared one
+            for _ in range(generator.randint(0, 20)):
+                stats.record(name, generator.random() < 0.5, generator.randint(1, 10000))
+        evaluator = RuleEvaluator(rules, stats)
+        for _ in range(20):
+            msg = {'matches': {name for name in names if generator.random() < 0.3}}
+            assert evaluator.evaluate(msg) == declared_walk(rules, msg)
+
+def test_statistics_are_recorded_and_reorder_keeps_results():
+    rules = [make_rule('slow', None, stop=True), make_rule('fast', None, stop=True), make_rule('plain', None)]
+    stats = RuleStats()
+    evaluator = RuleEvaluator(rules, stats)
+    evaluator.REORDER_INTERVAL = 3
+    msg = {'matches': {'fast', 'plain'}}
+    for _ in range(10):
+        assert [rule.name for rule in evaluator.evaluate(msg)] == ['fast']
+    assert stats.counters['fast']['matches'] == 10
+    assert stats.counters['slow']['evaluations'] == 10
+    assert 'plain' not in stats.counters